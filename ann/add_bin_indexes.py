@@ -0,0 +1,79 @@
+# add_bin_indexes.py
+#
+# Adds (chrom, bin) indexes to the UCSC binned reference tables the
+# annotator queries by bin, where they are missing
+#
+# Usage: python add_bin_indexes.py [table ...]
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import sys
+
+import utils as u
+
+"""Binned tables queried with bin IN (...), and their chromosome column
+"""
+BINNED_TABLES = [("refGene", "chrom")]
+
+
+"""Whether an index starts with the chromosome and bin columns
+"""
+
+
+def hasBinIndex(cursor, table, chromCol, binCol="bin"):
+    cursor.execute("SHOW INDEX FROM " + table + ";")
+    columns = [str(d[0]) for d in cursor.description]
+    indexes = {}
+    for row in cursor.fetchall():
+        index = dict(zip(columns, row))
+        parts = indexes.setdefault(index["Key_name"], {})
+        parts[int(index["Seq_in_index"])] = str(index["Column_name"]).lower()
+
+    for parts in indexes.values():
+        if parts.get(1) == chromCol.lower() and parts.get(2) == binCol.lower():
+            return True
+    return False
+
+
+def addBinIndex(cursor, table, chromCol, binCol="bin"):
+    if hasBinIndex(cursor, table, chromCol, binCol):
+        print(f"{table}: ({chromCol}, {binCol}) index already present")
+        return False
+
+    print(f"{table}: adding ({chromCol}, {binCol}) index . . .")
+    cursor.execute(
+        "ALTER TABLE "
+        + table
+        + " ADD INDEX "
+        + chromCol
+        + "_"
+        + binCol
+        + " ("
+        + chromCol
+        + ", "
+        + binCol
+        + ");"
+    )
+    return True
+
+
+def migrate(tables=None):
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    try:
+        for table, chromCol in BINNED_TABLES:
+            if tables and table not in tables:
+                continue
+            addBinIndex(cursor, table, chromCol)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1:])
+
+### EOF
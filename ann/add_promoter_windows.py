@@ -0,0 +1,180 @@
+# add_promoter_windows.py
+#
+# Builds the promoter-window copy of refGene queried by the Genes stage
+# (GenesStage with promoter_windows=True)
+#
+# Every transcript gets the range the stage matches variants against,
+# [txStart - offset, txEnd + offset], as indexed columns, and the CpG
+# islands overlapping its putative promoter region, so a variant needs a
+# single indexed lookup instead of a scan over computed bounds followed by
+# cpgIslandExt queries
+#
+# Usage: python add_promoter_windows.py [offset ...]
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import bisect
+import json
+import sys
+
+import utils as u
+
+GENE_TABLE = "refGene"
+CPG_TABLE = "cpgIslandExt"
+
+# Promoter offset of the Genes stage
+PROMOTER_OFFSETS = [500]
+
+# Rows inserted per statement
+BATCH_SIZE = 1000
+
+
+"""Putative promoter region of a transcript (both ends included),
+   None for transcripts without a strand
+"""
+
+
+def getPromoterRegion(strand, txStart, txEnd, offset):
+    if strand == "+":
+        return txStart - offset, txStart
+    elif strand == "-":
+        return txEnd, txEnd + offset
+    return None
+
+
+"""CpG islands by chromosome, sorted by start, with their position in the
+   table (the order lookups return them in) and the longest island length
+"""
+
+
+class CpgIslands(object):
+    def __init__(self, cursor):
+        cursor.execute(
+            "select chrom, chromStart, chromEnd, name from " + CPG_TABLE + ";"
+        )
+        self.islands = {}
+        n = 0
+        for chrom, start, end, name in cursor.fetchall():
+            self.islands.setdefault(chrom, []).append((int(start), int(end), n, name))
+            n = n + 1
+
+        self.starts = {}
+        self.longest = {}
+        for chrom, islands in self.islands.items():
+            islands.sort()
+            self.starts[chrom] = [island[0] for island in islands]
+            self.longest[chrom] = max([island[1] - island[0] for island in islands])
+
+    """[chromStart, chromEnd, name] of the islands overlapping [lo, hi],
+       in table order
+    """
+
+    def overlapping(self, chrom, lo, hi):
+        if chrom not in self.islands:
+            return []
+
+        islands = self.islands[chrom]
+        found = []
+        i = bisect.bisect_right(self.starts[chrom], hi) - 1
+        while i >= 0 and islands[i][0] + self.longest[chrom] >= lo:
+            if islands[i][1] >= lo:
+                found.append(islands[i])
+            i = i - 1
+
+        found.sort(key=lambda island: island[2])
+        return [[start, end, name] for start, end, n, name in found]
+
+
+"""Columns added to the copy of the gene table
+   geneRow is the position of the transcript in the gene table, the order
+   the Genes stage reports transcripts in
+   promoterCpg holds the overlapping islands as JSON, NULL if there are none
+"""
+
+
+def getPromoterColumns(row, geneRow, offset, cpgIslands):
+    chrom = row[2]
+    strand = str(row[3])
+    txStart = int(row[4])
+    txEnd = int(row[5])
+
+    islands = []
+    region = getPromoterRegion(strand, txStart, txEnd, offset)
+    if region is not None:
+        islands = cpgIslands.overlapping(chrom, region[0], region[1])
+
+    cpg = None
+    if len(islands) > 0:
+        cpg = json.dumps(islands)
+    return (geneRow, txStart - offset, txEnd + offset, cpg)
+
+
+"""Builds the table under a temporary name and swaps it in, so jobs
+   running meanwhile keep reading the previous copy
+"""
+
+
+def buildPromoterTable(conn, offset, cpgIslands):
+    table = u.promoterTable(GENE_TABLE, offset)
+    building = table + "_build"
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS " + building + ";")
+    cursor.execute("CREATE TABLE " + building + " LIKE " + GENE_TABLE + ";")
+    cursor.execute(
+        "ALTER TABLE "
+        + building
+        + " ADD COLUMN geneRow INT NOT NULL,"
+        + " ADD COLUMN promoterStart INT NOT NULL,"
+        + " ADD COLUMN promoterEnd INT NOT NULL,"
+        + " ADD COLUMN promoterCpg TEXT;"
+    )
+
+    cursor.execute("select * from " + GENE_TABLE + ";")
+    rows = cursor.fetchall()
+    sql = None
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = [
+            tuple(rows[n]) + getPromoterColumns(rows[n], n, offset, cpgIslands)
+            for n in range(i, min(i + BATCH_SIZE, len(rows)))
+        ]
+        if sql is None:
+            marks = ",".join(["%s"] * len(batch[0]))
+            sql = "INSERT INTO " + building + " VALUES (" + marks + ");"
+        cursor.executemany(sql, batch)
+    conn.commit()
+
+    # Lookups filter on chrom = %s AND promoterStart <= %s AND %s <= promoterEnd
+    cursor.execute(
+        "ALTER TABLE "
+        + building
+        + " ADD INDEX chrom_promoter (chrom, promoterStart, promoterEnd);"
+    )
+    cursor.execute("DROP TABLE IF EXISTS " + table + ";")
+    cursor.execute("RENAME TABLE " + building + " TO " + table + ";")
+    cursor.close()
+    return table, len(rows)
+
+
+def migrate(offsets=None):
+    if not offsets:
+        offsets = PROMOTER_OFFSETS
+
+    conn = u.db_connect()
+    try:
+        cursor = conn.cursor()
+        cpgIslands = CpgIslands(cursor)
+        cursor.close()
+        for offset in offsets:
+            table, rows = buildPromoterTable(conn, int(offset), cpgIslands)
+            print(f"{table}: {str(rows)} transcripts")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1:])
+
+### EOF
@@ -9,8 +9,16 @@
 #
 ##
 
+import bisect
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import file_utils as fu
+import interval_index as ii
+import sweep as sw
 import utils as u
+import vcf_record as vr
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
@@ -96,7 +104,7 @@ def binarySearchUniqueAndSorted(arg0, key):
     obj = 0
 
     while low <= high:
-        mid = (low + high) / 2
+        mid = (low + high) // 2
         obj = arg0[mid]
 
         if obj < key:
@@ -146,488 +154,2008 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""Sets ID and INFO of a variant from the matching dbSNP rows
+   Returns True if the variant was found in dbSNP
 """
 
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
+def annotateDbSnpFields(fields, rows, varclass="SNV"):
+    fields[2] = "."
+    rsids = []
+    mafs = []
+    if len(rows) > 0:
+        for row in rows:
+            rsids.append(str(row[3]))
+            if str(row[7]) != ".":
+                mafs.append("GMAF=" + str(row[7]))
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+        maf_str = ""
+        if len(mafs) > 0:
+            maf_str = ";" + ";".join([str(x) for x in mafs])
 
-    inds = getFormatSpecificIndices(format=format)
+        if fields[7].isMissing():
+            fields[7].replace("DB" + maf_str)
+        else:
+            fields[7].add(";DB;VC=" + varclass + maf_str)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        fields[2] = str(";".join(rsids))
+        return True
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    return False
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+"""Columns of the primary key of a table, in key order (empty without one)
+"""
 
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
+def getPrimaryKey(cursor, table):
+    cursor.execute(
+        "select COLUMN_NAME from information_schema.KEY_COLUMN_USAGE"
+        + " where TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s"
+        + " AND CONSTRAINT_NAME='PRIMARY' order by ORDINAL_POSITION;",
+        [table],
+    )
+    return [str(row[0]) for row in cursor.fetchall()]
 
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+"""Resolves a window of variants on one chromosome with a single query
+   Returns a list of matching dbSNP rows for every variant in the window,
+   the rows of a variant in the order of keyColumns (the primary key of
+   dbSNP, the order the per-variant query returns them in)
+"""
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+def getDbSnpRowsForWindow(cursor, chr, window, inds, varclass="SNV", keyColumns=()):
+    positions = []
+    refs = []
+    for fields in window:
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        positions.append(pos)
+        refs.append(ref)
+        refs.append(getComplementary(ref))
+
+    positions = list(dict.fromkeys(positions))
+    refs = list(dict.fromkeys(refs))
+    sql = (
+        "select * from dbSNP where CHR=%s AND POS IN ("
+        + ",".join(["%s"] * len(positions))
+        + ") AND REF IN ("
+        + ",".join(["%s"] * len(refs))
+        + ") AND INFO=%s order by "
+        + ",".join(["POS"] + [f"`{c}`" for c in keyColumns])
+        + ";"
+    )
+    cursor.execute(sql, [chr] + positions + refs + [varclass])
+    rows = cursor.fetchall()
 
-            linenum = linenum + 1
+    columns = [str(d[0]).upper() for d in cursor.description]
+    pos_col = columns.index("POS")
+    ref_col = columns.index("REF")
 
-        else:
-            fh_out.write(line + "\n")
+    # MySQL compares strings case-insensitively, so match the same way here
+    rowsByPos = {}
+    for row in rows:
+        rowsByPos.setdefault(int(row[pos_col]), []).append(row)
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    results = []
+    for fields in window:
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        accepted = [ref.upper(), getComplementary(ref).upper()]
+        matched = []
+        for row in rowsByPos.get(int(pos), []):
+            if str(row[ref_col]).strip().upper() in accepted:
+                matched.append(row)
+        results.append(matched)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return results
 
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+"""Header, comment and empty lines are passed through unchanged
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+def isHeaderLine(line):
+    return len(line) == 0 or line.startswith("#") or line.startswith("CHROM")
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
+"""Runs a list of stages over a VCF in a single pass
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+Every variant line is read as a record (vcf_record.py, only the columns
+up to INFO are split), passed through all stages in order and written
+once; records are handed to the stages a window at a time so stages can
+resolve several variants with one query. The count log is written once
+at the end, stage by stage.
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+With a checkpoint (checkpoint.StreamCheckpoint) the run continues from the
+checkpointed input and output offsets and counts, and saves checkpoints as
+windows are written. buffering sets the buffer size of the input and
+output files, and a budget (memory.MemoryBudget) the size of every window
+after the first.
+"""
 
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
+def runPipeline(
+    stages,
+    infile,
+    outfile,
+    logcountfile,
+    logmode="w",
+    window_size=5000,
+    sep="\t",
+    concurrent=False,
+    checkpoint=None,
+    buffering=-1,
+    budget=None,
+):
+    if checkpoint is None:
+        fh = open(infile, "rb", buffering=buffering)
+        fh_out = open(outfile, "wb", buffering=buffering)
+        annotateLines(
+            stages,
+            fh,
+            fh_out,
+            window_size=window_size,
+            sep=sep,
+            concurrent=concurrent,
+            budget=budget,
+        )
+        fh.close()
+        fh_out.close()
+    else:
+        checkpoint.restoreCounts(stages)
+        fh_out = checkpoint.openOutput(buffering=buffering)
+        annotateLines(
+            stages,
+            checkpoint.readLines(buffering=buffering),
+            fh_out,
+            window_size=window_size,
+            sep=sep,
+            concurrent=concurrent,
+            checkpoint=checkpoint,
+            budget=budget,
+        )
+        fh_out.close()
+
+    writeCountLog(stages, logcountfile, logmode=logmode)
+
+
+"""Annotates an iterable of lines (bytes) and writes them to fh_out
+   (opened in binary mode)
+   With a checkpoint, a checkpoint may be saved after every full window,
+   when every line read so far has been written, and a final one at the end
+   With a budget, the budget sets the size of the next window after every
+   full window
+"""
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+def annotateLines(
+    stages,
+    lines,
+    fh_out,
+    window_size=5000,
+    sep="\t",
+    concurrent=False,
+    checkpoint=None,
+    budget=None,
+):
+    for stage in stages:
+        stage.open()
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+    executor = None
+    if concurrent:
+        u.connectionPool.reserve(len(stages))
+        executor = ThreadPoolExecutor(max_workers=len(stages))
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
+    sep = sep.encode("utf-8")
+    window = []
+    for line in lines:
+        line = line.strip()
+        if vr.isHeaderLine(line):
+            if len(window) > 0:
+                annotateWindow(stages, window, fh_out, executor=executor)
+                window = []
+            fh_out.write(line + b"\n")
+        else:
+            window.append(vr.parseRecord(line, sep))
+            if len(window) >= window_size:
+                annotateWindow(stages, window, fh_out, executor=executor)
+                window = []
+                if checkpoint is not None:
+                    checkpoint.update(stages)
+                if budget is not None:
+                    window_size = budget.nextWindowSize()
+
+    if len(window) > 0:
+        annotateWindow(stages, window, fh_out, executor=executor)
+    if checkpoint is not None:
+        checkpoint.finish(stages)
+
+    if executor is not None:
+        executor.shutdown()
+    for stage in stages:
+        stage.close()
+
+
+def writeCountLog(stages, logcountfile, logmode="w"):
+    fh_log = open(logcountfile, logmode)
+    for stage in stages:
+        stage.writeLog(fh_log)
+    for stage in stages:
+        stage.writeCacheLog(fh_log)
+    fh_log.close()
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+"""Annotates a window of records with every stage, in stage order
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+With an executor the lookups of all stages run concurrently, each stage
+on its own pooled connection. Lookups only read the locus columns, so
+they do not depend on each other; the INFO additions are then applied
+one stage after another, so the output is the same as running the
+stages in sequence.
+"""
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+def annotateWindow(stages, window, fh_out, executor=None):
+    if executor is None:
+        for stage in stages:
+            stage.annotateWindow(window)
+    else:
+        futures = [executor.submit(stage.lookupWindow, window) for stage in stages]
+        for stage, future in zip(stages, futures):
+            stage.applyWindow(window, future.result())
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    for record in window:
+        vr.writeRecord(fh_out, record)
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+"""Runs a single stage from one intermediate file to the next
+"""
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
 
-            if keep_going:
-                fh_out.write(line + "\n")
+def runStage(
+    stage, vcf, tmpextin="", tmpextout=".1", logmode="a", window_size=1, sep="\t"
+):
+    runPipeline(
+        [stage],
+        infile=vcf + tmpextin,
+        outfile=vcf + tmpextout,
+        logcountfile=vcf + ".count.log",
+        logmode=logmode,
+        window_size=window_size,
+        sep=sep,
+    )
 
-            vcf_linenum = vcf_linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+"""Base class for annotation stages
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+A stage annotates variant records (vcf_record.VcfRecord, indexed like
+the list of VCF fields, INFO held as a vcf_info.Info) in two steps:
+fetch() looks up the reference data for a variant without touching the
+record, apply() adds the result to the record and updates the counts
+that writeLog() reports. A connection is borrowed from the shared pool
+for each window, so stages that run one after another reuse the same
+connection.
+"""
 
 
-"""Get information about location in gene structures
+"""Lookup engines that read local files instead of the reference database
 """
+LOCAL_ENGINES = ["columnar", "snpindex"]
 
+"""Engines whose lookups load the rows for the whole window being fetched
+"""
+WINDOW_ENGINES = ["prefetch", "join"]
+
+
+class AnnotationStage(object):
+    label = ""
+    # Streaming stages read large results through server-side cursors
+    streaming = False
+
+    def __init__(self, format="vcf", engine="sql"):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.engine = engine
+        self.counts = {}
+        self.conn = None
+        self.cursor = None
+        self.lookups = {}
+        self.cache = None
+        self.window = None
+        self.windowLookups = {}
+
+    def open(self):
+        pass
+
+    def close(self):
+        for lookup in self.lookups.values():
+            lookup.close()
+        self.lookups = {}
+
+    """Lookup on a region table for the current window
+       SQL lookups run on the window's cursor, prefetch and join lookups are
+       kept for the window and the others for the job
+    """
+
+    def getLookup(
+        self,
+        table,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        pad=0,
+        columns="*",
+        disjoint=False,
+        binCol=None,
+    ):
+        if self.engine == "sql":
+            return getRegionLookup(
+                "sql",
+                self.conn,
+                self.cursor,
+                table,
+                chromCol=chromCol,
+                startCol=startCol,
+                endCol=endCol,
+                pad=pad,
+                columns=columns,
+                binCol=binCol,
+            )
 
-def getGenes(
-    vcf,
-    format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
-    sep="\t",
-):
+        key = (table, chromCol, startCol, endCol, pad, columns, disjoint)
+        if self.engine in WINDOW_ENGINES:
+            if key not in self.windowLookups:
+                self.windowLookups[key] = getRegionLookup(
+                    self.engine,
+                    self.conn,
+                    self.cursor,
+                    table,
+                    chromCol=chromCol,
+                    startCol=startCol,
+                    endCol=endCol,
+                    pad=pad,
+                    columns=columns,
+                    positions=self.getWindowPositions,
+                    binCol=binCol,
+                    streaming=self.streaming,
+                )
+            return self.windowLookups[key]
+
+        if key not in self.lookups:
+            self.lookups[key] = getRegionLookup(
+                self.engine,
+                self.conn,
+                self.cursor,
+                table,
+                chromCol=chromCol,
+                startCol=startCol,
+                endCol=endCol,
+                pad=pad,
+                columns=columns,
+                disjoint=disjoint,
+                binCol=binCol,
+            )
+        return self.lookups[key]
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    """Adds counts collected by another instance of this stage (another shard)
+    """
+
+    def mergeCounts(self, counts):
+        for name in counts:
+            self.count(name, counts[name])
+
+    def fetch(self, fields):
+        raise NotImplementedError
+
+    def fetchWindow(self, window):
+        return [self.fetch(fields) for fields in window]
+
+    def apply(self, fields, result):
+        raise NotImplementedError
+
+    def annotateWindow(self, window):
+        self.applyWindow(window, self.lookupWindow(window))
+
+    """Everything the lookup of a record depends on
+    """
+
+    def lookupKey(self, fields):
+        return (self.getChrom(fields, prefix=True), self.getPos(fields))
+
+    """Name the results of this stage are cached under
+       Engines other than "sql" get their own entries, so the order of
+       multiple matches one engine returns never reaches a job on another
+    """
+
+    def cacheName(self):
+        return self.engineCacheName(
+            type(self).__name__ + ":" + str(getattr(self, "table", ""))
+        )
+
+    def engineCacheName(self, name):
+        if self.engine != "sql":
+            name = name + ":" + self.engine
+        return name
+
+    """Runs the lookups for a window, once per distinct lookup key
+       Records sharing a locus (multi-sample and merged VCFs) share the result
+       Only reads the locus columns, so it is safe to run next to other stages
+    """
+
+    def lookupWindow(self, window):
+        keys = [self.lookupKey(fields) for fields in window]
+        first = {}
+        for i in range(0, len(window)):
+            if keys[i] not in first:
+                first[keys[i]] = i
+
+        distinct = list(first)
+        results = self.lookupDistinct(distinct, [window[i] for i in first.values()])
+        byKey = dict(zip(distinct, results))
+        return [byKey[key] for key in keys]
+
+    """Lookups for distinct records, answering what it can from the
+       persistent result cache
+    """
+
+    def lookupDistinct(self, keys, window):
+        if self.cache is None:
+            return self.fetchFromSource(window)
+
+        cached = self.cache.getMany(self.cacheName(), keys)
+        missing = [i for i in range(0, len(window)) if keys[i] not in cached]
+        self.count("cacheHits", len(window) - len(missing))
+        self.count("cacheMisses", len(missing))
+
+        results = [cached.get(key) for key in keys]
+        if len(missing) > 0:
+            fetched = self.fetchFromSource([window[i] for i in missing])
+            found = {}
+            for i, result in zip(missing, fetched):
+                results[i] = result
+                found[keys[i]] = result
+            self.cache.putMany(self.cacheName(), found)
+        return results
+
+    """Runs the lookups for a window on a connection borrowed from the pool
+    """
+
+    def fetchFromSource(self, window):
+        if self.engine in LOCAL_ENGINES:
+            # Answered from local files, no database needed
+            return self.fetchWindow(window)
+
+        self.conn = u.get_connection()
+        self.cursor = self.conn.cursor()
+        self.window = window
+        try:
+            return self.fetchWindow(window)
+        finally:
+            self.cursor.close()
+            u.release_connection(self.conn)
+            self.conn = None
+            self.cursor = None
+            self.window = None
+            self.windowLookups = {}
+
+    """Positions of the records of the window being fetched on a chromosome
+       (named with or without the "chr" prefix)
+    """
+
+    def getWindowPositions(self, chrom):
+        positions = []
+        for fields in self.window or []:
+            if chrom in (self.getChrom(fields), self.getChrom(fields, prefix=False)):
+                positions.append(int(self.getPos(fields)))
+        return positions
+
+    def applyWindow(self, window, results):
+        for fields, result in zip(window, results):
+            self.apply(fields, result)
+
+    def writeLog(self, fh_log):
+        pass
+
+    def writeCacheLog(self, fh_log):
+        if self.cache is not None:
+            fh_log.write(
+                f"Cache {self.label}: {str(self.counts.get('cacheHits', 0))} hits, "
+                + f"{str(self.counts.get('cacheMisses', 0))} misses\n"
+            )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    """Chromosome with or without the "chr" prefix, as each table expects
+    """
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
+    def getChrom(self, fields, prefix=True):
+        chr = fields[self.inds[0]].strip()
+        if prefix and not chr.startswith("chr"):
+            chr = "chr" + chr
+        elif not prefix and chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+        return chr
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+    def getPos(self, fields):
+        return fields[self.inds[1]].strip()
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+"""Per-variant range query, the default lookup for region tables
+   Intervals are widened by pad on both sides (promoter windows)
+   On UCSC binned tables (binCol) the query is also restricted to the bins
+   that can hold an overlapping row, so MySQL can use a (chrom, bin) index
+"""
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
+class SqlRegionLookup(object):
+    def __init__(
+        self,
+        cursor,
+        table,
+        chromCol,
+        startCol,
+        endCol,
+        pad=0,
+        columns="*",
+        binCol=None,
+    ):
+        self.cursor = cursor
+        self.pad = int(pad)
+        self.binCol = binCol
+        self.pointLookup = startCol == endCol and self.pad == 0
+        select = "select " + columns + " from " + table + " where " + chromCol
+        if self.pointLookup:
+            self.sql = select + "=%s AND " + startCol + " = %s"
+        elif self.pad == 0:
+            self.sql = (
+                select + "=%s AND (" + startCol + " <= %s AND %s <= " + endCol + ")"
+            )
+        else:
+            self.sql = (
+                select
+                + "=%s AND ("
+                + startCol
+                + " - %s) <= %s AND %s <= ("
+                + endCol
+                + " + %s)"
+            )
 
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
+    def getParams(self, chrom, pos):
+        if self.pointLookup:
+            return [chrom, pos]
+        elif self.pad == 0:
+            return [chrom, pos, pos]
+        return [chrom, self.pad, pos, pos, self.pad]
+
+    def getQuery(self, chrom, pos):
+        sql = self.sql
+        params = self.getParams(chrom, pos)
+        if self.binCol is not None:
+            # Rows reaching pos have [start, end) overlapping [pos - 1, pos + 1)
+            bins = u.binsOverlappingRange(
+                int(pos) - self.pad - 1, int(pos) + self.pad + 1
             )
+            sql = sql + " AND " + self.binCol + " IN (" + ",".join(["%s"] * len(bins))
+            sql = sql + ")"
+            params = params + bins
+        return sql + ";", params
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+    def overlapping(self, chrom, pos):
+        sql, params = self.getQuery(chrom, pos)
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchall()
 
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
+    def first(self, chrom, pos):
+        sql, params = self.getQuery(chrom, pos)
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchone()
 
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
+    def close(self):
+        pass
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
 
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
+"""Runs a query whose rows are read once, in order, and returns the cursor
+   to iterate them from
+   With streaming=True the rows come through a server-side cursor on the
+   same connection (utils.open_stream), to be closed with closeRows()
+"""
 
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
 
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+def queryRows(cursor, sql, params, streaming=False):
+    if streaming:
+        cursor = u.open_stream(cursor.connection)
+    cursor.execute(sql, params)
+    return cursor
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
 
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
+def closeRows(cursor, streaming=False):
+    if streaming:
+        cursor.close()
 
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
 
-                    else:
-                        region = ""
+# Widest range read by a single prefetch query, in bases
+PREFETCH_SPAN = 1000000
 
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
+"""Range prefetch for clustered variants, the lookup of the "prefetch" engine
 
-                    cnt = cnt + 1
+On the first lookup on a chromosome, the positions of all the window's
+records on it are grouped into clusters spanning at most PREFETCH_SPAN
+bases. The rows overlapping each cluster are then read with a single
+range query, and lookups inside a cluster are answered from memory.
+Memory is bounded by the window size and the span, and nothing outside
+the window is loaded. Positions outside the clusters fall back to
+per-variant queries.
+"""
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
 
+class PrefetchLookup(object):
+    def __init__(
+        self,
+        cursor,
+        table,
+        chromCol,
+        startCol,
+        endCol,
+        pad=0,
+        columns="*",
+        positions=None,
+        binCol=None,
+        streaming=False,
+    ):
+        self.cursor = cursor
+        self.streaming = streaming
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.pad = int(pad)
+        self.positions = positions
+        self.binCol = binCol
+        self.fallback = SqlRegionLookup(
+            cursor,
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            pad=pad,
+            columns=columns,
+            binCol=binCol,
+        )
+        self.sql = (
+            "select "
+            + columns
+            + " from "
+            + table
+            + " where "
+            + chromCol
+            + "=%s AND "
+            + startCol
+            + " <= %s AND "
+            + endCol
+            + " >= %s"
+        )
+        self.clusters = {}
+
+    def prefetch(self, chrom):
+        clusters = []
+        for pos in sorted(set(self.positions(chrom))):
+            if len(clusters) > 0 and pos - clusters[-1][0] <= PREFETCH_SPAN:
+                clusters[-1][1] = pos
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+                clusters.append([pos, pos])
+
+        starts = []
+        ends = []
+        indexes = []
+        for lo, hi in clusters:
+            sql = self.sql
+            params = [chrom, hi + self.pad, lo - self.pad]
+            if self.binCol is not None:
+                bins = u.binsOverlappingRange(lo - self.pad - 1, hi + self.pad + 1)
+                sql = sql + " AND " + self.binCol + " IN ("
+                sql = sql + ",".join(["%s"] * len(bins)) + ")"
+                params = params + bins
+            rows = queryRows(self.cursor, sql + ";", params, self.streaming)
+            starts.append(lo)
+            ends.append(hi)
+            indexes.append(
+                ii.IntervalIndex(
+                    rows,
+                    ii.getColumnIndex(rows.description, self.chromCol),
+                    ii.getColumnIndex(rows.description, self.startCol),
+                    ii.getColumnIndex(rows.description, self.endCol),
+                    pad=self.pad,
+                )
+            )
+            closeRows(rows, self.streaming)
+        self.clusters[chrom] = (starts, ends, indexes)
+
+    def overlapping(self, chrom, pos):
+        if chrom not in self.clusters:
+            self.prefetch(chrom)
+
+        pos = int(pos)
+        starts, ends, indexes = self.clusters[chrom]
+        i = bisect.bisect_right(starts, pos) - 1
+        if i >= 0 and pos <= ends[i]:
+            return indexes[i].overlapping(chrom, pos)
+        return list(self.fallback.overlapping(chrom, pos))
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def close(self):
+        pass
+
+
+# Name of the per-connection table the join engine loads positions into
+JOIN_TABLE = "annVariants"
+
+# Positions inserted per statement by the join engine
+JOIN_INSERT_SIZE = 1000
+
+"""Server-side join, the lookup of the "join" engine
+
+On the first lookup on a chromosome, the distinct positions of the
+window's records on it are loaded into a temporary table with multi-row
+inserts, and joined with the reference table in a single query. The
+database then plans the whole overlap join, and the window costs a couple
+of round trips per table and chromosome instead of one per variant. The
+joined rows come back ordered by position, and lookups are answered from
+them. STRAIGHT_JOIN keeps the positions as the outer loop, so the rows of
+each position are read (and ordered) like its per-variant query would
+read them. Positions outside the window fall back to per-variant queries.
+
+Temporary tables belong to the connection, and the window's connection is
+used by one stage at a time, so lookups can share JOIN_TABLE: each one
+reloads it and reads all of its join before the next lookup runs.
+"""
 
-            linenum = linenum + 1
 
+class JoinLookup(object):
+    def __init__(
+        self,
+        cursor,
+        table,
+        chromCol,
+        startCol,
+        endCol,
+        pad=0,
+        columns="*",
+        positions=None,
+        binCol=None,
+        streaming=False,
+    ):
+        self.cursor = cursor
+        self.streaming = streaming
+        self.positions = positions
+        self.fallback = SqlRegionLookup(
+            cursor,
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            pad=pad,
+            columns=columns,
+            binCol=binCol,
+        )
+
+        if columns.strip() == "*":
+            selected = "t.*"
         else:
-            fh_out.write(line + "\n")
+            selected = ", ".join(["t." + c.strip() for c in columns.split(",")])
+        pad = int(pad)
+        if startCol == endCol and pad == 0:
+            overlap = "t." + startCol + " = v.pos"
+        else:
+            overlap = (
+                f"t.{startCol} <= v.pos + {str(pad)}"
+                + f" AND v.pos - {str(pad)} <= t.{endCol}"
+            )
+        self.sql = (
+            f"select v.pos, {selected} from {JOIN_TABLE} v STRAIGHT_JOIN {table} t"
+            + f" on t.{chromCol}=%s AND {overlap} order by v.seq;"
+        )
+        self.rows = {}
+
+    def load(self, chrom):
+        positions = sorted(set(self.positions(chrom)))
+        self.cursor.execute(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {JOIN_TABLE}"
+            + " (seq INT NOT NULL PRIMARY KEY, pos INT NOT NULL);"
+        )
+        self.cursor.execute(f"DELETE FROM {JOIN_TABLE};")
+        for i in range(0, len(positions), JOIN_INSERT_SIZE):
+            batch = positions[i : i + JOIN_INSERT_SIZE]
+            values = []
+            for seq, pos in enumerate(batch, i):
+                values.extend([seq, pos])
+            self.cursor.execute(
+                f"INSERT INTO {JOIN_TABLE} (seq, pos) VALUES "
+                + ",".join(["(%s,%s)"] * len(batch))
+                + ";",
+                values,
+            )
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        rows = dict([(pos, []) for pos in positions])
+        found = queryRows(self.cursor, self.sql, [chrom], self.streaming)
+        for row in found:
+            rows[int(row[0])].append(tuple(row[1:]))
+        closeRows(found, self.streaming)
+        self.rows[chrom] = rows
+
+    def overlapping(self, chrom, pos):
+        if chrom not in self.rows:
+            self.load(chrom)
+
+        pos = int(pos)
+        if pos in self.rows[chrom]:
+            return self.rows[chrom][pos]
+        return list(self.fallback.overlapping(chrom, pos))
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def close(self):
+        pass
+
+
+"""Returns the lookup for a region table
+   engine is "sql", "index" (in memory), "sweep" (sort-merge, sorted input)
+   "columnar" (memory-mapped reference store, see build_refstore.py)
+   "prefetch" (range queries over the window's variants, see PrefetchLookup)
+   or "join" (window's positions joined in the database, see JoinLookup)
+   disjoint=True marks tables without overlapping intervals, which the
+   "index" engine then resolves a batch of positions at a time
+   The "index" engine sorts the matches of a position by table row number,
+   the order the "sql" lookups return them in; compare_engines.py checks an
+   engine against "sql" on the reference database
+   binCol names the UCSC bin column, used by the queries of the "sql",
+   "prefetch", "sweep" (fallback) and "join" (fallback) engines
+   With streaming=True the "prefetch" and "join" engines read their range
+   and join results through server-side cursors
+"""
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+def getRegionLookup(
+    engine,
+    conn,
+    cursor,
+    table,
+    chromCol="chrom",
+    startCol="chromStart",
+    endCol="chromEnd",
+    pad=0,
+    columns="*",
+    disjoint=False,
+    positions=None,
+    binCol=None,
+    streaming=False,
+):
+    if engine == "index":
+        return ii.getIntervalIndex(
+            conn,
+            table,
+            chromCol=chromCol,
+            startCol=startCol,
+            endCol=endCol,
+            pad=pad,
+            columns=columns,
+            disjoint=disjoint,
+        )
+    elif engine == "sweep":
+        return sw.SweepLookup(
+            table,
+            chromCol=chromCol,
+            startCol=startCol,
+            endCol=endCol,
+            pad=pad,
+            columns=columns,
+            fallback=lambda fallbackCursor: SqlRegionLookup(
+                fallbackCursor,
+                table,
+                chromCol,
+                startCol,
+                endCol,
+                pad=pad,
+                columns=columns,
+                binCol=binCol,
+            ),
+        )
+    elif engine == "columnar":
+        # numpy is only needed by the columnar store
+        import refstore as rs
+
+        return rs.ColumnarLookup(
+            table,
+            chromCol=chromCol,
+            startCol=startCol,
+            endCol=endCol,
+            pad=pad,
+            columns=columns,
+        )
+    elif engine == "prefetch":
+        return PrefetchLookup(
+            cursor,
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            pad=pad,
+            columns=columns,
+            positions=positions,
+            binCol=binCol,
+            streaming=streaming,
+        )
+    elif engine == "join":
+        return JoinLookup(
+            cursor,
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            pad=pad,
+            columns=columns,
+            positions=positions,
+            binCol=binCol,
+            streaming=streaming,
+        )
+    elif engine == "sql":
+        return SqlRegionLookup(
+            cursor,
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            pad=pad,
+            columns=columns,
+            binCol=binCol,
+        )
+    raise ValueError(f"Unknown lookup engine '{engine}'")
+
+
+"""Stages with their own queries support only some of the lookup engines
+"""
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+def checkEngine(engine, supported, label):
+    if engine not in supported:
+        raise ValueError(f"{label} does not support the '{engine}' lookup engine")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+"""Base class for stages that overlap the variant position with a region table
+   Stages that only need to know whether there is an overlap set firstOnly
+   Stages on tables without overlapping intervals set disjoint
+   Stages on UCSC binned tables set binCol
+"""
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+class RegionOverlapStage(AnnotationStage):
+    chromPrefix = True
+    chromCol = "chrom"
+    startCol = "chromStart"
+    endCol = "chromEnd"
+    firstOnly = False
+    disjoint = False
+    binCol = None
+
+    def __init__(self, table, format="vcf", engine="sql"):
+        AnnotationStage.__init__(self, format=format, engine=engine)
+        self.table = table
+        if self.label == "":
+            self.label = table
+        self.lookup = None
+
+    def fetchWindow(self, window):
+        return self.fetchTable(self.table, window)
+
+    def fetchTable(self, table, window):
+        self.lookup = self.getLookup(
+            table,
+            chromCol=self.chromCol,
+            startCol=self.startCol,
+            endCol=self.endCol,
+            disjoint=self.disjoint,
+            binCol=self.binCol,
+        )
+        if hasattr(self.lookup, "overlappingMany"):
+            return self.fetchBatched(window)
+        return AnnotationStage.fetchWindow(self, window)
+
+    def fetch(self, fields):
+        chr = self.getChrom(fields, prefix=self.chromPrefix)
+        if self.firstOnly:
+            return self.lookup.first(chr, self.getPos(fields))
+        return self.lookup.overlapping(chr, self.getPos(fields))
+
+    """Resolves the window one chromosome at a time with batched lookups
+    """
+
+    def fetchBatched(self, window):
+        byChrom = {}
+        for i in range(0, len(window)):
+            chr = self.getChrom(window[i], prefix=self.chromPrefix)
+            byChrom.setdefault(chr, []).append(i)
+
+        results = [None] * len(window)
+        for chr, lines in byChrom.items():
+            positions = [int(self.getPos(window[i])) for i in lines]
+            for i, rows in zip(lines, self.lookup.overlappingMany(chr, positions)):
+                if not self.firstOnly:
+                    results[i] = rows
+                elif len(rows) > 0:
+                    results[i] = rows[0]
+        return results
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.counts.get('var', 0))} in "
+            + f"{str(self.counts.get('line', 0))} variants\n"
+        )
+
+
+"""Appends records to INFO, with a separator unless INFO already ends with one
+"""
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def appendToInfo(fields, text):
+    fields[7].append(text)
+
+
+"""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With batch_size > 0 variants are resolved batch_size at a time per chromosome
+    engine is "sql", "columnar" or "snpindex" (dbSNP key index, see snp_index.py)
+"""
+
+
+class DbSnpStage(AnnotationStage):
+    label = "dbSNP"
+
+    def __init__(self, format="vcf", varclass="SNV", batch_size=0, engine="sql"):
+        checkEngine(engine, ["sql", "columnar", "snpindex"], self.label)
+        AnnotationStage.__init__(self, format=format, engine=engine)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.keyColumns = None
+
+    def lookupKey(self, fields):
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        return AnnotationStage.lookupKey(self, fields) + (ref,)
+
+    def cacheName(self):
+        return self.engineCacheName("DbSnpStage:" + self.varclass)
+
+    def fetch(self, fields):
+        chr = self.getChrom(fields, prefix=False)
+        pos = self.getPos(fields)
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        if self.engine == "snpindex":
+            # numpy is only needed by the dbSNP key index
+            import snp_index as si
+
+            snps = si.getSnpIndex()
+            return snps.matching(chr, pos, [ref, compRef], self.varclass)
+
+        if self.engine == "columnar":
+            # Same matching as MySQL: case-insensitive, trailing spaces ignored
+            snps = self.getLookup("dbSNP", chromCol="CHR", startCol="POS", endCol="POS")
+            refCol = snps.columnIndex("REF")
+            infoCol = snps.columnIndex("INFO")
+            accepted = [ref.upper(), compRef.upper()]
+            return [
+                row
+                for row in snps.overlapping(chr, pos)
+                if str(row[refCol]).rstrip().upper() in accepted
+                and str(row[infoCol]).rstrip().upper() == self.varclass.upper()
+            ]
+
+        sql = (
+            "select * from dbSNP where CHR=%s AND POS=%s"
+            + " AND ( REF=%s OR REF =%s )  AND INFO = %s ;"
+        )
+        self.cursor.execute(sql, [chr, pos, ref, compRef, self.varclass])
+        return self.cursor.fetchall()
+
+    def fetchWindow(self, window):
+        if self.batch_size <= 0 or self.engine != "sql":
+            return AnnotationStage.fetchWindow(self, window)
+
+        if self.keyColumns is None:
+            self.keyColumns = getPrimaryKey(self.cursor, "dbSNP")
+        results = []
+        start = 0
+        while start < len(window):
+            chr = self.getChrom(window[start], prefix=False)
+            end = start + 1
+            while (
+                end < len(window)
+                and end - start < self.batch_size
+                and self.getChrom(window[end], prefix=False) == chr
+            ):
+                end = end + 1
+            results.extend(
+                getDbSnpRowsForWindow(
+                    self.cursor,
+                    chr,
+                    window[start:end],
+                    self.inds,
+                    self.varclass,
+                    self.keyColumns,
+                )
+            )
+            start = end
+        return results
+
+    def apply(self, fields, rows):
+        self.count("variants")
+        if annotateDbSnpFields(fields, rows, varclass=self.varclass):
+            self.count("found")
+
+    def writeLog(self, fh_log):
+        # First line is counted too, as in the original AnnTools
+        linenum = self.counts.get("variants", 0) + 1
+        var_count = self.counts.get("found", 0)
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+    engine is "sql" or "columnar"
+"""
+
+
+class BigRefGeneStage(AnnotationStage):
+    label = "BigRefGene"
+
+    # The three tables are tried in this order and the first one with
+    # matches is used. Misses are the common case, so candidates from all
+    # three are read in a single round trip, each row tagged with its tier
+    tieredSql = (
+        "select 1 as tier, t.* from chrom_pos_equal_base t"
+        + " where CHR=%s AND start = %s"
+        + " AND ((haplotypeReference=%s AND haplotypeAlternate =%s)"
+        + " OR (haplotypeReference=%s AND haplotypeAlternate =%s))"
+        + " UNION ALL select 2 as tier, t.* from chrom_pos_equal_nobase t"
+        + " where CHR=%s AND start = %s"
+        + " UNION ALL select 3 as tier, t.* from chrom_pos_unequal t"
+        + " where CHR=%s AND start <= %s AND %s <= end;"
+    )
+
+    def __init__(self, format="vcf", engine="sql"):
+        checkEngine(engine, ["sql", "columnar"], self.label)
+        AnnotationStage.__init__(self, format=format, engine=engine)
+
+    def lookupKey(self, fields):
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        alt = clean_mysql_chars(fields[self.inds[3]]).strip()
+        return AnnotationStage.lookupKey(self, fields) + (ref, alt)
+
+    def fetch(self, fields):
+        chr = self.getChrom(fields, prefix=False)
+        pos = self.getPos(fields)
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        alt = clean_mysql_chars(fields[self.inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        if self.engine == "columnar":
+            return self.fetchFromStore(chr, pos, [(ref, alt), (compRef, compAlt)])
+
+        self.cursor.execute(
+            self.tieredSql,
+            [chr, pos, ref, alt, compRef, compAlt, chr, pos, chr, pos, pos],
+        )
+        return self.firstTier(self.cursor.fetchall())
+
+    """Rows of the first tier with matches, without the tier column
+    """
+
+    def firstTier(self, rows):
+        tiers = {}
+        for row in rows:
+            tiers.setdefault(int(row[0]), []).append(tuple(row[1:]))
+        if len(tiers) == 0:
+            return ()
+        return tuple(tiers[min(tiers)])
+
+    def fetchFromStore(self, chr, pos, alleles):
+        equalBase = self.getLookup(
+            "chrom_pos_equal_base", chromCol="CHR", startCol="start", endCol="start"
+        )
+        refCol = equalBase.columnIndex("haplotypeReference")
+        altCol = equalBase.columnIndex("haplotypeAlternate")
+        accepted = [(ref.upper(), alt.upper()) for ref, alt in alleles]
+        rows = [
+            row
+            for row in equalBase.overlapping(chr, pos)
+            if (str(row[refCol]).rstrip().upper(), str(row[altCol]).rstrip().upper())
+            in accepted
+        ]
+        if len(rows) > 0:
+            return rows
+
+        equalNoBase = self.getLookup(
+            "chrom_pos_equal_nobase", chromCol="CHR", startCol="start", endCol="start"
+        )
+        rows = equalNoBase.overlapping(chr, pos)
+        if len(rows) > 0:
+            return rows
+
+        unequal = self.getLookup(
+            "chrom_pos_unequal", chromCol="CHR", startCol="start", endCol="end"
+        )
+        return unequal.overlapping(chr, pos)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]])))
+
+            fields[7].add(";" + ";".join(m))
+            if fields[7].startswith(".;"):
+                fields[7].dropPrefix(2)
+
+
+"""A refGene transcript with its exons parsed into integer arrays
+"""
+
+
+class Transcript(object):
+    __slots__ = [
+        "strand",
+        "txStart",
+        "txEnd",
+        "cdsStart",
+        "cdsEnd",
+        "exonCount",
+        "exonStarts",
+        "exonEnds",
+        "sortedExons",
+    ]
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = [
+            int(x) for x in row[9].decode("utf-8").split(",")[0 : self.exonCount]
+        ]
+        self.exonEnds = [
+            int(x) for x in row[10].decode("utf-8").split(",")[0 : self.exonCount]
+        ]
+
+        # Exons in order and apart from each other can be binary searched
+        self.sortedExons = True
+        for e in range(1, self.exonCount):
+            if self.exonStarts[e] <= self.exonEnds[e - 1]:
+                self.sortedExons = False
+
+    """Numbers (0-based, in table order) of the exons containing pos
+    """
+
+    def exonsAt(self, pos):
+        if not self.sortedExons:
+            return [
+                e
+                for e in range(0, self.exonCount)
+                if u.isBetween(pos, self.exonStarts[e], self.exonEnds[e])
+            ]
+
+        e = bisect.bisect_right(self.exonStarts, pos) - 1
+        if e >= 0 and pos <= self.exonEnds[e]:
+            return [e]
+        return []
+
+
+"""Transcripts parsed by this process, keyed by name and coordinates,
+   least recently used first
+"""
+transcriptCache = OrderedDict()
+
+"""Transcripts a streaming run keeps parsed
+"""
+TRANSCRIPT_CACHE_SIZE = 10000
+
+
+"""Parsed transcript of a gene table row
+   With a limit the least recently used transcripts are dropped once the
+   cache holds more than limit of them
+"""
+
+
+def getTranscript(row, limit=None):
+    key = tuple(row[1:11])
+    transcript = transcriptCache.get(key)
+    if transcript is None:
+        transcript = Transcript(row)
+        transcriptCache[key] = transcript
+        if limit is not None:
+            while len(transcriptCache) > limit:
+                transcriptCache.popitem(last=False)
+    elif limit is not None:
+        transcriptCache.move_to_end(key)
+    return transcript
+
+
+def clearTranscriptCache():
+    transcriptCache.clear()
+
+
+"""Columns add_promoter_windows.py appends to the gene table
+   (geneRow, promoterStart, promoterEnd, promoterCpg)
+"""
+PROMOTER_GENE_ROW = -4
+PROMOTER_CPG = -1
+
+"""Get information about location in gene structures
+"""
+
+
+class GenesStage(AnnotationStage):
+    label = "Genes"
+
+    # positionType set by BigRefGene and the counter it goes to
+    positionTypeCounts = {
+        "intron": "intronic",
+        "non_coding_intron": "non_coding_intronic",
+        "CDS": "cds",
+        "non_coding_exon": "non_coding_exonic",
+        "utr5": "utr5",
+        "utr3": "utr3",
+    }
+
+    def __init__(
+        self,
+        format="vcf",
+        table="refGene",
+        promoter_offset=500,
+        engine="sql",
+        promoter_windows=False,
+    ):
+        AnnotationStage.__init__(self, format=format, engine=engine)
+        self.table = table
+        self.promoter_offset = int(promoter_offset)
+        self.promoter_windows = promoter_windows
+
+    def cacheName(self):
+        return AnnotationStage.cacheName(self) + ":" + str(self.promoter_offset)
+
+    """Transcripts within promoter_offset of the position, in table order
+       With promoter_windows the padded ranges and the promoter CpG islands
+       are read from the table built by add_promoter_windows.py, in one
+       indexed lookup
+    """
+
+    def getTranscripts(self, chr, pos):
+        if self.promoter_windows:
+            transcripts = self.getLookup(
+                u.promoterTable(self.table, self.promoter_offset),
+                startCol="promoterStart",
+                endCol="promoterEnd",
+            )
+            # Rows come back in index order
+            rows = list(transcripts.overlapping(chr, pos))
+            rows.sort(key=lambda row: row[PROMOTER_GENE_ROW])
+            return rows
+
+        transcripts = self.getLookup(
+            self.table,
+            startCol="txStart",
+            endCol="txEnd",
+            pad=self.promoter_offset,
+            binCol="bin",
+        )
+        return transcripts.overlapping(chr, pos)
+
+    """First CpG island containing the position, as a cpgIslandExt row
+       (chrom, chromStart, chromEnd, name)
+    """
+
+    def getCpgIsland(self, chr, pos, row):
+        if self.promoter_windows:
+            # promoterCpg lists the islands overlapping the promoter region
+            # of the transcript
+            if row[PROMOTER_CPG] is None:
+                return None
+            for start, end, name in json.loads(row[PROMOTER_CPG]):
+                if u.isBetween(pos, start, end):
+                    return (chr, start, end, name)
+            return None
+
+        cpgIslands = self.getLookup(
+            "cpgIslandExt", columns="chrom, chromStart, chromEnd, name"
+        )
+        return cpgIslands.first(chr, pos)
+
+    """Returns (row, region, exonic hits, putative promoter hit) for every
+    overlapping transcript
+    """
+
+    def fetch(self, fields):
+        chr = self.getChrom(fields, prefix=True)
+        pos = int(self.getPos(fields))
+
+        rows = self.getTranscripts(chr, pos)
+
+        located = []
+        for row in rows:
+            transcript = getTranscript(
+                row, TRANSCRIPT_CACHE_SIZE if self.streaming else None
+            )
+            txtStart = transcript.txStart
+            txtEnd = transcript.txEnd
+            cdsStart = transcript.cdsStart
+            cdsEnd = transcript.cdsEnd
+            exonCount = transcript.exonCount
+            strand = transcript.strand
+
+            promoter_plus = txtStart - self.promoter_offset
+            promoter_minus = txtEnd + self.promoter_offset
+            region = ""
+            exonic = 0
+            promoter = False
+            exons = []
+
+            if cdsStart == cdsEnd:
+                for e in transcript.exonsAt(pos):
+                    exnum = e + 1
+                    if strand == "-":
+                        exnum = exonCount - e
+                    exons.append(
+                        "non_coding_exon=" + "ex" + str(exnum) + "/" + str(exonCount)
+                    )
+                if len(exons) > 0:
+                    region = ";".join(exons)
+            elif u.isBetween(pos, cdsStart, cdsEnd):
+                for e in transcript.exonsAt(pos):
+                    exnum = e + 1
+                    if strand == "-":
+                        exnum = exonCount - e
+                    exons.append("exon=" + "ex" + str(exnum) + "/" + str(exonCount))
+                    exonic = exonic + 1
+                if len(exons) > 0:
+                    region = ";".join(exons)
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or (
+                u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")
+            ):
+                cpg = self.getCpgIsland(chr, pos, row)
+                if cpg is not None:
+                    region = "putativePromoterRegion=" + "".join(str(cpg[3]).split())
+                    promoter = True
+
+            located.append((row, region, exonic, promoter))
+
+        return located
+
+    def apply(self, fields, located):
+        if len(located) > 0:
+            # count location, once for every transcript
+            positionType = clean_mysql_chars(fields[7].get("positionType"))
+            if positionType in self.positionTypeCounts:
+                self.count(self.positionTypeCounts[positionType], len(located))
+
+            info = []
+            cnt = 1
+            for row, region, exonic, promoter in located:
+                self.count("exonic", exonic)
+                if promoter:
+                    self.count("promoter")
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row, indices=indicesKnownGenes, region=region, cnt=cnt
+                        )
+                    )
+                cnt = cnt + 1
+
+            fields[7].add(";" + ";".join(info))
+
+        else:
+            fields[7].add(";positionType=interGenic")
+            self.count("interGenic")
+
+    def writeLog(self, fh_log):
+        lines = [
+            ("In interGenic", "interGenic"),
+            ("In CDS", "cds"),
+            ("In '3 UTR", "utr3"),
+            ("In '5 UTR", "utr5"),
+            ("In Intronic", "intronic"),
+            ("In Non_coding_intronic", "non_coding_intronic"),
+            ("In Exonic", "exonic"),
+            ("In Non_coding_exonic", "non_coding_exonic"),
+            ("In Putative Promoter Region", "promoter"),
+        ]
+
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+        for text, name in lines:
+            print(f"{text} {str(self.counts.get(name, 0))}")
+            fh_log.write(f"{text} {str(self.counts.get(name, 0))}\n")
+
+
+"""Longest site of each tfbsConsSites<chr> table, read by this process
+"""
+tfbsSiteLengths = {}
+
+"""Overlap with tfbsConsSites
+"""
+
+
+class TfbsConsSitesStage(AnnotationStage):
+    label = "addOverlapWithTfbsConsSites"
+
+    allowed_chrom = [str(c) for c in range(1, 23)] + ["X", "Y"]
+
+    def __init__(self, format="vcf", table="tfbsConsSites", engine="sql"):
+        checkEngine(engine, ["sql", "columnar"], self.label)
+        AnnotationStage.__init__(self, format=format, engine=engine)
+        self.table = table
+
+    def fetch(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chrIndex = self.getChrom(fields, prefix=False)
+        if chrIndex not in self.allowed_chrom:
+            return []
+
+        pos = self.getPos(fields)
+        if self.engine == "columnar":
+            sites = self.getLookup(
+                self.table + chrIndex,
+                chromCol=None,
+                columns="chrom, chromStart, chromEnd, name",
+            )
+            return sites.overlapping(None, pos)
+
+        sql = (
+            "select chrom, chromStart, chromEnd, name from "
+            + self.table
+            + chrIndex
+            + " where  chromStart <= %s AND %s <= chromEnd;"
+        )
+        self.cursor.execute(sql, [pos, pos])
+        return self.cursor.fetchall()
+
+    """Resolves the window one chromosome table at a time
+       The window's positions on a chromosome are grouped into clusters
+       spanning at most PREFETCH_SPAN bases, the sites overlapping each
+       cluster are read with one range query and assigned to the positions
+       in a sweep
+    """
+
+    def fetchWindow(self, window):
+        if self.engine != "sql":
+            return AnnotationStage.fetchWindow(self, window)
+
+        byChrom = {}
+        for i in range(0, len(window)):
+            chrIndex = self.getChrom(window[i], prefix=False)
+            if chrIndex in self.allowed_chrom:
+                byChrom.setdefault(chrIndex, []).append(i)
+
+        results = [[] for fields in window]
+        for chrIndex, lines in byChrom.items():
+            positions = [int(self.getPos(window[i])) for i in lines]
+            sites = {}
+            clusters = []
+            for pos in sorted(set(positions)):
+                if len(clusters) > 0 and pos - clusters[-1][0] <= PREFETCH_SPAN:
+                    clusters[-1].append(pos)
+                else:
+                    clusters.append([pos])
+            for cluster in clusters:
+                sites.update(self.sweepSites(self.table + chrIndex, cluster))
+            for i, pos in zip(lines, positions):
+                results[i] = sites[pos]
+        return results
+
+    """Sites overlapping each of the sorted positions, keyed by position
+       Sites of a position keep the order the range query returned them in,
+       like the per-variant query
+    """
+
+    def sweepSites(self, table, positions):
+        lo = positions[0]
+        hi = positions[-1]
+        # Bounding the start by the longest site keeps the range on chromStart
+        sql = (
+            "select chrom, chromStart, chromEnd, name from "
+            + table
+            + " where chromStart >= %s AND chromStart <= %s AND %s <= chromEnd;"
+        )
+        found = queryRows(
+            self.cursor, sql, [lo - self.getSiteLength(table), hi, lo], self.streaming
+        )
+        rows = sorted(enumerate(found), key=lambda e: (int(e[1][1]), e[0]))
+        closeRows(found, self.streaming)
+
+        sites = {}
+        active = []
+        added = 0
+        for pos in positions:
+            while added < len(rows) and int(rows[added][1][1]) <= pos:
+                active.append(rows[added])
+                added = added + 1
+            active = [e for e in active if int(e[1][2]) >= pos]
+            sites[pos] = [e[1] for e in sorted(active, key=lambda e: e[0])]
+        return sites
+
+    """Longest site of a chromosome table, read once per process
+    """
+
+    def getSiteLength(self, table):
+        if table not in tfbsSiteLengths:
+            self.cursor.execute("select max(chromEnd - chromStart) from " + table + ";")
+            length = self.cursor.fetchone()[0]
+            tfbsSiteLengths[table] = int(length or 0)
+        return tfbsSiteLengths[table]
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            records = []
+            for row in rows:
+                self.count("var")
+                t = (
+                    str(row[3])
+                    + "."
+                    + str(row[0])
+                    + "."
+                    + str(row[1])
+                    + "."
+                    + str(row[2])
+                )
+                records.append("tfbsRegion" + "=" + t.strip())
+            appendToInfo(fields, ";".join(records))
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.counts.get('var', 0))} in "
+            + f"{str(self.counts.get('line', 0))} variants\n"
+        )
+
+
+"""Overlap with GadAll table
+"""
+
+
+class GadAllStage(RegionOverlapStage):
+    # For some reason this table has no "chr" preceeding number
+    chromPrefix = False
+    chromCol = "chromosome"
+
+    def __init__(self, format="vcf", table="gadAll", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.count("var")
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + "=" + str(row[3]))
+            appendToInfo(fields, ";".join(records))
+
+
+""" Overlap with gwasCatalog table """
+
+
+class GwasCatalogStage(RegionOverlapStage):
+    startCol = "chromEnd"
+    endCol = "chromEnd"
+
+    def __init__(self, format="vcf", table="gwasCatalog", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            records = []
+            for row in rows:
+                self.count("var")
+                records.append(
+                    str(self.table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
+                )
+            appendToInfo(fields, ";".join(records))
+
+
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+
+
+class HugoStage(RegionOverlapStage):
+    label = "HUGO Gene Nomenclature Committee"
+
+    def __init__(self, format="vcf", table="hugo", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.count("var")
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
+            appendToInfo(fields, ",".join(records).replace(";", ","))
+
+
+"""Overlap with segdup regions genomicSuperDups
+"""
+
+
+class GenomicSuperDupsStage(RegionOverlapStage):
+    firstOnly = True
+
+    def __init__(self, format="vcf", table="genomicSuperDups", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.count("line")
+            self.count("var")
+            fields[7].add(
+                ";"
+                + str(self.table)
+                + "="
+                + str(True)
+                + ";"
+                + "otherChrom="
+                + str(row[7])
+                + ";otherStart="
+                + str(row[8])
+                + ";otherEnd="
+                + str(row[9])
+            )
+
+
+"""Searches Genes Databases and returns Genes/Cytobands
+   with which SNP or INDEL overlaps
+"""
+
+
+class RefGeneOverlapStage(RegionOverlapStage):
+    startCol = "txStart"
+    endCol = "txEnd"
+    binCol = "bin"
+
+    def __init__(self, format="vcf", table="refGene", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            overlapsWith = []
+            for row in rows:
+                self.count("var")
+                overlapsWith.append(
+                    "name2" + "=" + str(row[12]) + ";" + "name" + "=" + str(row[1])
+                )
+            appendToInfo(fields, ";".join([str(x) for x in overlapsWith]))
+
+
+"""Method to find overlap with Cytoband table
+"""
+
+
+class CytobandStage(RegionOverlapStage):
+    label = "Cytoband"
+
+    def __init__(self, format="vcf", table="cytoBand", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+        self.colindex = 12
+        self.startCol = "txStart"
+        self.endCol = "txEnd"
+        if table == "cytoBand":
+            # Bands partition each chromosome
+            self.colindex = 3
+            self.startCol = "chromStart"
+            self.endCol = "chromEnd"
+            self.disjoint = True
+
+    def apply(self, fields, rows):
+        if len(rows) > 0:
+            self.count("line")
+            overlapsWith = []
+            for row in rows:
+                self.count("var")
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
+            appendToInfo(fields, str(self.table) + "=" + str(cytoband))
+
+
+"""Method to find overlap with CNV tables
+   With a list of tables, all of them are resolved in the same pass; the
+   flags and count log lines stay per table, in the order of the list
+   The result of a record is a tuple of per-table overlap flags
+"""
+
+
+class CnvStage(RegionOverlapStage):
+    firstOnly = True
+
+    def __init__(self, format="vcf", table="dgv_Cnv", engine="sql", tables=None):
+        if tables is None:
+            tables = [table]
+        self.tables = list(tables)
+        RegionOverlapStage.__init__(
+            self, ", ".join(self.tables), format=format, engine=engine
+        )
+
+    def cacheName(self):
+        return type(self).__name__ + ":flags:" + ",".join(self.tables)
+
+    def fetchWindow(self, window):
+        if self.engine == "sql":
+            return [self.fetchCombined(fields) for fields in window]
+
+        byTable = [self.fetchTable(table, window) for table in self.tables]
+        return [tuple([row is not None for row in rows]) for rows in zip(*byTable)]
+
+    """Overlap flags of all the tables from a single query
+    """
+
+    def fetchCombined(self, fields):
+        overlap = (
+            self.chromCol
+            + "=%s AND ("
+            + self.startCol
+            + " <= %s AND %s <= "
+            + self.endCol
+            + ")"
+        )
+        sql = ", ".join(
+            [
+                "EXISTS(select 1 from " + table + " where " + overlap + ")"
+                for table in self.tables
+            ]
+        )
+        chr = self.getChrom(fields, prefix=self.chromPrefix)
+        pos = self.getPos(fields)
+        self.cursor.execute("select " + sql + ";", [chr, pos, pos] * len(self.tables))
+        return tuple([bool(flag) for flag in self.cursor.fetchone()])
+
+    def apply(self, fields, flags):
+        for table, flag in zip(self.tables, flags):
+            if flag:
+                self.count("line:" + table)
+                self.count("var:" + table)
+                appendToInfo(fields, str(table) + "=" + str(True))
+
+    def writeLog(self, fh_log):
+        for table in self.tables:
+            fh_log.write(
+                f"In {str(table)}: {str(self.counts.get('var:' + table, 0))} in "
+                + f"{str(self.counts.get('line:' + table, 0))} variants\n"
+            )
+
+
+"""Method to find overlap with targetScanS tables
+"""
+
+
+class MiRNAStage(RegionOverlapStage):
+    label = "miRNA"
+    firstOnly = True
+
+    def __init__(self, format="vcf", table="targetScanS", engine="sql"):
+        RegionOverlapStage.__init__(self, table, format=format, engine=engine)
+
+    def apply(self, fields, row):
+        if row is not None:
+            self.count("line")
+            self.count("var")
+            t = (
+                str(row[4])
+                + ","
+                + str(row[1])
+                + "_"
+                + str(row[2])
+                + "_"
+                + str(row[3])
+            )
+            appendToInfo(fields, "miRNAsites=" + t.strip())
+
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In miRNAsites: {str(self.counts.get('var', 0))} in "
+            + f"{str(self.counts.get('line', 0))} variants\n"
+        )
+
+
+"""Stage-by-stage entry points
+   Each one reads one intermediate file and writes the next
+"""
+
+
+def getSnpsFromDbSnp(
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
+    sep="\t",
+    batch_size=0,
+):
+    runStage(
+        DbSnpStage(format=format, varclass=varclass, batch_size=batch_size),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        logmode="w",
+        window_size=max(batch_size, 1),
+        sep=sep,
+    )
+
+
+def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
+    runStage(
+        BigRefGeneStage(format=format),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
+
+
+def getGenes(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    promoter_windows=False,
+):
+    runStage(
+        GenesStage(
+            format=format,
+            table=table,
+            promoter_offset=promoter_offset,
+            promoter_windows=promoter_windows,
+        ),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -664,7 +2192,7 @@ def getExonsEtAl(
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    conn = u.get_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -889,868 +2417,164 @@ def getExonsEtAl(
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
-
-
-"""Overlap with tfbsConsSites
-"""
+    u.release_connection(conn)
 
 
 def addOverlapWithTfbsConsSites(
     vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
 ):
+    runStage(
+        TfbsConsSitesStage(format=format, table=table),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWithGadAll(
+    vcf,
+    format="vcf",
+    table="gadAll",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        GadAllStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+def addOverlapWithGwasCatalog(
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        GwasCatalogStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
+def addOverlapWitHUGOGeneNomenclature(
+    vcf,
+    format="vcf",
+    table="hugo",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        HugoStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-
-                    fh_out.write("\t".join(fields) + "\n")
-
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
-
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
-
-        linenum = linenum + 1
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with GadAll table
-"""
-
-
-def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-""" Overlap with gwasCatalog table """
-
-
-def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-
-
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with segdup regions genomicSuperDups
-"""
-
-
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
-
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
-"""
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        GenomicSuperDupsStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
 
 def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="refGene",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = "name"
-    name2 = "name2"
-    startName = "txStart"
-    endName = "txEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
-
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        RefGeneOverlapStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Method to find overlap with Cytoband table
-"""
 
 
 def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
-
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        CytobandStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Method to find overlap with CNV tables
-"""
 
 
 def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+    tables=None,
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        CnvStage(format=format, table=table, engine=engine, tables=tables),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Method to find overlap with targetScanS tables
-"""
 
 
 def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        MiRNAStage(format=format, table=table, engine=engine),
+        vcf,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 ### EOF
@@ -14,6 +14,9 @@ import sys
 import json
 from botocore.exceptions import ClientError
 
+import driver
+import job_monitor as jm
+
 base_dir = os.path.abspath(os.path.dirname(__file__))
 
 # Get configuration
@@ -32,15 +35,26 @@ jobFolder = os.path.join(base_dir, "job")
 if not os.path.exists(jobFolder):
     os.makedirs(jobFolder)
 
+"""Jobs launched by this annotator and still running, keyed by job ID
+"""
+runningJobs = {}
+
 
-def handle_requests_queue(sqsQueue=None, s3=None, dynamodbTable=None, maxMessages=None, waitTime = None):
+def handle_requests_queue(sqsQueue=None, s3=None, dynamodbTable=None, maxMessages=None, waitTime = None,
+                          visibilityTimeout=jm.VISIBILITY_TIMEOUT, maxReceiveCount=jm.MAX_RECEIVE_COUNT):
+
+    # Extend the messages of running jobs, delete those of completed ones
+    for jobId in list(runningJobs):
+        if runningJobs[jobId].poll():
+            del runningJobs[jobId]
 
     # configparser： https://docs.python.org/3/library/configparser.html
     # configparser error handling: https://stackoverflow.com/questions/24832628/python-configparser-getting-and-setting-without-exceptions
     # Read messages from the queue
     messages = []
     try:
-        messages = sqsQueue.receive_messages(MaxNumberOfMessages=maxMessages, WaitTimeSeconds=waitTime)
+        messages = sqsQueue.receive_messages(MaxNumberOfMessages=maxMessages, WaitTimeSeconds=waitTime,
+                                             AttributeNames=jm.MESSAGE_ATTRIBUTES)
     except ClientError as e:
         if e.response["Error"]["Code"] == "AccessDenied":
             print(f"Access denied to the queue: {e}")
@@ -99,30 +113,53 @@ def handle_requests_queue(sqsQueue=None, s3=None, dynamodbTable=None, maxMessage
                 print(f"Delete message failed: {e}")
             continue
 
+        # Stages requested for this job, replacing the configured pipeline
+        pipeline = data.get("pipeline")
+        if pipeline is not None:
+            try:
+                pipeline = driver.parsePipeline(pipeline)
+            except ValueError as e:
+                jm.failJob(dynamodbTable, jobId, message, f"invalid pipeline in job request: {e}")
+                continue
+
+        # A redelivered request of a job still running here only hands over its receipt handle
+        if jobId in runningJobs:
+            runningJobs[jobId].setMessage(message)
+            continue
+
+        # A request delivered more often than that keeps failing
+        if jm.getReceiveCount(message) > maxReceiveCount:
+            jm.failJob(dynamodbTable, jobId, message, f"gave up after {maxReceiveCount} attempts")
+            continue
+
         # Downloads the input file from S3 and saves it to the AnnTools instance in /home/ubuntu/gas/ann/job/<user_id>/<job_id> folder
+        # An existing job folder is from an interrupted run of the job, which resumes from its checkpoint
         singleJobFolder = os.path.join(jobFolder, userId, jobId)
-        try:
-            os.makedirs(singleJobFolder)
-        except FileExistsError as e:
-            print(f"Job folder has already in annotator: {e}")
-            continue
+        if os.path.exists(singleJobFolder):
+            print(f"Resuming job {jobId} in its existing job folder")
+        os.makedirs(singleJobFolder, exist_ok=True)
 
         filename = key.split("~")[-1]
         localPath = os.path.join(singleJobFolder, filename)
 
-        try:
-            s3.download_file(bucket, key, localPath)
-        except ClientError as e:
-            print(f"Cannot download the input file from s3: {e}")
-            continue
+        # download_file() writes to a temporary file first, so an existing input is complete
+        if not os.path.exists(localPath):
+            try:
+                s3.download_file(bucket, key, localPath)
+            except ClientError as e:
+                print(f"Cannot download the input file from s3: {e}")
+                continue
 
         if not os.path.exists(localPath):  # if file is not found
             print("Cannot find the file in the AnnTools instance")
             continue
 
         # Launch annotation job as a background process
+        command = ["python", os.path.join(base_dir, "run.py"), localPath]
+        if pipeline is not None:
+            command.append(json.dumps(pipeline))
         try:
-            subprocess.Popen(["python", os.path.join(base_dir, "run.py"), localPath])
+            process = subprocess.Popen(command)
         except subprocess.CalledProcessError as e:
             print(f"Subprocess failed, failed to launch annotator job: {e}")
             continue
@@ -130,13 +167,8 @@ def handle_requests_queue(sqsQueue=None, s3=None, dynamodbTable=None, maxMessage
             print(str(e))
             continue
 
-        # Delete message from queue, if job was successfully submitted
-        try:
-            message.delete()
-        except ClientError as e:
-            print(f"Delete message failed: {e}")
-        except Exception as e:
-            print(str(e))
+        # Keep the message hidden while the job runs, it is deleted once the job completes
+        runningJobs[jobId] = jm.JobMonitor(jobId, process, message, visibilityTimeout=visibilityTimeout)
 
         # Update job_status in DynamoDB to “RUNNING” if its current status is “PENDING”
         try:
@@ -160,6 +192,14 @@ def handle_requests_queue(sqsQueue=None, s3=None, dynamodbTable=None, maxMessage
 
 
 def main():
+    # Check the configured pipeline and engines before taking any job
+    try:
+        driver.parsePipeline(driver.pipelineFromConfig(config))
+        driver.enginesFromConfig(config)
+    except ValueError as e:
+        print(f"Invalid [ann] settings in the annotator configuration file: {e}")
+        raise
+
     # Get handles to resources
     # configparser： https://docs.python.org/3/library/configparser.html
     # configparser error handling: https://stackoverflow.com/questions/24832628/python-configparser-getting-and-setting-without-exceptions
@@ -198,17 +238,25 @@ def main():
     try:
         wait_time = config.getint("sqs", "WaitTime")
         max_messages = config.getint("sqs", "MaxMessages")
+        visibility_timeout = config.getint("sqs", "VisibilityTimeout", fallback=jm.VISIBILITY_TIMEOUT)
+        max_receive_count = config.getint("sqs", "MaxReceiveCount", fallback=jm.MAX_RECEIVE_COUNT)
     except ValueError as e:
         wait_time = None
         max_messages = None
+        visibility_timeout = jm.VISIBILITY_TIMEOUT
+        max_receive_count = jm.MAX_RECEIVE_COUNT
         print(f"ValueError: {e}")
     except NoSectionError as e:
         wait_time = None
         max_messages = None
+        visibility_timeout = jm.VISIBILITY_TIMEOUT
+        max_receive_count = jm.MAX_RECEIVE_COUNT
         print(f"Can't find section 'sqs' from the annotator configuration file: {e}")
     except NoOptionError as e:
         wait_time = None
         max_messages = None
+        visibility_timeout = jm.VISIBILITY_TIMEOUT
+        max_receive_count = jm.MAX_RECEIVE_COUNT
         print(f"Can't find the option from the annotator configuration file: {e}")
 
     s3 = boto3.client("s3")
@@ -234,7 +282,8 @@ def main():
 
     # Poll queue for new results and process them
     while True:
-        handle_requests_queue(sqsQueue=queue, s3=s3, dynamodbTable=table, maxMessages=max_messages, waitTime=wait_time)
+        handle_requests_queue(sqsQueue=queue, s3=s3, dynamodbTable=table, maxMessages=max_messages, waitTime=wait_time,
+                              visibilityTimeout=visibility_timeout, maxReceiveCount=max_receive_count)
 
 
 if __name__ == "__main__":
@@ -11,12 +11,17 @@
 import json
 import os
 import subprocess
+import threading
+from configparser import ConfigParser, ExtendedInterpolation
 
 import boto3
 import requests
 from botocore.exceptions import ClientError
 from flask import Flask, jsonify, request, abort
 
+import driver
+import job_monitor as jm
+
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
@@ -24,6 +29,17 @@ app.url_map.strict_slashes = False
 environment = "annotator_webhook_config.Config"
 app.config.from_object(environment)
 
+# Check the pipeline and engines run.py reads from the annotator
+# configuration file before taking any job
+annotatorConfig = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+annotatorConfig.read("annotator_config.ini")
+try:
+    driver.parsePipeline(driver.pipelineFromConfig(annotatorConfig))
+    driver.enginesFromConfig(annotatorConfig)
+except ValueError as e:
+    print(f"Invalid [ann] settings in the annotator configuration file: {e}")
+    raise
+
 # Connect to SQS and get the message queue
 sqs = boto3.resource('sqs', region_name=app.config["AWS_REGION_NAME"])
 try:
@@ -53,6 +69,83 @@ except ClientError as e:
 if not os.path.exists(app.config["ANNOTATOR_JOBS_DIR"]):
     os.makedirs(app.config["ANNOTATOR_JOBS_DIR"])
 
+"""Jobs launched by this webhook and still running, keyed by job ID
+"""
+runningJobs = {}
+
+
+"""Runs AnnTools on the input file of a job as a background process
+"""
+
+
+def launchJob(localPath, pipeline=None):
+    command = ["python", os.path.join(app.config["ANNOTATOR_BASE_DIR"], "run.py"), localPath]
+    if pipeline is not None:
+        command.append(json.dumps(pipeline))
+    return subprocess.Popen(command)
+
+
+"""Watches a launched job in a background thread: its message (once found)
+is kept hidden while the job runs and deleted once the job completes
+"""
+
+
+def watchJob(jobId, process, message=None):
+    monitor = jm.JobMonitor(
+        jobId, process, message, visibilityTimeout=app.config["AWS_SQS_VISIBILITY_TIMEOUT"]
+    )
+    runningJobs[jobId] = monitor
+
+    def wait():
+        monitor.wait()
+        runningJobs.pop(jobId, None)
+
+    threading.Thread(target=wait, daemon=True).start()
+    return monitor
+
+
+"""Relaunches a job whose request came back to the queue and whose input is
+still in its job folder here, i.e. a job interrupted on this instance; the
+job resumes from its checkpoint. A job still running here takes over the
+redelivered message; a job whose request was delivered more than
+AWS_SQS_MAX_RECEIVE_COUNT times, or carries an invalid pipeline, is marked
+FAILED and its request deleted.
+"""
+
+
+def resumeJob(data, message):
+    jobId = data.get("job_id")
+    userId = data.get("user_id")
+    key = data.get("s3_key_input_file")
+    if not jobId or not userId or not key:
+        return
+    pipeline = data.get("pipeline")
+    if pipeline is not None:
+        try:
+            pipeline = driver.parsePipeline(pipeline)
+        except ValueError as e:
+            jm.failJob(table, jobId, message, f"invalid pipeline in job request: {e}")
+            return
+    if jobId in runningJobs:
+        runningJobs[jobId].setMessage(message)
+        return
+    localPath = os.path.join(app.config["ANNOTATOR_JOBS_DIR"], userId, jobId, key.split("~")[-1])
+    if not os.path.exists(localPath):
+        return
+    # A request delivered more often than that keeps failing
+    maxReceiveCount = app.config["AWS_SQS_MAX_RECEIVE_COUNT"]
+    if jm.getReceiveCount(message) > maxReceiveCount:
+        jm.failJob(table, jobId, message, f"gave up after {maxReceiveCount} attempts")
+        return
+    try:
+        process = launchJob(localPath, pipeline)
+    except Exception as e:
+        print(f"Failed to resume job {jobId}: {e}")
+        return
+    print(f"Resuming job {jobId} in its existing job folder")
+    watchJob(jobId, process, message)
+
+
 @app.route("/", methods=["GET"])
 def annotator_webhook():
 
@@ -147,13 +240,37 @@ def annotate():
                     500,
                 )
 
+            # Stages requested for this job, replacing the configured pipeline
+            pipeline = messageData.get("pipeline")
+            if pipeline is not None:
+                try:
+                    pipeline = driver.parsePipeline(pipeline)
+                except ValueError as e:
+                    jm.failJob(table, jobId, None, f"invalid pipeline in job request: {e}")
+                    return (
+                        jsonify({"code": 400, "message": f"Invalid pipeline: {e}"}),
+                        400,
+                    )
+
+            # A repeated notification of a job still running here is already handled
+            if jobId in runningJobs:
+                return (
+                    jsonify({"code": 201, "message": "Annotation job is already running."}),
+                    201,
+                )
+
             # Downloads the input file from S3 and saves it to the AnnTools instance in /home/ubuntu/gas/ann/job/<user_id>/<job_id> folder
+            # An existing job folder is from an interrupted run of the job, which resumes from its checkpoint
             singleJobFolder = os.path.join(app.config["ANNOTATOR_JOBS_DIR"], userId, jobId)
-            if not os.path.exists(singleJobFolder):
-                os.makedirs(singleJobFolder)
+            if os.path.exists(singleJobFolder):
+                print(f"Resuming job {jobId} in its existing job folder")
+            os.makedirs(singleJobFolder, exist_ok=True)
+
+            filename = key.split("~")[-1]
+            localPath = os.path.join(singleJobFolder, filename)
 
-                filename = key.split("~")[-1]
-                localPath = os.path.join(singleJobFolder, filename)
+            # download_file() writes to a temporary file first, so an existing input is complete
+            if not os.path.exists(localPath):
                 s3 = boto3.client("s3")
                 try:
                     s3.download_file(bucket, key, localPath)
@@ -164,22 +281,67 @@ def annotate():
                         500,
                     )
 
-                if not os.path.exists(localPath):  # if file is not found
-                    print("Cannot find the file in the AnnTools instance")
-                    return (
-                        jsonify({"code": 500, "message": "Cannot find the file in the AnnTools instance"}),
-                        500,
-                    )
+            if not os.path.exists(localPath):  # if file is not found
+                print("Cannot find the file in the AnnTools instance")
+                return (
+                    jsonify({"code": 500, "message": "Cannot find the file in the AnnTools instance"}),
+                    500,
+                )
 
-                # Launch annotation job as a background process
+            # Launch annotation job as a background process
+            try:
+                process = launchJob(localPath, pipeline)
+            except subprocess.CalledProcessError as e:
+                print( f"Subprocess failed, failed to launch annotator job: {e}")
+                return (
+                    jsonify({"code": 500, "message": f"Subprocess failed, failed to launch annotator job: {e}"}),
+                    500,
+                )
+            except Exception as e:
+                print(str(e))
+                return (
+                    jsonify({"code": 500, "message": str(e)}),
+                    500,
+                )
+            monitor = watchJob(jobId, process)
+
+            # Update job_status in DynamoDB to “RUNNING” if its current status is “PENDING”
+            try:
+                table.update_item(
+                    Key={"job_id": jobId},
+                    UpdateExpression="SET job_status = :newStatus",
+                    ConditionExpression="job_status = :oldStatus",
+                    ExpressionAttributeValues={
+                        ":newStatus": "RUNNING",
+                        ":oldStatus": "PENDING"
+                    })
+            except ClientError as e:
+                print(f"Did not to update job status: {e}")
+
+            # Find the message of the job in the queue; it is kept hidden while the job runs and deleted once it completes
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/message/index.html
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/message/delete.html
+            findSqsMessage = False
+            while not findSqsMessage:
+                # find the message from the queue
                 try:
-                    subprocess.Popen(["python", os.path.join(app.config["ANNOTATOR_BASE_DIR"], "run.py"), localPath])
-                except subprocess.CalledProcessError as e:
-                    print( f"Subprocess failed, failed to launch annotator job: {e}")
-                    return (
-                        jsonify({"code": 500, "message": f"Subprocess failed, failed to launch annotator job: {e}"}),
-                        500,
-                    )
+                    sqsMessages = requestsQueue.receive_messages(MaxNumberOfMessages=app.config["AWS_SQS_MAX_MESSAGES"], WaitTimeSeconds=app.config["AWS_SQS_WAIT_TIME"],
+                                                                 AttributeNames=jm.MESSAGE_ATTRIBUTES)
+                except ClientError as e:
+                    if e.response["Error"]["Code"] == "AccessDenied":
+                        print(f"Access denied to the queue:: {e}")
+                        return (
+                            jsonify(
+                                {"code": 500, "message": f"Access denied to the queue:: {e}"}),
+                            500,
+                        )
+                    else:
+                        print(f"ClientError: {e}")
+                        return (
+                            jsonify(
+                                {"code": 500, "message": f"ClientError: {e}"}),
+                            500,
+                        )
                 except Exception as e:
                     print(str(e))
                     return (
@@ -187,93 +349,48 @@ def annotate():
                         500,
                     )
 
-                # Update job_status in DynamoDB to “RUNNING” if its current status is “PENDING”
-                try:
-                    table.update_item(
-                        Key={"job_id": jobId},
-                        UpdateExpression="SET job_status = :newStatus",
-                        ConditionExpression="job_status = :oldStatus",
-                        ExpressionAttributeValues={
-                            ":newStatus": "RUNNING",
-                            ":oldStatus": "PENDING"
-                        })
-                except ClientError as e:
-                    print(f"Did not to update job status: {e}")
-
-                # Delete message from queue, if job was successfully submitted
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/message/index.html
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/message/delete.html
-                findSqsMessage = False
-                while not findSqsMessage:
-                    # find the message from the queue
+                if len(sqsMessages) == 0:
+                    break
+
+                for sqsMessage in sqsMessages:
                     try:
-                        sqsMessages = requestsQueue.receive_messages(MaxNumberOfMessages=app.config["AWS_SQS_MAX_MESSAGES"], WaitTimeSeconds=app.config["AWS_SQS_WAIT_TIME"])
-                    except ClientError as e:
-                        if e.response["Error"]["Code"] == "AccessDenied":
-                            print(f"Access denied to the queue:: {e}")
-                            return (
-                                jsonify(
-                                    {"code": 500, "message": f"Access denied to the queue:: {e}"}),
-                                500,
-                            )
-                        else:
-                            print(f"ClientError: {e}")
-                            return (
-                                jsonify(
-                                    {"code": 500, "message": f"ClientError: {e}"}),
-                                500,
-                            )
+                        sqsMessageBody = json.loads(sqsMessage.body).get("Message")
+                        data = json.loads(sqsMessageBody)
+                        sqsJobId = data.get("job_id")
+                    except json.JSONDecodeError as e:
+                        print(f"Invalid JSON: {e}")
+                        try:
+                            sqsMessage.delete()
+                        except ClientError as e:
+                            print(f"Delete message failed: {e}")
+                        continue
+                    except AttributeError as e:
+                        print(f"AttributeError: {e}")
+                        try:
+                            sqsMessage.delete()
+                        except ClientError as e:
+                            print(f"Delete message failed: {e}")
+                        continue
                     except Exception as e:
                         print(str(e))
-                        return (
-                            jsonify({"code": 500, "message": str(e)}),
-                            500,
-                        )
-
-                    if len(sqsMessages) == 0:
+                        try:
+                            sqsMessage.delete()
+                        except ClientError as e:
+                            print(f"Delete message failed: {e}")
+                        continue
+
+                    if sqsJobId == jobId:
+                        monitor.setMessage(sqsMessage)
+                        findSqsMessage = True
                         break
 
-                    for sqsMessage in sqsMessages:
-                        try:
-                            sqsMessageBody = json.loads(sqsMessage.body).get("Message")
-                            data = json.loads(sqsMessageBody)
-                            sqsJobId = data.get("job_id")
-                        except json.JSONDecodeError as e:
-                            print(f"Invalid JSON: {e}")
-                            try:
-                                sqsMessage.delete()
-                            except ClientError as e:
-                                print(f"Delete message failed: {e}")
-                            continue
-                        except AttributeError as e:
-                            print(f"AttributeError: {e}")
-                            try:
-                                sqsMessage.delete()
-                            except ClientError as e:
-                                print(f"Delete message failed: {e}")
-                            continue
-                        except Exception as e:
-                            print(str(e))
-                            try:
-                                sqsMessage.delete()
-                            except ClientError as e:
-                                print(f"Delete message failed: {e}")
-                            continue
-
-                        if sqsJobId == jobId:
-                            try:
-                                sqsMessage.delete()
-                            except ClientError as e:
-                                print(f"Delete message failed: {e}")
-                            except Exception as e:
-                                print(str(e))
-                            findSqsMessage = True
-                            break
+                    # A redelivered request of another job interrupted on this instance
+                    resumeJob(data, sqsMessage)
 
-                return (
-                    jsonify({"code": 201, "message": "Annotation job request processed."}),
-                    201,
-                )
+            return (
+                jsonify({"code": 201, "message": "Annotation job request processed."}),
+                201,
+            )
 
         return (
             jsonify({"code": 500, "message": "Invalid message type"}),
@@ -45,6 +45,10 @@ class Config(object):
     # AWS SQS queues
     AWS_SQS_WAIT_TIME = 20
     AWS_SQS_MAX_MESSAGES = 10
+    # Seconds a running job keeps its request hidden, extended until it completes
+    AWS_SQS_VISIBILITY_TIMEOUT = 300
+    # Deliveries of a request before its job is marked FAILED
+    AWS_SQS_MAX_RECEIVE_COUNT = 3
     AWS_SQS_REQUESTS_QUEUE_NAME = "xxxxx"
 
     # AWS DynamoDB
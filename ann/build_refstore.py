@@ -0,0 +1,495 @@
+# build_refstore.py
+#
+# Exports the AnnTools reference tables from MySQL into the memory-mapped
+# columnar store read by refstore.py, and builds the dbSNP key index read
+# by snp_index.py
+#
+# Usage: python build_refstore.py [store_dir] [table ... | dbSNP.idx]
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import json
+import os
+import shutil
+import struct
+import sys
+
+import numpy as np
+import pymysql.cursors
+
+import refstore as rs
+import snp_index as si
+import utils as u
+
+"""Tables to export and the columns they are looked up on
+   (table, chromosome column, start column, end column)
+"""
+TFBS_CHROMS = [str(c) for c in range(1, 23)] + ["X", "Y"]
+TABLES = [
+    ("dbSNP", "CHR", "POS", "POS"),
+    ("chrom_pos_equal_base", "CHR", "start", "start"),
+    ("chrom_pos_equal_nobase", "CHR", "start", "start"),
+    ("chrom_pos_unequal", "CHR", "start", "end"),
+    ("refGene", "chrom", "txStart", "txEnd"),
+    ("cpgIslandExt", "chrom", "chromStart", "chromEnd"),
+    ("cytoBand", "chrom", "chromStart", "chromEnd"),
+    ("gadAll", "chromosome", "chromStart", "chromEnd"),
+    ("gwasCatalog", "chrom", "chromEnd", "chromEnd"),
+    ("targetScanS", "chrom", "chromStart", "chromEnd"),
+    ("hugo", "chrom", "chromStart", "chromEnd"),
+    ("dgv_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("abParts_IG_T_CelReceptors", "chrom", "chromStart", "chromEnd"),
+    ("mcCarroll_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("conrad_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("genomicSuperDups", "chrom", "chromStart", "chromEnd"),
+] + [("tfbsConsSites" + c, None, "chromStart", "chromEnd") for c in TFBS_CHROMS]
+
+# Name of the dbSNP key index (snp_index.py) in the table list
+SNP_INDEX = "dbSNP.idx"
+
+# Rows read from the database and rows gathered into the pools at a time
+CHUNK_SIZE = 100000
+
+
+"""Kind of a column, from the first non-NULL value in the first chunk
+   Values that are neither numbers nor blobs (e.g. DECIMAL) are kept as text
+"""
+
+
+def getKind(values):
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return "str"
+        if isinstance(value, int):
+            return "int"
+        if isinstance(value, float):
+            return "float"
+        if isinstance(value, (bytes, bytearray)):
+            return "bytes"
+        return "str"
+    return "str"
+
+
+def encodeValue(value, kind):
+    if value is None:
+        return b""
+    if kind == "bytes":
+        return bytes(value)
+    return str(value).encode("utf-8")
+
+
+def castValue(value, kind):
+    if value is None:
+        return 0
+    if kind == "int":
+        return int(value)
+    return float(value)
+
+
+"""Appends the columns of one chunk of rows to the raw files in tmpDir
+"""
+
+
+class ColumnWriter(object):
+    def __init__(self, tmpDir, columns, chromIndex, startIndex, endIndex):
+        self.tmpDir = tmpDir
+        self.columns = columns
+        self.chromIndex = chromIndex
+        self.startIndex = startIndex
+        self.endIndex = endIndex
+        self.kinds = None
+        self.hasNulls = [False] * len(columns)
+        self.chroms = {}
+        self.rows = 0
+        self.files = {}
+
+    def getFile(self, name):
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.tmpDir, name), "wb")
+        return self.files[name]
+
+    def write(self, rows):
+        if self.kinds is None:
+            self.kinds = [
+                getKind([row[i] for row in rows]) for i in range(len(self.columns))
+            ]
+
+        codes = []
+        for row in rows:
+            chrom = "" if self.chromIndex is None else str(row[self.chromIndex])
+            if chrom not in self.chroms:
+                self.chroms[chrom] = len(self.chroms)
+            codes.append(self.chroms[chrom])
+        np.asarray(codes, dtype=np.int32).tofile(self.getFile("chrom"))
+        np.asarray(
+            [int(row[self.startIndex]) for row in rows], dtype=np.int64
+        ).tofile(self.getFile("start"))
+        np.asarray([int(row[self.endIndex]) for row in rows], dtype=np.int64).tofile(
+            self.getFile("end")
+        )
+
+        for i in range(0, len(self.columns)):
+            kind = self.kinds[i]
+            values = [row[i] for row in rows]
+            nulls = np.asarray([v is None for v in values], dtype=np.bool_)
+            self.hasNulls[i] = self.hasNulls[i] or bool(nulls.any())
+            nulls.tofile(self.getFile(f"c{i}.null"))
+
+            if kind in ("str", "bytes"):
+                data = [encodeValue(v, kind) for v in values]
+                np.asarray([len(d) for d in data], dtype=np.int64).tofile(
+                    self.getFile(f"c{i}.len")
+                )
+                self.getFile(f"c{i}.pool").write(b"".join(data))
+            else:
+                dtype = np.int64 if kind == "int" else np.float64
+                try:
+                    converted = [castValue(v, kind) for v in values]
+                except (TypeError, ValueError):
+                    raise ValueError(
+                        f"Column {self.columns[i]} mixes {kind} and other values"
+                    )
+                np.asarray(converted, dtype=dtype).tofile(self.getFile(f"c{i}"))
+
+        self.rows = self.rows + len(rows)
+
+    def close(self):
+        for fh in self.files.values():
+            fh.close()
+        self.files = {}
+
+
+"""Maps a raw column file written by ColumnWriter
+"""
+
+
+def readRaw(tmpDir, name, dtype):
+    path = os.path.join(tmpDir, name)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+"""Sorts the raw columns by chromosome and start into the store layout
+   The sort is stable, so rows with the same start keep their table order
+"""
+
+
+def writeTable(writer, tableDir, table, chromCol, startCol, endCol):
+    kinds = writer.kinds or ["str"] * len(writer.columns)
+
+    def raw(name, dtype):
+        return readRaw(writer.tmpDir, name, dtype)
+
+    codes = raw("chrom", np.int32)
+    starts = raw("start", np.int64)
+    ends = raw("end", np.int64)
+    order = np.lexsort((starts, codes))
+    sortedCodes = codes[order]
+    sortedStarts = starts[order]
+    sortedEnds = ends[order]
+
+    segments = {}
+    maxEnds = np.empty(len(order), dtype=np.int64)
+    for chrom, code in writer.chroms.items():
+        lo = int(np.searchsorted(sortedCodes, code, side="left"))
+        hi = int(np.searchsorted(sortedCodes, code, side="right"))
+        maxEnds[lo:hi] = np.maximum.accumulate(sortedEnds[lo:hi])
+        segments[chrom] = [lo, hi]
+
+    np.save(os.path.join(tableDir, "start.npy"), sortedStarts)
+    np.save(os.path.join(tableDir, "end.npy"), sortedEnds)
+    np.save(os.path.join(tableDir, "maxend.npy"), maxEnds)
+    np.save(os.path.join(tableDir, "order.npy"), order.astype(np.int64))
+
+    for i in range(0, len(writer.columns)):
+        if writer.hasNulls[i]:
+            np.save(
+                os.path.join(tableDir, f"c{i}.null.npy"),
+                raw(f"c{i}.null", np.bool_)[order],
+            )
+        if kinds[i] in ("str", "bytes"):
+            writePool(
+                raw(f"c{i}.len", np.int64),
+                raw(f"c{i}.pool", np.uint8),
+                order,
+                os.path.join(tableDir, f"c{i}"),
+            )
+        else:
+            dtype = np.int64 if kinds[i] == "int" else np.float64
+            np.save(os.path.join(tableDir, f"c{i}.npy"), raw(f"c{i}", dtype)[order])
+
+    meta = {
+        "table": table,
+        "columns": writer.columns,
+        "kinds": kinds,
+        "chromCol": chromCol,
+        "startCol": startCol,
+        "endCol": endCol,
+        "rows": int(len(order)),
+        "chroms": {} if chromCol is None else segments,
+    }
+    fh = open(os.path.join(tableDir, "meta.json"), "w")
+    json.dump(meta, fh)
+    fh.close()
+
+
+"""Writes a string pool in sorted row order
+"""
+
+
+def writePool(lengths, pool, order, prefix):
+    offsets = getSortedOffsets(lengths, order)
+    np.save(prefix + ".offsets.npy", offsets)
+
+    out = np.lib.format.open_memmap(
+        prefix + ".pool.npy", mode="w+", dtype=np.uint8, shape=(int(offsets[-1]),)
+    )
+    gatherPool(lengths, pool, order, offsets, out)
+    out.flush()
+    del out
+
+
+"""Offsets of the values of a pool once its rows are sorted by order
+"""
+
+
+def getSortedOffsets(lengths, order):
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths[order], out=offsets[1:])
+    return offsets
+
+
+"""Copies the values of a pool into out in sorted row order,
+   CHUNK_SIZE rows at a time
+"""
+
+
+def gatherPool(lengths, pool, order, offsets, out):
+    sourceOffsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=sourceOffsets[1:])
+    sortedLengths = lengths[order]
+    for lo in range(0, len(order), CHUNK_SIZE):
+        rows = order[lo : lo + CHUNK_SIZE]
+        counts = sortedLengths[lo : lo + CHUNK_SIZE]
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        # Byte positions of the chunk's values in the source pool
+        within = np.arange(total, dtype=np.int64) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        source = np.repeat(sourceOffsets[rows], counts) + within
+        out[offsets[lo] : offsets[lo] + total] = pool[source]
+
+
+"""Exports one table, streaming it from the database
+"""
+
+
+def exportTable(conn, storeDir, table, chromCol, startCol, endCol):
+    tableDir = rs.getTableDir(table, storeDir)
+    tmpDir = tableDir + ".tmp"
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute("select * from " + table + ";")
+    columns = [str(d[0]) for d in cursor.description]
+    lowered = [c.lower() for c in columns]
+    writer = ColumnWriter(
+        tmpDir,
+        columns,
+        None if chromCol is None else lowered.index(chromCol.lower()),
+        lowered.index(startCol.lower()),
+        lowered.index(endCol.lower()),
+    )
+
+    rows = cursor.fetchmany(CHUNK_SIZE)
+    while len(rows) > 0:
+        writer.write(rows)
+        rows = cursor.fetchmany(CHUNK_SIZE)
+    cursor.close()
+    writer.close()
+
+    # Build next to the live copy and swap it in once complete
+    buildDir = tableDir + ".new"
+    shutil.rmtree(buildDir, ignore_errors=True)
+    os.makedirs(buildDir)
+    writeTable(writer, buildDir, table, chromCol, startCol, endCol)
+    shutil.rmtree(tmpDir)
+    shutil.rmtree(tableDir, ignore_errors=True)
+    os.rename(buildDir, tableDir)
+    return writer.rows
+
+
+"""Builds the dbSNP key index read by snp_index.py
+   rsID and GMAF are taken by position (3 and 7), like annotateDbSnpFields
+"""
+
+
+def buildSnpIndex(conn, path):
+    tmpDir = path + ".tmp"
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute("select * from dbSNP;")
+    columns = [str(d[0]) for d in cursor.description]
+    lowered = [c.lower() for c in columns]
+    fieldColumns = {
+        "chrom": lowered.index("chr"),
+        "pos": lowered.index("pos"),
+        "ref": lowered.index("ref"),
+        "id": 3,
+        "gmaf": 7,
+        "varclass": lowered.index("info"),
+    }
+
+    # chrom, pos, ref, id, gmaf, varclass code
+    writer = ColumnWriter(
+        tmpDir, ["CHR", "POS", "REF", "ID", "GMAF", "VARCLASS"], 0, 1, 1
+    )
+    varclasses = {}
+    rows = cursor.fetchmany(CHUNK_SIZE)
+    while len(rows) > 0:
+        records = []
+        for row in rows:
+            varclass = str(row[fieldColumns["varclass"]])
+            if varclass not in varclasses:
+                varclasses[varclass] = len(varclasses)
+            records.append(
+                (
+                    str(row[fieldColumns["chrom"]]),
+                    int(row[fieldColumns["pos"]]),
+                    str(row[fieldColumns["ref"]]),
+                    str(row[fieldColumns["id"]]),
+                    str(row[fieldColumns["gmaf"]]),
+                    varclasses[varclass],
+                )
+            )
+        writer.write(records)
+        rows = cursor.fetchmany(CHUNK_SIZE)
+    cursor.close()
+    writer.close()
+
+    codes = readRaw(tmpDir, "chrom", np.int32)
+    positions = readRaw(tmpDir, "start", np.int64)
+    order = np.lexsort((positions, codes))
+    sortedCodes = codes[order]
+    chroms = {}
+    for chrom, code in writer.chroms.items():
+        chroms[chrom] = [
+            int(np.searchsorted(sortedCodes, code, side="left")),
+            int(np.searchsorted(sortedCodes, code, side="right")),
+        ]
+
+    # Pools of the text fields, columns 2 to 4 of the writer
+    pools = {}
+    for name, i in [("ref", 2), ("id", 3), ("gmaf", 4)]:
+        lengths = readRaw(tmpDir, f"c{i}.len", np.int64)
+        pools[name] = (
+            lengths,
+            readRaw(tmpDir, f"c{i}.pool", np.uint8),
+            getSortedOffsets(lengths, order),
+        )
+
+    counts = {"records": len(order)}
+    for name in pools:
+        counts[name + ".offsets"] = len(order) + 1
+        counts[name + ".pool"] = int(pools[name][2][-1])
+    sections = {}
+    offset = 0
+    for name, dtype in si.SECTIONS:
+        sections[name] = [offset, counts[name]]
+        offset = offset + counts[name] * dtype.itemsize
+        offset = offset + (-offset % 8)
+
+    header = json.dumps(
+        {
+            "chroms": chroms,
+            "varclasses": sorted(varclasses, key=lambda v: varclasses[v]),
+            "columns": columns,
+            "fieldColumns": fieldColumns,
+            "sections": sections,
+        }
+    ).encode("utf-8")
+    dataStart = si.getDataStart(len(header))
+
+    buildFile = path + ".new"
+    fh = open(buildFile, "wb")
+    fh.write(si.MAGIC)
+    fh.write(struct.pack("<Q", len(header)))
+    fh.write(header)
+    fh.truncate(dataStart + offset)
+    fh.close()
+
+    def section(name, dtype):
+        return np.memmap(
+            buildFile,
+            dtype=dtype,
+            mode="r+",
+            offset=dataStart + sections[name][0],
+            shape=(sections[name][1],),
+        )
+
+    records = section("records", si.RECORD)
+    records["pos"] = positions[order]
+    records["varclass"] = readRaw(tmpDir, "c5", np.int64)[order]
+    records.flush()
+    for name in pools:
+        lengths, pool, offsets = pools[name]
+        out = section(name + ".offsets", np.int64)
+        out[:] = offsets
+        out.flush()
+        if sections[name + ".pool"][1] > 0:
+            out = section(name + ".pool", np.uint8)
+            gatherPool(lengths, pool, order, offsets, out)
+            out.flush()
+        del out
+    del records
+
+    shutil.rmtree(tmpDir)
+    os.replace(buildFile, path)
+    return len(order)
+
+
+def build(storeDir=None, tables=None):
+    if storeDir is None:
+        storeDir = rs.STORE_DIR
+    if not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+
+    specs = TABLES
+    snpIndex = True
+    if tables:
+        specs = [s for s in TABLES if s[0] in tables]
+        snpIndex = SNP_INDEX in tables
+        unknown = set(tables) - set([s[0] for s in specs]) - set([SNP_INDEX])
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown reference tables: {', '.join(sorted(unknown))}")
+
+    conn = u.db_connect()
+    try:
+        for table, chromCol, startCol, endCol in specs:
+            rows = exportTable(conn, storeDir, table, chromCol, startCol, endCol)
+            print(f"{table}: {str(rows)} rows")
+        if snpIndex:
+            rows = buildSnpIndex(conn, os.path.join(storeDir, SNP_INDEX))
+            print(f"{SNP_INDEX}: {str(rows)} records")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    storeDir = None
+    if len(sys.argv) > 1:
+        storeDir = sys.argv[1]
+    build(storeDir, sys.argv[2:])
+
+### EOF
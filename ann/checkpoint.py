@@ -0,0 +1,385 @@
+# checkpoint.py
+#
+# Checkpoint manifests of resumable annotation jobs
+#
+# A manifest is a small JSON file in the job folder. A streaming (fused)
+# run records how far it has read the input and written the output, with
+# the CRC-32 of both prefixes and the counts of every stage; a
+# stage-by-stage run records the stages whose intermediate files are
+# complete. A job restarted on the same input picks up from the last
+# checkpoint whose files still match their checksums, and starts over
+# otherwise.
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import json
+import os
+import time
+import zlib
+
+import file_utils as fu
+
+"""Seconds between two checkpoints of a streaming run
+"""
+CHECKPOINT_SECONDS = 60
+
+# Bytes read at a time when checksumming a file
+CHUNK_SIZE = 1024 * 1024
+
+
+"""CRC-32 of the byte range [start, end) of a file (end=None: end of file)
+"""
+
+
+def getChecksum(filename, start=0, end=None):
+    crc = 0
+    fh = open(filename, "rb")
+    fh.seek(start)
+    offset = start
+    while end is None or offset < end:
+        size = CHUNK_SIZE
+        if end is not None:
+            size = min(size, end - offset)
+        data = fh.read(size)
+        if len(data) == 0:
+            break
+        crc = zlib.crc32(data, crc)
+        offset = offset + len(data)
+    fh.close()
+    return crc
+
+
+"""Manifest as saved, None if there is none or it cannot be read
+"""
+
+
+def loadManifest(path):
+    if not fu.isExist(path):
+        return None
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except ValueError:
+        return None
+
+
+"""Writes the manifest to a temporary file and renames it over the old one,
+   so a crash leaves either the previous or the new manifest, never a
+   partial one
+"""
+
+
+def saveManifest(path, manifest):
+    tmpfile = path + ".tmp"
+    with open(tmpfile, "w") as fh:
+        json.dump(manifest, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmpfile, path)
+
+
+def deleteManifest(path):
+    fu.delete(path)
+    fu.delete(path + ".tmp")
+
+
+"""Settings as they read back from the manifest (tuples become lists)
+"""
+
+
+def normalize(settings):
+    return json.loads(json.dumps(settings))
+
+
+"""Output file (binary) that keeps the size and CRC-32 of what it holds
+"""
+
+
+class ChecksumWriter(object):
+    def __init__(self, fh, offset=0, crc=0):
+        self.fh = fh
+        self.offset = offset
+        self.crc = crc
+
+    def write(self, data):
+        self.fh.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.offset = self.offset + len(data)
+
+    """Makes everything written so far durable
+    """
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+"""Checkpoint of the streaming annotation of the byte range [start, end)
+of infile into outfile
+
+On creation the manifest at path is checked against the files: settings,
+input size and the checksums of the input and output prefixes must all
+match, otherwise the run starts from the beginning. readLines() and
+openOutput() then continue where the manifest left off, restoreCounts()
+brings back the counts of the annotated part, and update() saves a new
+checkpoint, at most every `interval` seconds, once a window is written.
+"""
+
+
+class StreamCheckpoint(object):
+    def __init__(
+        self,
+        path,
+        infile,
+        outfile,
+        settings,
+        start=0,
+        end=None,
+        interval=CHECKPOINT_SECONDS,
+    ):
+        self.path = path
+        self.infile = infile
+        self.outfile = outfile
+        self.settings = normalize(settings)
+        self.start = start
+        self.end = end
+        self.interval = interval
+        self.inputOffset = start
+        self.inputCrc = 0
+        self.outputOffset = 0
+        self.outputCrc = 0
+        self.counts = None
+        self.complete = False
+        self.output = None
+        self.saved = time.time()
+
+        manifest = loadManifest(path)
+        if manifest is not None and self.matches(manifest):
+            self.inputOffset = manifest["inputOffset"]
+            self.inputCrc = manifest["inputChecksum"]
+            self.outputOffset = manifest["outputOffset"]
+            self.outputCrc = manifest["outputChecksum"]
+            self.counts = manifest["counts"]
+            self.complete = manifest["complete"]
+        else:
+            deleteManifest(path)
+
+    def isResumed(self):
+        return self.counts is not None
+
+    def matches(self, manifest):
+        try:
+            return (
+                manifest["settings"] == self.settings
+                and manifest["input"] == self.infile
+                and manifest["start"] == self.start
+                and manifest["end"] == self.end
+                and manifest["inputSize"] == fu.fileSize(self.infile)
+                and fu.isExist(self.outfile)
+                and fu.fileSize(self.outfile) >= manifest["outputOffset"]
+                and not (
+                    manifest["complete"]
+                    and fu.fileSize(self.outfile) != manifest["outputOffset"]
+                )
+                and getChecksum(self.infile, self.start, manifest["inputOffset"])
+                == manifest["inputChecksum"]
+                and getChecksum(self.outfile, 0, manifest["outputOffset"])
+                == manifest["outputChecksum"]
+            )
+        except (KeyError, TypeError):
+            return False
+
+    """Lines (bytes) of the input range not annotated yet
+    """
+
+    def readLines(self, buffering=-1):
+        lines = fu.readLines(
+            self.infile, self.inputOffset, self.end, decode=False, buffering=buffering
+        )
+        for line in lines:
+            self.inputOffset = self.inputOffset + len(line)
+            self.inputCrc = zlib.crc32(line, self.inputCrc)
+            yield line
+
+    """Output file, cut back to the checkpointed offset
+    """
+
+    def openOutput(self, buffering=-1):
+        if self.isResumed():
+            fh = open(self.outfile, "r+b", buffering=buffering)
+            fh.truncate(self.outputOffset)
+            fh.seek(self.outputOffset)
+        else:
+            fh = open(self.outfile, "wb", buffering=buffering)
+        self.output = ChecksumWriter(fh, self.outputOffset, self.outputCrc)
+        return self.output
+
+    def restoreCounts(self, stages):
+        if self.counts is None:
+            return
+        for stage, counts in zip(stages, self.counts):
+            stage.counts = dict(counts)
+
+    """Saves a checkpoint if the last one is older than the interval
+       Everything read so far must have been written to the output
+    """
+
+    def update(self, stages):
+        if time.time() - self.saved >= self.interval:
+            self.save(stages)
+
+    """Saves the final checkpoint once the whole range is written
+    """
+
+    def finish(self, stages):
+        self.complete = True
+        self.save(stages)
+
+    """Marks an output assembled elsewhere (e.g. from shards) as complete
+    """
+
+    def markComplete(self, stages):
+        self.inputOffset = self.end
+        if self.inputOffset is None:
+            self.inputOffset = fu.fileSize(self.infile)
+        self.inputCrc = getChecksum(self.infile, self.start, self.inputOffset)
+        self.outputOffset = fu.fileSize(self.outfile)
+        self.outputCrc = getChecksum(self.outfile)
+        self.complete = True
+        self.save(stages, sync=False)
+
+    def save(self, stages, sync=True):
+        if sync and self.output is not None:
+            self.output.sync()
+            self.outputOffset = self.output.offset
+            self.outputCrc = self.output.crc
+        self.counts = [stage.counts for stage in stages]
+        saveManifest(
+            self.path,
+            {
+                "settings": self.settings,
+                "input": self.infile,
+                "start": self.start,
+                "end": self.end,
+                "inputSize": fu.fileSize(self.infile),
+                "inputOffset": self.inputOffset,
+                "inputChecksum": self.inputCrc,
+                "outputOffset": self.outputOffset,
+                "outputChecksum": self.outputCrc,
+                "counts": self.counts,
+                "complete": self.complete,
+            },
+        )
+        self.saved = time.time()
+
+    def delete(self):
+        deleteManifest(self.path)
+
+
+"""Checkpoint of a stage-by-stage run: the stages whose output files are
+complete, in the order they ran, with the checksum of each output and the
+size of the count log after the stage
+
+Only the leading stages whose outputs still match their checksums count
+as done; a stage that is run again first cuts the count log back to what
+the stages before it wrote. Once the final output is recorded (finish())
+and still matches its checksum, the whole job is complete.
+"""
+
+
+class StageCheckpoint(object):
+    def __init__(self, path, infile, logcountfile, settings):
+        self.path = path
+        self.logcountfile = logcountfile
+        self.settings = normalize(settings)
+        self.inputSize = fu.fileSize(infile)
+        self.inputCrc = getChecksum(infile)
+        self.done = []
+        self.final = None
+        self.complete = False
+
+        manifest = loadManifest(path)
+        if (
+            manifest is not None
+            and manifest.get("settings") == self.settings
+            and manifest.get("inputSize") == self.inputSize
+            and manifest.get("inputChecksum") == self.inputCrc
+        ):
+            final = manifest.get("final")
+            if (
+                final is not None
+                and fu.isExist(final["output"])
+                and getChecksum(final["output"]) == final["checksum"]
+            ):
+                self.final = final
+                self.complete = True
+            for stage in manifest.get("stages", []):
+                if not fu.isExist(stage["output"]):
+                    break
+                if getChecksum(stage["output"]) != stage["checksum"]:
+                    break
+                self.done.append(stage)
+        else:
+            deleteManifest(path)
+
+    def isDone(self, name, outfile):
+        for stage in self.done:
+            if stage["name"] == name and stage["output"] == outfile:
+                return True
+        return False
+
+    """Cuts the count log back to its size after the last completed stage
+    """
+
+    def rewindLog(self):
+        if len(self.done) == 0 or not fu.isExist(self.logcountfile):
+            return
+        fh = open(self.logcountfile, "r+b")
+        fh.truncate(self.done[-1]["logSize"])
+        fh.close()
+
+    def stageDone(self, name, outfile):
+        with open(outfile, "rb") as fh:
+            os.fsync(fh.fileno())
+        self.done.append(
+            {
+                "name": name,
+                "output": outfile,
+                "checksum": getChecksum(outfile),
+                "logSize": fu.fileSize(self.logcountfile),
+            }
+        )
+        self.save()
+
+    """Records outfile as the final output, holding what the last stage
+       wrote; call it before the last stage output is renamed to outfile
+    """
+
+    def finish(self, outfile):
+        self.final = {"output": outfile, "checksum": self.done[-1]["checksum"]}
+        self.complete = True
+        self.save()
+
+    def save(self):
+        saveManifest(
+            self.path,
+            {
+                "settings": self.settings,
+                "inputSize": self.inputSize,
+                "inputChecksum": self.inputCrc,
+                "stages": self.done,
+                "final": self.final,
+            },
+        )
+
+    def delete(self):
+        deleteManifest(self.path)
+
+
+### EOF
@@ -0,0 +1,94 @@
+# compare_engines.py
+#
+# Checks that lookup engines annotate exactly like the "sql" engine
+#
+# Annotates a VCF with the "sql" engine and with each engine given, on the
+# reference database, and reports the lines whose annotation differs. Every
+# engine has to annotate identically on the production tables, including
+# the order of multiple matches, which the "index" engine (the default for
+# region lookups) takes from the table row numbers.
+#
+# Usage: python compare_engines.py <file.vcf> [engine ...]
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import os
+import shutil
+import sys
+import tempfile
+
+import driver
+
+"""driver.run arguments of every engine checked against "sql"
+"""
+ENGINES = dict(
+    [(name, args) for name, args in driver.LOOKUP_ENGINES.items() if name != "sql"]
+)
+
+# Differing lines printed per engine
+MAX_REPORTED = 10
+
+
+"""Annotated lines of the VCF with one set of driver.run arguments
+"""
+
+
+def annotate(vcf, folder, name, kwargs):
+    infile = os.path.join(folder, name + ".vcf")
+    shutil.copy(vcf, infile)
+    driver.run(infile, "vcf", processes=1, **kwargs)
+    outfile = os.path.join(folder, name + ".annot.vcf")
+    with open(outfile, "rb") as fh:
+        return fh.read().split(b"\n")
+
+
+"""Lines (number, expected, found) that differ from the "sql" annotation
+"""
+
+
+def compareLines(expected, found):
+    differing = []
+    for i in range(0, max(len(expected), len(found))):
+        left = expected[i] if i < len(expected) else b""
+        right = found[i] if i < len(found) else b""
+        if left != right:
+            differing.append((i + 1, left, right))
+    return differing
+
+
+def compare(vcf, engines):
+    folder = tempfile.mkdtemp()
+    failed = []
+    try:
+        expected = annotate(vcf, folder, "sql", {"region_engine": "sql"})
+        for engine in engines:
+            differing = compareLines(
+                expected, annotate(vcf, folder, engine, ENGINES[engine])
+            )
+            print(f"{engine}: {str(len(differing))} lines differ from sql")
+            for n, left, right in differing[:MAX_REPORTED]:
+                print(f"  line {str(n)}")
+                print(f"    sql:    {left.decode('utf-8', 'replace')}")
+                print(f"    {engine}: {right.decode('utf-8', 'replace')}")
+            if len(differing) > 0:
+                failed.append(engine)
+    finally:
+        shutil.rmtree(folder)
+    return failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python compare_engines.py <file.vcf> [engine ...]")
+        sys.exit(2)
+    engines = sys.argv[2:] or ["index", "prefetch", "join"]
+    for engine in engines:
+        if engine not in ENGINES:
+            print(f"Unknown engine '{engine}', expected one of: {', '.join(ENGINES)}")
+            sys.exit(2)
+    sys.exit(1 if compare(sys.argv[1], engines) else 0)
+
+### EOF
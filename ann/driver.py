@@ -11,168 +11,666 @@
 
 import sys
 import os
+import multiprocessing
+import shutil
 import file_utils as fu
+import add_promoter_windows as apw
 import annotate as ann
+import checkpoint as ck
+import memory as mem
+import result_cache as rc
 
 
-def run(infile, format):
+"""CNV tables, resolved together by one stage
+"""
+CNV_TABLES = ["dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv"]
+
+
+"""Stages a pipeline can run, by name, in their default order: stage class,
+   the run() lookup engine it uses and its parameters with their defaults
+   Genes counts variants by the positionType BigRefGene adds to INFO
+"""
+PIPELINE_STAGES = [
+    ("dbSNP", ann.DbSnpStage, "dbsnp", {}),
+    ("BigRefGene", ann.BigRefGeneStage, "variant", {}),
+    (
+        "Genes",
+        ann.GenesStage,
+        "gene",
+        {"table": "refGene", "promoter_offset": 500},
+    ),
+    ("Cytoband", ann.CytobandStage, "region", {"table": "cytoBand"}),
+    ("gadAll", ann.GadAllStage, "region", {"table": "gadAll"}),
+    ("gwasCatalog", ann.GwasCatalogStage, "region", {"table": "gwasCatalog"}),
+    ("miRNA", ann.MiRNAStage, "region", {"table": "targetScanS"}),
+    ("HUGO", ann.HugoStage, "region", {"table": "hugo"}),
+    ("CNV", ann.CnvStage, "region", {"tables": CNV_TABLES}),
+    (
+        "genomicSuperDups",
+        ann.GenomicSuperDupsStage,
+        "region",
+        {"table": "genomicSuperDups"},
+    ),
+    ("tfbsConsSites", ann.TfbsConsSitesStage, "variant", {"table": "tfbsConsSites"}),
+]
+
+STAGE_NAMES = [name for name, stageClass, engine, params in PIPELINE_STAGES]
+
+
+"""Validates a pipeline specification and fills in the default parameters
+
+The specification lists the stages to run, in order, as names or as
+{"stage": name, <parameter>: value, ...} dicts (None: every stage with its
+defaults). Returns a list of such dicts with every parameter set; raises
+ValueError on unknown stages or parameters, repeated stages and values of
+the wrong type.
+"""
+
+
+def parsePipeline(spec=None):
+    if spec is None:
+        spec = STAGE_NAMES
+    if not isinstance(spec, list) or len(spec) == 0:
+        raise ValueError("The pipeline must be a non-empty list of stages")
+
+    stageParams = dict([(name, params) for name, c, e, params in PIPELINE_STAGES])
+    pipeline = []
+    for entry in spec:
+        if isinstance(entry, str):
+            entry = {"stage": entry}
+        if not isinstance(entry, dict) or "stage" not in entry:
+            raise ValueError(f"Invalid pipeline entry: {entry}")
+
+        name = entry["stage"]
+        if name not in stageParams:
+            raise ValueError(
+                f"Unknown stage '{name}', expected one of: {', '.join(STAGE_NAMES)}"
+            )
+        if name in [stage["stage"] for stage in pipeline]:
+            raise ValueError(f"Stage '{name}' is listed more than once")
+
+        stage = {"stage": name}
+        stage.update(stageParams[name])
+        for key in entry:
+            if key == "stage":
+                continue
+            if key not in stageParams[name]:
+                raise ValueError(f"Stage '{name}' has no parameter '{key}'")
+            stage[key] = parseParam(name, key, entry[key], stageParams[name][key])
+        pipeline.append(stage)
+    return pipeline
+
+
+"""Value of a stage parameter, converted to the type of its default
+   Lists may also be given as comma-separated strings (as in the config)
+"""
+
+
+def parseParam(name, key, value, default):
+    if isinstance(default, list):
+        if isinstance(value, str):
+            value = [item.strip() for item in value.split(",") if item.strip()]
+        if not isinstance(value, list) or len(value) == 0:
+            raise ValueError(f"Stage '{name}': '{key}' must be a non-empty list")
+        return [str(item) for item in value]
+
+    if isinstance(default, int):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Stage '{name}': '{key}' must be an integer")
+
+    if not isinstance(value, str) or len(value.strip()) == 0:
+        raise ValueError(f"Stage '{name}': '{key}' must be a table name")
+    return value.strip()
+
+
+"""Pipeline specification of the [ann] config section: the stage names in
+   Stages (comma separated, every stage if unset) and their parameters in
+   [ann.<stage>] sections
+"""
+
+
+def pipelineFromConfig(config, section="ann"):
+    names = config.get(section, "Stages", fallback="")
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    if len(names) == 0:
+        names = STAGE_NAMES
+
+    spec = []
+    stageParams = dict([(name, params) for name, c, e, params in PIPELINE_STAGES])
+    for name in names:
+        entry = {"stage": name}
+        for key in stageParams.get(name, {}):
+            value = config.get(section + "." + name, key, fallback=None)
+            if value is not None:
+                entry[key] = value
+        spec.append(entry)
+    return spec
+
+
+"""Lookup engines a job can be configured with (LookupEngine in [ann]) and
+   the driver.run arguments that select them: "sql" and "index" are region
+   engines, the others also take over the gene lookups
+"""
+LOOKUP_ENGINES = {
+    "sql": {"region_engine": "sql"},
+    "index": {"region_engine": "index"},
+    "sweep": {"sweep": True},
+    "prefetch": {"prefetch": True},
+    "join": {"join": True},
+    "columnar": {"columnar": True},
+}
+
+
+def lookupEngineArgs(engine):
+    engine = engine.strip().lower()
+    if engine not in LOOKUP_ENGINES:
+        raise ValueError(
+            f"Unknown lookup engine '{engine}', expected one of: "
+            + ", ".join(LOOKUP_ENGINES)
+        )
+    return dict(LOOKUP_ENGINES[engine])
+
+
+"""driver.run arguments of the lookup engines in the [ann] config section:
+   LookupEngine (lookupEngineArgs()) and DbSnpIndex
+"""
+
+
+def enginesFromConfig(config, section="ann"):
+    kwargs = lookupEngineArgs(config.get(section, "LookupEngine", fallback="index"))
+    kwargs["dbsnp_index"] = config.getboolean(section, "DbSnpIndex", fallback=False)
+    return kwargs
+
+
+"""Annotation stages of a pipeline (parsePipeline()), in the order they are
+   applied; the default pipeline runs every stage
+   With a cache_file the stages share the persistent result cache
+   With promoter_windows the Genes stage reads the promoter-window table
+   built by add_promoter_windows.py, if one is built for its table and offset
+   With streaming the stages read large results through server-side cursors,
+   region lookups use the prefetch engine instead of the index engine and
+   the Genes stage keeps at most ann.TRANSCRIPT_CACHE_SIZE transcripts
+"""
+
+
+def getStages(
+    format="vcf",
+    dbsnp_batch_size=5000,
+    region_engine="index",
+    gene_engine="sql",
+    variant_engine="sql",
+    dbsnp_engine=None,
+    cache_file=None,
+    reference_version="1",
+    cache_entries=1000000,
+    promoter_windows=False,
+    pipeline=None,
+    streaming=False,
+):
+    if dbsnp_engine is None:
+        dbsnp_engine = variant_engine
+    # The index engine keeps whole tables in memory for the process lifetime
+    if streaming and region_engine == "index":
+        region_engine = "prefetch"
+    if pipeline is None:
+        pipeline = parsePipeline()
+    engines = {
+        "dbsnp": dbsnp_engine,
+        "variant": variant_engine,
+        "gene": gene_engine,
+        "region": region_engine,
+    }
+    stageTypes = dict([(name, (c, e)) for name, c, e, params in PIPELINE_STAGES])
+
+    stages = []
+    for spec in pipeline:
+        stageClass, engine = stageTypes[spec["stage"]]
+        kwargs = dict([(key, spec[key]) for key in spec if key != "stage"])
+        if stageClass is ann.DbSnpStage:
+            kwargs["batch_size"] = dbsnp_batch_size
+        if stageClass is ann.GenesStage:
+            kwargs["promoter_windows"] = (
+                promoter_windows
+                and kwargs["table"] == apw.GENE_TABLE
+                and kwargs["promoter_offset"] in apw.PROMOTER_OFFSETS
+            )
+        stages.append(stageClass(format=format, engine=engines[engine], **kwargs))
+    for stage in stages:
+        stage.streaming = streaming
+
+    if cache_file:
+        cache = rc.getResultCache(
+            cache_file, reference_version, maxEntries=cache_entries
+        )
+        for stage in stages:
+            stage.cache = cache
+    return stages
+
+
+"""Annotates the input in a single pass and writes <name>.annot.vcf
+   With fused=False every stage writes its own intermediate file instead
+   With sweep=True region and gene lookups are merged with the sorted input
+   (unsorted input falls back to per-variant queries)
+   With prefetch=True they read the rows overlapping clusters of the
+   window's variants with one range query per cluster
+   With join=True the window's positions are loaded into a temporary table
+   and joined with each region table and refGene by the database
+   With columnar=True every lookup is answered from the memory-mapped
+   reference store written by build_refstore.py, without database access
+   With dbsnp_index=True dbSNP is searched in the dbSNP key index instead
+   Inputs of at least two shards of min_shard_bytes are split by byte range
+   and annotated by up to `processes` worker processes (default: CPU count)
+   With concurrent_stages=True the lookups of all stages for a window run
+   in parallel threads, each on its own database connection, so a job
+   holds up to processes x stages connections at once
+   With a cache_file lookup results are kept across jobs, keyed by
+   reference_version, and the cache hits and misses go to the count log
+   With promoter_windows=True gene lookups use the promoter-window table
+   (add_promoter_windows.py) instead of padding refGene in the query; the
+   columnar store does not export it, so columnar=True ignores it
+   pipeline selects the stages, their order and parameters (parsePipeline())
+   With streaming=True a fused job keeps its memory use down: region lookups
+   use the prefetch engine instead of loading whole tables (index), large
+   results are read through server-side cursors, files use fixed-size
+   buffers, the transcript cache is capped, windows shrink and caches are
+   cleared while the job is over memory_budget bytes (split evenly between
+   shards, a target rather than a hard limit) and the peak RSS goes to the
+   count log
+   With a checkpoint (manifest path, in the job folder) a restarted job
+   resumes from its last checkpoint, saved every checkpoint_seconds; a job
+   already complete only rewrites its count log
+"""
+
+
+def run(
+    infile,
+    format,
+    dbsnp_batch_size=5000,
+    region_engine="index",
+    fused=True,
+    window_size=5000,
+    sweep=False,
+    prefetch=False,
+    join=False,
+    processes=None,
+    min_shard_bytes=32 * 1024 * 1024,
+    concurrent_stages=False,
+    columnar=False,
+    dbsnp_index=False,
+    cache_file=None,
+    reference_version="1",
+    cache_entries=1000000,
+    promoter_windows=False,
+    checkpoint=None,
+    checkpoint_seconds=ck.CHECKPOINT_SECONDS,
+    pipeline=None,
+    streaming=False,
+    memory_budget=None,
+):
+    pipeline = parsePipeline(pipeline)
+    if not fused:
+        runStageByStage(
+            infile,
+            format,
+            dbsnp_batch_size=dbsnp_batch_size,
+            region_engine=region_engine,
+            checkpoint=checkpoint,
+            pipeline=pipeline,
+        )
+        return
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+    gene_engine = "sql"
+    variant_engine = "sql"
+    if sweep:
+        region_engine = "sweep"
+        gene_engine = "sweep"
+    if prefetch:
+        region_engine = "prefetch"
+        gene_engine = "prefetch"
+    if join:
+        region_engine = "join"
+        gene_engine = "join"
+    if columnar:
+        region_engine = "columnar"
+        gene_engine = "columnar"
+        variant_engine = "columnar"
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    stageArgs = {
+        "format": format,
+        "dbsnp_batch_size": dbsnp_batch_size,
+        "region_engine": region_engine,
+        "gene_engine": gene_engine,
+        "variant_engine": variant_engine,
+        "dbsnp_engine": "snpindex" if dbsnp_index else variant_engine,
+        "cache_file": cache_file,
+        "reference_version": reference_version,
+        "cache_entries": cache_entries,
+        "promoter_windows": promoter_windows and not columnar,
+        "pipeline": pipeline,
+        "streaming": streaming,
+    }
+    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+    logcountfile = infile + ".count.log"
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    shards = min(processes, fu.fileSize(infile) // min_shard_bytes)
+
+    jobCheckpoint = None
+    if checkpoint:
+        jobCheckpoint = ck.StreamCheckpoint(
+            checkpoint,
+            infile,
+            finalout,
+            {"stageArgs": stageArgs, "shards": shards},
+            interval=checkpoint_seconds,
+        )
+        if jobCheckpoint.isResumed():
+            print("Resuming from checkpoint")
+
+    buffering = -1
+    if streaming:
+        buffering = mem.IO_BUFFER_SIZE
+    else:
+        memory_budget = None
+
+    if jobCheckpoint is not None and jobCheckpoint.complete:
+        stages = getStages(**stageArgs)
+        jobCheckpoint.restoreCounts(stages)
+        ann.writeCountLog(stages, logcountfile)
+    elif shards > 1:
+        stages = runSharded(
+            infile,
+            finalout,
+            logcountfile,
+            stageArgs,
+            shards,
+            window_size=window_size,
+            concurrent=concurrent_stages,
+            checkpoint=jobCheckpoint,
+            buffering=buffering,
+            memory_budget=memory_budget,
+        )
+    else:
+        stages = getStages(**stageArgs)
+        budget = None
+        if memory_budget:
+            budget = mem.MemoryBudget(
+                memory_budget, window_size, release=[ann.clearTranscriptCache]
+            )
+        ann.runPipeline(
+            stages,
+            infile=infile,
+            outfile=finalout,
+            logcountfile=logcountfile,
+            window_size=window_size,
+            concurrent=concurrent_stages,
+            checkpoint=jobCheckpoint,
+            buffering=buffering,
+            budget=budget,
+        )
+
+    for stage in stages:
+        print(f"{stage.label} - done.")
+
+    if streaming:
+        peak = mem.formatMegabytes(mem.getPeakRss(children=shards > 1))
+        print(f"Peak memory (RSS): {peak}")
+        with open(logcountfile, "a") as fh_log:
+            fh_log.write(f"Peak memory (RSS): {peak}\n")
+
+
+"""Splits the variant lines into byte-range shards, annotates them in a
+   process pool and concatenates the results in input order
+   Returns the stages with the counts of all shards merged
+   With a checkpoint every shard keeps its own manifest next to the job's,
+   and the job is marked complete once the output is assembled
+   A memory_budget (bytes) is split evenly between the shard processes
+"""
+
+
+def runSharded(
+    infile,
+    outfile,
+    logcountfile,
+    stageArgs,
+    shards,
+    window_size=5000,
+    concurrent=False,
+    checkpoint=None,
+    buffering=-1,
+    memory_budget=None,
+):
+    header = []
+    headerEnd = 0
+    for line in fu.readLines(infile):
+        if not ann.isHeaderLine(line.strip()):
+            break
+        header.append(line.strip())
+        headerEnd = headerEnd + len(line.encode("utf-8"))
+
+    jobs = []
+    ranges = fu.splitByteRange(infile, shards, start=headerEnd)
+    for i in range(0, len(ranges)):
+        start, end = ranges[i]
+        partfile = infile + ".part" + str(i)
+        partCheckpoint = None
+        interval = None
+        if checkpoint is not None:
+            partCheckpoint = checkpoint.path + ".part" + str(i)
+            interval = checkpoint.interval
+        budget = None
+        if memory_budget:
+            budget = memory_budget // len(ranges)
+        jobs.append(
+            (
+                infile,
+                start,
+                end,
+                partfile,
+                stageArgs,
+                window_size,
+                concurrent,
+                partCheckpoint,
+                interval,
+                buffering,
+                budget,
+            )
+        )
+
+    print(f"Annotating {str(len(jobs))} shards in parallel")
+    pool = multiprocessing.Pool(processes=len(jobs))
+    try:
+        shardCounts = pool.map(annotateShard, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    stages = getStages(**stageArgs)
+    for counts in shardCounts:
+        for stage, stageCounts in zip(stages, counts):
+            stage.mergeCounts(stageCounts)
+
+    fh_out = open(outfile, "wb")
+    for line in header:
+        fh_out.write((line + "\n").encode("utf-8"))
+    for job in jobs:
+        fh_part = open(job[3], "rb")
+        shutil.copyfileobj(fh_part, fh_out)
+        fh_part.close()
+    fh_out.close()
+
+    # Parts are only deleted once the job checkpoint covers the output
+    if checkpoint is not None:
+        checkpoint.markComplete(stages)
+    for job in jobs:
+        fu.delete(job[3])
+        if job[7] is not None:
+            ck.deleteManifest(job[7])
+
+    ann.writeCountLog(stages, logcountfile)
+    return stages
+
+
+"""Annotates one shard in a worker process, returns the counts of every stage
+"""
+
+
+def annotateShard(job):
+    (
+        infile,
+        start,
+        end,
+        partfile,
+        stageArgs,
+        window_size,
+        concurrent,
+        partCheckpoint,
+        interval,
+        buffering,
+        budget,
+    ) = job
+    stages = getStages(**stageArgs)
+    if budget is not None:
+        budget = mem.MemoryBudget(
+            budget, window_size, release=[ann.clearTranscriptCache]
+        )
+    if partCheckpoint is None:
+        fh_out = open(partfile, "wb", buffering=buffering)
+        ann.annotateLines(
+            stages,
+            fu.readLines(infile, start, end, decode=False, buffering=buffering),
+            fh_out,
+            window_size=window_size,
+            concurrent=concurrent,
+            budget=budget,
+        )
+        fh_out.close()
+        return [stage.counts for stage in stages]
+
+    checkpoint = ck.StreamCheckpoint(
+        partCheckpoint, infile, partfile, stageArgs, start, end, interval=interval
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    checkpoint.restoreCounts(stages)
+    if not checkpoint.complete:
+        fh_out = checkpoint.openOutput(buffering=buffering)
+        ann.annotateLines(
+            stages,
+            checkpoint.readLines(buffering=buffering),
+            fh_out,
+            window_size=window_size,
+            concurrent=concurrent,
+            checkpoint=checkpoint,
+            budget=budget,
+        )
+        fh_out.close()
+    return [stage.counts for stage in stages]
+
+
+"""Runs one step of a stage-by-stage run, unless the checkpoint already
+   holds its output
+"""
+
+
+def runStep(checkpoint, label, outfile, step, **kwargs):
+    if checkpoint is not None and checkpoint.isDone(label, outfile):
+        print(f"{label} - restored from checkpoint.")
+        return
+    if checkpoint is not None:
+        checkpoint.rewindLog()
+    step(**kwargs)
+    print(f"{label} - done.")
+    if checkpoint is not None:
+        checkpoint.stageDone(label, outfile)
+
+
+"""Runs the stages one after another, each writing an intermediate file
+   (<infile>.1, <infile>.2, ...), the last one renamed to <name>.annot.vcf
+   With a checkpoint (manifest path) completed stages are not run again; the
+   manifest records the final output before the rename and is deleted only
+   after the intermediate files, so a job restarted at any point after the
+   last stage only finishes the cleanup
+"""
 
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
+def runStageByStage(
+    infile,
+    format,
+    dbsnp_batch_size=5000,
+    region_engine="index",
+    checkpoint=None,
+    pipeline=None,
+):
+    if pipeline is None:
+        pipeline = parsePipeline()
+    stageCheckpoint = None
+    if checkpoint:
+        stageCheckpoint = ck.StageCheckpoint(
+            checkpoint,
+            infile,
+            infile + ".count.log",
+            {
+                "format": format,
+                "dbsnp_batch_size": dbsnp_batch_size,
+                "region_engine": region_engine,
+                "pipeline": pipeline,
+            },
+        )
+
+    print("Running . . .")
+
+    stages = getStages(
+        format=format,
+        dbsnp_batch_size=dbsnp_batch_size,
+        region_engine=region_engine,
+        pipeline=pipeline,
+    )
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
-    os.rename(infile + ".annot", finalout)
+    if stageCheckpoint is not None and stageCheckpoint.complete:
+        print(f"{finalout} restored from checkpoint.")
+        cleanupStages(infile, stages, stageCheckpoint)
+        return
+
+    tmpextin = ""
+    for i in range(0, len(stages)):
+        tmpextout = "." + str(i + 1)
+        # dbSNP is queried in batches, the other stages variant by variant
+        window_size = 1
+        if isinstance(stages[i], ann.DbSnpStage):
+            window_size = max(dbsnp_batch_size, 1)
+        runStep(
+            stageCheckpoint,
+            stages[i].label,
+            infile + tmpextout,
+            ann.runStage,
+            stage=stages[i],
+            vcf=infile,
+            tmpextin=tmpextin,
+            tmpextout=tmpextout,
+            logmode="w" if i == 0 else "a",
+            window_size=window_size,
+        )
+        tmpextin = tmpextout
+
+    if stageCheckpoint is not None:
+        stageCheckpoint.finish(finalout)
+    os.replace(infile + tmpextin, finalout)
+    cleanupStages(infile, stages, stageCheckpoint)
+
+
+"""Deletes the intermediate files of runStageByStage(), then the manifest
+"""
+
+
+def cleanupStages(infile, stages, checkpoint=None):
+    for i in range(1, len(stages) + 1):
+        fu.delete(infile + "." + str(i))
+    if checkpoint is not None:
+        checkpoint.delete()
 
 
 ### EOF
@@ -243,6 +243,52 @@ def readindices(filename, sep="\t"):
     return sorted(values)
 
 
+"""Yields the lines that start in the byte range [start, end) of a file
+   start must be at the beginning of a line
+   With decode=False the lines are yielded as bytes
+   buffering is the buffer size of the file (-1: default)
+"""
+
+
+def readLines(filename, start=0, end=None, decode=True, buffering=-1):
+    fh = open(filename, "rb", buffering=buffering)
+    fh.seek(start)
+    offset = start
+    for line in fh:
+        if end is not None and offset >= end:
+            break
+        offset = offset + len(line)
+        if decode:
+            yield line.decode("utf-8")
+        else:
+            yield line
+    fh.close()
+
+
+"""Splits the byte range [start, end of file) into at most n ranges
+   that begin and end on line boundaries
+"""
+
+
+def splitByteRange(filename, n, start=0):
+    size = fileSize(filename)
+    bounds = [start]
+    fh = open(filename, "rb")
+    for i in range(1, n):
+        target = start + ((size - start) * i) // n
+        if target <= bounds[-1]:
+            continue
+        # Move to the first line starting at or after target
+        fh.seek(target - 1)
+        fh.readline()
+        offset = fh.tell()
+        if bounds[-1] < offset < size:
+            bounds.append(offset)
+    fh.close()
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
 """"Count number of lines in file, file is not loaded to memory
 """
 
@@ -0,0 +1,247 @@
+# interval_index.py
+#
+# In-memory overlap lookups for the small AnnTools region tables
+# (cytoBand, CNV tables, targetScanS, genomicSuperDups, gadAll, gwasCatalog)
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import bisect
+
+"""Indexes loaded by this process, keyed by table, columns and padding
+"""
+loadedIndexes = {}
+
+
+"""Per-chromosome sorted interval arrays for one reference table
+
+Rows are kept sorted by start together with a running maximum of the
+end coordinates, so a point lookup only walks back over intervals that
+can still reach the position. Every interval keeps the row number of its
+row in the table, and matches are sorted by it so they come out in the
+order of the SQL lookups. Intervals are widened by pad on both sides
+(promoter windows).
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self, rows, chromCol, startCol, endCol, pad=0):
+        self.chroms = {}
+        entries = {}
+        for rowNumber, row in enumerate(rows):
+            entries.setdefault(str(row[chromCol]), []).append(
+                (int(row[startCol]) - pad, rowNumber, int(row[endCol]) + pad, row)
+            )
+
+        for chrom in entries:
+            chromEntries = sorted(entries[chrom], key=lambda e: (e[0], e[1]))
+            starts = []
+            maxEnds = []
+            maxEnd = None
+            for e in chromEntries:
+                starts.append(e[0])
+                if maxEnd is None or e[2] > maxEnd:
+                    maxEnd = e[2]
+                maxEnds.append(maxEnd)
+            self.chroms[chrom] = (starts, maxEnds, chromEntries)
+
+    """All rows with start <= pos <= end, in table row order
+    """
+
+    def overlapping(self, chrom, pos):
+        if chrom not in self.chroms:
+            return []
+
+        pos = int(pos)
+        starts, maxEnds, chromEntries = self.chroms[chrom]
+        found = []
+        i = bisect.bisect_right(starts, pos) - 1
+        while i >= 0 and maxEnds[i] >= pos:
+            if chromEntries[i][2] >= pos:
+                found.append(chromEntries[i])
+            i = i - 1
+
+        # Table row numbers
+        found.sort(key=lambda e: e[1])
+        return [e[3] for e in found]
+
+    """First overlapping row in table order, or None (same as fetchone)
+    """
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    # Indexes are shared by the whole process and stay loaded
+    def close(self):
+        pass
+
+
+"""numpy, imported on first use, or None where it is not installed
+"""
+
+
+def importNumpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+"""Vectorized lookups for tables of non-overlapping intervals (cytoBand)
+
+With intervals sorted by start and each one starting at or after the end
+of the previous one, a position can only fall in the last interval that
+starts at or before it, or also in the one before that when the two share
+a boundary (lookups include both ends, like the SQL queries). A whole
+batch of positions on a chromosome is then resolved with one numpy
+searchsorted; without numpy every position takes one binary search.
+"""
+
+
+class DisjointIntervalIndex(object):
+    def __init__(self, rows, chromCol, startCol, endCol):
+        self.chroms = {}
+        self.disjoint = True
+        self.np = importNumpy()
+        entries = {}
+        for rowNumber, row in enumerate(rows):
+            entries.setdefault(str(row[chromCol]), []).append(
+                (int(row[startCol]), rowNumber, int(row[endCol]), row)
+            )
+
+        for chrom in entries:
+            chromEntries = sorted(entries[chrom], key=lambda e: (e[0], e[1]))
+            starts = [e[0] for e in chromEntries]
+            ends = [e[2] for e in chromEntries]
+            for i in range(1, len(starts)):
+                if starts[i] <= starts[i - 1] or starts[i] < ends[i - 1]:
+                    self.disjoint = False
+                    break
+            if self.np is not None:
+                starts = self.np.array(starts, dtype=self.np.int64)
+                ends = self.np.array(ends, dtype=self.np.int64)
+            rowNumbers = [e[1] for e in chromEntries]
+            self.chroms[chrom] = (
+                starts,
+                ends,
+                rowNumbers,
+                [e[3] for e in chromEntries],
+            )
+
+    """Overlapping rows in table row order for every position in the batch
+    """
+
+    def overlappingMany(self, chrom, positions):
+        if chrom not in self.chroms:
+            return [[] for p in positions]
+
+        starts, ends, rowNumbers, rows = self.chroms[chrom]
+        if self.np is None:
+            return [
+                self.collect(self.bandsAt(starts, ends, int(pos)), rowNumbers, rows)
+                for pos in positions
+            ]
+
+        np = self.np
+        pos = np.asarray([int(p) for p in positions], dtype=np.int64)
+        last = np.searchsorted(starts, pos, side="right") - 1
+        current = np.maximum(last, 0)
+        previous = np.maximum(last - 1, 0)
+        inCurrent = (last >= 0) & (ends[current] >= pos)
+        inPrevious = (last >= 1) & (ends[previous] >= pos)
+
+        results = []
+        for k in range(0, len(pos)):
+            found = []
+            if inPrevious[k]:
+                found.append(int(previous[k]))
+            if inCurrent[k]:
+                found.append(int(current[k]))
+            results.append(self.collect(found, rowNumbers, rows))
+        return results
+
+    """Bands holding pos, found with one binary search (no numpy)
+    """
+
+    def bandsAt(self, starts, ends, pos):
+        last = bisect.bisect_right(starts, pos) - 1
+        found = []
+        if last >= 1 and ends[last - 1] >= pos:
+            found.append(last - 1)
+        if last >= 0 and ends[last] >= pos:
+            found.append(last)
+        return found
+
+    def collect(self, found, rowNumbers, rows):
+        found.sort(key=lambda i: rowNumbers[i])
+        return [rows[i] for i in found]
+
+    def overlapping(self, chrom, pos):
+        return self.overlappingMany(chrom, [int(pos)])[0]
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def close(self):
+        pass
+
+
+"""Position of a column in a result set, matched case-insensitively like MySQL
+"""
+
+
+def getColumnIndex(description, name):
+    columns = [str(d[0]).lower() for d in description]
+    return columns.index(name.lower())
+
+
+"""Loads the table once per process and returns its index
+   Row numbers are the positions of the rows in the full-table read
+   With disjoint=True tables without overlapping intervals get the
+   vectorized index (DisjointIntervalIndex)
+"""
+
+
+def getIntervalIndex(
+    conn,
+    table,
+    chromCol="chrom",
+    startCol="chromStart",
+    endCol="chromEnd",
+    pad=0,
+    columns="*",
+    disjoint=False,
+):
+    key = (table, chromCol, startCol, endCol, pad, columns, disjoint)
+    if key not in loadedIndexes:
+        cursor = conn.cursor()
+        cursor.execute("select " + columns + " from " + table + ";")
+        rows = cursor.fetchall()
+        chromIndex = getColumnIndex(cursor.description, chromCol)
+        startIndex = getColumnIndex(cursor.description, startCol)
+        endIndex = getColumnIndex(cursor.description, endCol)
+        cursor.close()
+
+        index = None
+        if disjoint and pad == 0:
+            index = DisjointIntervalIndex(rows, chromIndex, startIndex, endIndex)
+            if not index.disjoint:
+                print(f"{table} has overlapping intervals, using the interval index")
+                index = None
+        if index is None:
+            index = IntervalIndex(rows, chromIndex, startIndex, endIndex, pad=pad)
+        loadedIndexes[key] = index
+
+    return loadedIndexes[key]
+
+
+### EOF
@@ -0,0 +1,161 @@
+# job_monitor.py
+#
+# SQS messages of running annotation jobs
+#
+# A job request message stays in the queue until its run.py exits
+# successfully; while the job runs, the message's visibility timeout is
+# extended so no annotator takes the job again. If run.py or the annotator
+# dies, the message becomes visible again and the job is redelivered: the
+# rerun finds the job folder with its input and resumes from the checkpoint
+# manifest in it. A request received more than MAX_RECEIVE_COUNT times
+# keeps failing; the job is then marked FAILED and its request deleted.
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import subprocess
+import time
+
+from botocore.exceptions import ClientError
+
+"""Seconds a running job keeps its message hidden after each extension
+"""
+VISIBILITY_TIMEOUT = 300
+
+"""Seconds between two extensions of the visibility timeout
+"""
+HEARTBEAT_SECONDS = 60
+
+"""Deliveries of a job request before the job is given up
+"""
+MAX_RECEIVE_COUNT = 3
+
+"""Message attributes to request with receive_messages()
+"""
+MESSAGE_ATTRIBUTES = ["ApproximateReceiveCount"]
+
+
+"""Times the message has been received, including this time
+   (1 where the attribute was not requested)
+"""
+
+
+def getReceiveCount(message):
+    attributes = message.attributes or {}
+    try:
+        return int(attributes.get("ApproximateReceiveCount", 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+"""Marks the job FAILED in the annotations table and deletes its request,
+   so it is not delivered again
+"""
+
+
+def failJob(table, jobId, message, reason):
+    print(f"Annotation job {jobId} failed: {reason}")
+    try:
+        table.update_item(
+            Key={"job_id": jobId},
+            UpdateExpression="SET job_status = :newStatus",
+            ExpressionAttributeValues={":newStatus": "FAILED"},
+        )
+    except ClientError as e:
+        print(f"Failed to update job status: {e}")
+    if message is None:
+        return
+    try:
+        message.delete()
+    except ClientError as e:
+        print(f"Delete message failed: {e}")
+
+
+"""Watches the run.py process of a job and the SQS message it came from
+
+poll() extends the visibility of the message every heartbeatSeconds while
+the process runs and deletes the message once the process exits with 0. A
+failed job leaves its message in the queue, to be redelivered (and
+resumed) once the last extension runs out, up to MAX_RECEIVE_COUNT
+deliveries.
+"""
+
+
+class JobMonitor(object):
+    def __init__(
+        self,
+        jobId,
+        process,
+        message=None,
+        visibilityTimeout=VISIBILITY_TIMEOUT,
+        heartbeatSeconds=HEARTBEAT_SECONDS,
+    ):
+        self.jobId = jobId
+        self.process = process
+        self.message = message
+        self.visibilityTimeout = visibilityTimeout
+        self.heartbeatSeconds = heartbeatSeconds
+        self.extended = 0
+        self.extend()
+
+    """Takes over the message found after the launch, or a redelivered copy
+       of it (only its receipt handle is valid from then on)
+    """
+
+    def setMessage(self, message):
+        self.message = message
+        returncode = self.process.poll()
+        if returncode is None:
+            self.extend()
+        elif returncode == 0:
+            self.delete()
+
+    def extend(self):
+        self.extended = time.time()
+        if self.message is None:
+            return
+        try:
+            self.message.change_visibility(VisibilityTimeout=self.visibilityTimeout)
+        except ClientError as e:
+            print(f"Extend message visibility failed for job {self.jobId}: {e}")
+
+    def delete(self):
+        if self.message is None:
+            return
+        try:
+            self.message.delete()
+        except ClientError as e:
+            print(f"Delete message failed for job {self.jobId}: {e}")
+
+    """True once the process has exited (and its message is handled)
+    """
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is None:
+            if time.time() - self.extended >= self.heartbeatSeconds:
+                self.extend()
+            return False
+        if returncode == 0:
+            self.delete()
+        else:
+            print(
+                f"Annotation job {self.jobId} failed with exit code {returncode}, "
+                "its request will be redelivered"
+            )
+        return True
+
+    """Blocks until the process exits, extending the message meanwhile
+    """
+
+    def wait(self):
+        while not self.poll():
+            try:
+                self.process.wait(timeout=self.heartbeatSeconds)
+            except subprocess.TimeoutExpired:
+                pass
+
+
+### EOF
@@ -0,0 +1,97 @@
+# memory.py
+#
+# Memory use of annotation jobs: resident set size of the process and the
+# per-job memory budget of streaming runs
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import gc
+import os
+import resource
+import sys
+
+"""Buffer size of the input and output files of streaming runs
+"""
+IO_BUFFER_SIZE = 1024 * 1024
+
+# Smallest window a memory budget shrinks the window to
+MIN_WINDOW_SIZE = 100
+
+# Windows grow back once the process is below this share of its budget
+LOW_WATER = 0.75
+
+
+"""Peak resident set size in bytes of this process, and with children=True
+   of the largest of its finished child processes (shard workers) too
+"""
+
+
+def getPeakRss(children=False):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes, except on macOS
+    if sys.platform != "darwin":
+        peak = peak * 1024
+    return peak
+
+
+"""Current resident set size in bytes (the peak where /proc is not there)
+"""
+
+
+def getCurrentRss():
+    try:
+        with open("/proc/self/statm", "r") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return getPeakRss()
+
+
+def formatMegabytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+"""Memory budget of a streaming run
+
+The run asks for the size of its next window after every window it
+writes. While the process is over its limit (bytes) the window is halved,
+down to MIN_WINDOW_SIZE, so fewer variants and reference rows are held at
+a time, the release callables (cache clears) are called and garbage is
+collected; reading the input waits on the smaller windows. Once the
+process is back under LOW_WATER of the limit, windows double again up to
+the configured size.
+
+The budget is a target, not a hard limit: a single window, the reference
+rows one lookup returns and memory the process holds outside the pipeline
+can still take it over.
+"""
+
+
+class MemoryBudget(object):
+    def __init__(self, limit, windowSize, release=()):
+        self.limit = int(limit)
+        self.maxWindowSize = windowSize
+        self.windowSize = windowSize
+        self.release = list(release)
+        self.throttled = 0
+
+    def nextWindowSize(self):
+        rss = getCurrentRss()
+        if rss > self.limit:
+            for release in self.release:
+                release()
+            gc.collect()
+            if self.windowSize > MIN_WINDOW_SIZE:
+                self.windowSize = max(MIN_WINDOW_SIZE, self.windowSize // 2)
+                self.throttled = self.throttled + 1
+        elif rss < self.limit * LOW_WATER and self.windowSize < self.maxWindowSize:
+            self.windowSize = min(self.maxWindowSize, self.windowSize * 2)
+        return self.windowSize
+
+
+### EOF
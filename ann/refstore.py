@@ -0,0 +1,213 @@
+# refstore.py
+#
+# Memory-mapped columnar copies of the AnnTools reference tables
+# (written by build_refstore.py)
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import json
+import os
+
+import numpy as np
+
+"""Directory holding the exported tables, one sub-directory per table
+"""
+STORE_DIR = os.environ.get(
+    "ANNTOOLS_REFSTORE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "refstore"),
+)
+
+"""Tables mapped by this process, keyed by directory
+"""
+openTables = {}
+
+
+def getTableDir(table, storeDir=None):
+    if storeDir is None:
+        storeDir = STORE_DIR
+    return os.path.join(storeDir, table)
+
+
+"""One exported table
+
+Layout of a table directory:
+    meta.json           column names and kinds, interval columns, and the
+                        [first, last) row range of every chromosome
+    start.npy, end.npy  interval coordinates, rows sorted by chromosome and start
+    maxend.npy          running maximum of end within each chromosome
+    order.npy           position of each row in the original table
+    c<i>.npy            values of column i (int and float columns), or
+    c<i>.offsets.npy    row boundaries in the string pool c<i>.pool.npy
+                        (str and bytes columns)
+    c<i>.null.npy       NULL mask of column i, only if it has NULLs
+
+Every array is memory-mapped, so tables open instantly and their pages are
+shared through the page cache by all the processes annotating on the host.
+Tables exported without a chromosome column (tfbsConsSites<chr>) have a
+single row range that every lookup searches.
+"""
+
+
+class ColumnarTable(object):
+    def __init__(self, path):
+        fh = open(os.path.join(path, "meta.json"))
+        meta = json.load(fh)
+        fh.close()
+
+        self.path = path
+        self.columns = meta["columns"]
+        self.kinds = meta["kinds"]
+        self.chromCol = meta["chromCol"]
+        self.startCol = meta["startCol"]
+        self.endCol = meta["endCol"]
+        self.segments = meta["chroms"]
+
+        self.starts = self.load("start")
+        self.ends = self.load("end")
+        self.maxEnds = self.load("maxend")
+        self.order = self.load("order")
+        self.values = []
+        self.nulls = []
+        for i in range(0, len(self.columns)):
+            if self.kinds[i] in ("str", "bytes"):
+                self.values.append(
+                    (self.load(f"c{i}.offsets"), self.load(f"c{i}.pool"))
+                )
+            else:
+                self.values.append(self.load(f"c{i}"))
+            nullFile = os.path.join(path, f"c{i}.null.npy")
+            if os.path.exists(nullFile):
+                self.nulls.append(np.load(nullFile, mmap_mode="r"))
+            else:
+                self.nulls.append(None)
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def columnIndex(self, name):
+        columns = [c.lower() for c in self.columns]
+        return columns.index(name.lower())
+
+    """Checks that lookups on these columns can be answered by this table
+    """
+
+    def matches(self, chromCol, startCol, endCol):
+        names = [self.chromCol, self.startCol, self.endCol]
+        wanted = [chromCol, startCol, endCol]
+        return [str(n).lower() for n in names] == [str(n).lower() for n in wanted]
+
+    """Sorted-row numbers of the rows with start - pad <= pos <= end + pad,
+    in table order
+    """
+
+    def find(self, chrom, pos, pad=0):
+        if self.chromCol is None:
+            lo, hi = 0, len(self.starts)
+        elif chrom in self.segments:
+            lo, hi = self.segments[chrom]
+        else:
+            return []
+
+        pos = int(pos)
+        found = []
+        i = lo + int(np.searchsorted(self.starts[lo:hi], pos + pad, side="right")) - 1
+        while i >= lo and self.maxEnds[i] + pad >= pos:
+            if self.ends[i] + pad >= pos:
+                found.append(i)
+            i = i - 1
+
+        found.sort(key=lambda i: self.order[i])
+        return found
+
+    def getValue(self, column, i):
+        if self.nulls[column] is not None and self.nulls[column][i]:
+            return None
+
+        kind = self.kinds[column]
+        if kind == "int":
+            return int(self.values[column][i])
+        elif kind == "float":
+            return float(self.values[column][i])
+
+        offsets, pool = self.values[column]
+        value = pool[offsets[i] : offsets[i + 1]].tobytes()
+        if kind == "bytes":
+            return value
+        return value.decode("utf-8")
+
+    def getRow(self, i, columns):
+        return tuple([self.getValue(c, i) for c in columns])
+
+
+"""Maps an exported table once per process
+"""
+
+
+def getTable(table, storeDir=None):
+    path = getTableDir(table, storeDir)
+    if path not in openTables:
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise ValueError(f"Table {table} is not in the reference store {path}")
+        openTables[path] = ColumnarTable(path)
+    return openTables[path]
+
+
+"""Overlap lookups on an exported table, rows come back like the SQL
+lookups return them (table order, selected columns in the selected order)
+"""
+
+
+class ColumnarLookup(object):
+    def __init__(
+        self,
+        table,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        pad=0,
+        columns="*",
+        storeDir=None,
+    ):
+        self.table = getTable(table, storeDir)
+        if not self.table.matches(chromCol, startCol, endCol):
+            raise ValueError(
+                f"Table {table} was exported for lookups on "
+                + f"{self.table.chromCol}, {self.table.startCol}, "
+                + f"{self.table.endCol}"
+            )
+
+        self.pad = int(pad)
+        if columns.strip() == "*":
+            self.columns = list(range(0, len(self.table.columns)))
+        else:
+            self.columns = [
+                self.table.columnIndex(c.strip()) for c in columns.split(",")
+            ]
+
+    """Position of a column in the returned rows
+    """
+
+    def columnIndex(self, name):
+        return self.columns.index(self.table.columnIndex(name))
+
+    def overlapping(self, chrom, pos):
+        return [
+            self.table.getRow(i, self.columns)
+            for i in self.table.find(chrom, pos, self.pad)
+        ]
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    # Tables are shared by the whole process and stay mapped
+    def close(self):
+        pass
+
+
+### EOF
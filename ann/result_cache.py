@@ -0,0 +1,129 @@
+# result_cache.py
+#
+# Persistent cache of stage lookup results, shared by the annotation jobs
+# running on an instance
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+"""Caches opened by this process, keyed by file and reference version
+"""
+openCaches = {}
+
+# Keys per statement, below the SQLite host parameter limit
+BATCH_SIZE = 500
+
+
+"""Lookup results keyed by reference version, stage and locus
+
+Results are kept in an SQLite file, so every job (and every shard process)
+on the instance reads and fills the same cache. Entries carry the time
+they were last used; once the cache holds more than maxEntries the least
+recently used ones are evicted. Entries of other reference versions are
+never read again and age out the same way.
+"""
+
+
+class ResultCache(object):
+    def __init__(self, path, version, maxEntries=1000000):
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.version = str(version)
+        self.maxEntries = int(maxEntries)
+        self.lock = threading.Lock()
+        self.added = 0
+        self.conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute(
+            "create table if not exists results"
+            + " (key TEXT PRIMARY KEY, value BLOB, used REAL);"
+        )
+        self.conn.execute("create index if not exists results_used on results (used);")
+
+    def makeKey(self, stage, key):
+        return json.dumps([self.version, stage, [str(k) for k in key]])
+
+    """Cached results of a stage for the given lookup keys, as a dict
+    """
+
+    def getMany(self, stage, keys):
+        found = {}
+        byKey = {}
+        for key in keys:
+            byKey[self.makeKey(stage, key)] = key
+        storeKeys = list(byKey)
+
+        with self.lock:
+            for i in range(0, len(storeKeys), BATCH_SIZE):
+                batch = storeKeys[i : i + BATCH_SIZE]
+                marks = ",".join(["?"] * len(batch))
+                rows = self.conn.execute(
+                    "select key, value from results where key in (" + marks + ");",
+                    batch,
+                ).fetchall()
+                for storeKey, value in rows:
+                    found[byKey[storeKey]] = pickle.loads(value)
+                if len(rows) > 0:
+                    self.conn.execute(
+                        "update results set used=? where key in (" + marks + ");",
+                        [time.time()] + batch,
+                    )
+        return found
+
+    def putMany(self, stage, results):
+        now = time.time()
+        rows = [
+            (self.makeKey(stage, key), pickle.dumps(value), now)
+            for key, value in results.items()
+        ]
+        with self.lock:
+            self.conn.execute("begin;")
+            self.conn.executemany(
+                "insert or replace into results (key, value, used) values (?, ?, ?);",
+                rows,
+            )
+            self.conn.execute("commit;")
+            self.added = self.added + len(rows)
+            if self.added * 100 >= self.maxEntries:
+                self.evict()
+                self.added = 0
+
+    def evict(self):
+        entries = self.conn.execute("select count(*) from results;").fetchone()[0]
+        if entries > self.maxEntries:
+            self.conn.execute(
+                "delete from results where key in"
+                + " (select key from results order by used limit ?);",
+                [entries - self.maxEntries],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+"""Opens a cache once per process (connections are not shared with forks)
+"""
+
+
+def getResultCache(path, version, maxEntries=1000000):
+    key = (os.getpid(), os.path.abspath(path), str(version))
+    if key not in openCaches:
+        openCaches[key] = ResultCache(path, version, maxEntries=maxEntries)
+    return openCaches[key]
+
+
+### EOF
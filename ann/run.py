@@ -51,8 +51,45 @@ class Timer(object):
 if __name__ == "__main__":
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
+        # Persistent lookup cache shared by the jobs on this instance
+        cacheFile = config.get("ann", "AnnotationCacheFile", fallback="")
+        referenceVersion = config.get("ann", "ReferenceVersion", fallback="1")
+        cacheEntries = config.getint("ann", "AnnotationCacheEntries", fallback=1000000)
+        # Set once add_promoter_windows.py has built the promoter-window table
+        promoterWindows = config.getboolean("ann", "PromoterWindows", fallback=False)
+        # A restarted job resumes from the checkpoint manifest in its job folder
+        checkpointSeconds = config.getint("ann", "CheckpointSeconds", fallback=60)
+        checkpointFile = os.path.splitext(sys.argv[1])[0] + ".checkpoint.json"
+        # Streaming mode, for instances running several jobs at once
+        streaming = config.getboolean("ann", "StreamingMode", fallback=False)
+        memoryBudget = config.getint("ann", "MemoryBudgetMB", fallback=0)
+        # One database connection per stage and shard process while enabled
+        concurrentStages = config.getboolean("ann", "ConcurrentStages", fallback=False)
+        # Lookup engines (sweep, prefetch, join, columnar, dbSNP index)
+        engines = driver.enginesFromConfig(config)
+        # Pipeline of the job request (validated by the annotator), else the
+        # one in the config
+        if len(sys.argv) > 2:
+            pipeline = json.loads(sys.argv[2])
+        else:
+            pipeline = driver.pipelineFromConfig(config)
+
         with Timer():
-            driver.run(sys.argv[1], "vcf")
+            driver.run(
+                sys.argv[1],
+                "vcf",
+                cache_file=cacheFile or None,
+                reference_version=referenceVersion,
+                cache_entries=cacheEntries,
+                promoter_windows=promoterWindows,
+                checkpoint=checkpointFile if checkpointSeconds > 0 else None,
+                checkpoint_seconds=checkpointSeconds,
+                pipeline=pipeline,
+                streaming=streaming,
+                memory_budget=memoryBudget * 1024 * 1024 or None,
+                concurrent_stages=concurrentStages,
+                **engines,
+            )
 
         # Get results file and log file
         inputFileLocalPath = sys.argv[
@@ -211,6 +248,11 @@ if __name__ == "__main__":
             os.remove(logFileLocalPath)
         except OSError as e:
             print(f"Fail to delete log file at {logFileLocalPath}: {e}")
+        if os.path.exists(checkpointFile):
+            try:
+                os.remove(checkpointFile)
+            except OSError as e:
+                print(f"Fail to delete checkpoint at {checkpointFile}: {e}")
 
         # Delete the job folder, which is supposed to be empty at this point
         # https://www.geeksforgeeks.org/delete-a-directory-or-file-using-python/
@@ -0,0 +1,160 @@
+# snp_index.py
+#
+# Packed, sorted dbSNP key index searched in place through a memory map
+# (written by build_refstore.py)
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import json
+import os
+import struct
+
+import numpy as np
+
+import refstore as rs
+
+INDEX_FILE = os.environ.get(
+    "ANNTOOLS_DBSNP_INDEX", os.path.join(rs.STORE_DIR, "dbSNP.idx")
+)
+MAGIC = b"ANNSNPIX"
+
+"""Fixed-width records, sorted by chromosome and position
+   varclass is a code into the varclasses list of the header
+"""
+RECORD = np.dtype([("pos", "<u4"), ("varclass", "<u4")])
+
+"""Sections of the file after the header, in file order
+   Text fields are pools addressed through an offset table, the value of
+   record i being pool[offsets[i]:offsets[i + 1]]
+"""
+SECTIONS = [
+    ("records", RECORD),
+    ("ref.offsets", np.dtype("<i8")),
+    ("ref.pool", np.dtype("u1")),
+    ("id.offsets", np.dtype("<i8")),
+    ("id.pool", np.dtype("u1")),
+    ("gmaf.offsets", np.dtype("<i8")),
+    ("gmaf.pool", np.dtype("u1")),
+]
+
+"""Indexes mapped by this process, keyed by file
+"""
+openIndexes = {}
+
+
+"""The dbSNP key index
+
+File layout:
+    MAGIC, header length (uint64), JSON header, padding to 8 bytes
+    the SECTIONS, each at the offset the header gives relative to the
+    end of the padded header
+
+The header lists the [first, last) record range of every chromosome, the
+variant classes, the original dbSNP columns and the position of each
+section. Matching rows are rebuilt in the dbSNP column layout, so they can
+be used like the rows of the SQL lookups.
+"""
+
+
+class SnpIndex(object):
+    def __init__(self, path):
+        fh = open(path, "rb")
+        if fh.read(len(MAGIC)) != MAGIC:
+            fh.close()
+            raise ValueError(f"{path} is not a dbSNP key index")
+        headerLength = struct.unpack("<Q", fh.read(8))[0]
+        header = json.loads(fh.read(headerLength).decode("utf-8"))
+        fh.close()
+
+        self.chroms = header["chroms"]
+        self.varclasses = header["varclasses"]
+        self.columns = header["columns"]
+        self.fieldColumns = header["fieldColumns"]
+
+        dataStart = getDataStart(headerLength)
+        self.sections = {}
+        for name, dtype in SECTIONS:
+            offset, count = header["sections"][name]
+            if count == 0:
+                self.sections[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.sections[name] = np.memmap(
+                    path,
+                    dtype=dtype,
+                    mode="r",
+                    offset=dataStart + offset,
+                    shape=(count,),
+                )
+        self.positions = self.sections["records"]["pos"]
+
+    def getText(self, field, i):
+        offsets = self.sections[field + ".offsets"]
+        pool = self.sections[field + ".pool"]
+        return pool[offsets[i] : offsets[i + 1]].tobytes().decode("utf-8")
+
+    """Record range [lo, hi) of a chromosome position, by binary search
+    """
+
+    def find(self, chrom, pos):
+        if chrom not in self.chroms:
+            return 0, 0
+        lo, hi = self.chroms[chrom]
+        positions = self.positions[lo:hi]
+        pos = int(pos)
+        return (
+            lo + int(np.searchsorted(positions, pos, side="left")),
+            lo + int(np.searchsorted(positions, pos, side="right")),
+        )
+
+    """dbSNP rows at the position with one of the REF alleles and the variant
+    class, in table order (REF matched case-insensitively, like MySQL)
+    """
+
+    def matching(self, chrom, pos, refs, varclass):
+        lo, hi = self.find(chrom, pos)
+        accepted = [ref.upper() for ref in refs]
+        rows = []
+        for i in range(lo, hi):
+            record = self.sections["records"][i]
+            recordClass = self.varclasses[int(record["varclass"])]
+            if recordClass.rstrip().upper() != varclass.upper():
+                continue
+            ref = self.getText("ref", i)
+            if ref.rstrip().upper() not in accepted:
+                continue
+
+            row = [None] * len(self.columns)
+            row[self.fieldColumns["chrom"]] = chrom
+            row[self.fieldColumns["pos"]] = int(record["pos"])
+            row[self.fieldColumns["ref"]] = ref
+            row[self.fieldColumns["id"]] = self.getText("id", i)
+            row[self.fieldColumns["gmaf"]] = self.getText("gmaf", i)
+            row[self.fieldColumns["varclass"]] = recordClass
+            rows.append(tuple(row))
+        return rows
+
+    def close(self):
+        pass
+
+
+def getDataStart(headerLength):
+    end = len(MAGIC) + 8 + headerLength
+    return end + (-end % 8)
+
+
+"""Maps the index once per process
+"""
+
+
+def getSnpIndex(path=None):
+    if path is None:
+        path = INDEX_FILE
+    if path not in openIndexes:
+        openIndexes[path] = SnpIndex(path)
+    return openIndexes[path]
+
+
+### EOF
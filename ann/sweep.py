@@ -0,0 +1,149 @@
+# sweep.py
+#
+# Sort-merge (sweep-line) overlap lookups for coordinate-sorted VCFs
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import pymysql.cursors
+
+import utils as u
+
+
+class UnsortedInputError(Exception):
+    pass
+
+
+"""Overlap lookups answered by merging the VCF with the reference table
+
+For each chromosome the table rows are streamed once, ordered by start,
+through an unbuffered cursor. Rows enter the active set when the sweep
+reaches their start and leave it once it has passed their end, so a
+sorted VCF is annotated in one linear pass over both inputs. Matches
+come back in start order, so where several rows overlap a position the
+first one may not be the row a per-variant query returns first.
+
+As soon as a variant arrives out of order (a lower position on the same
+chromosome, or a chromosome seen before) the sweep is abandoned and the
+remaining lookups go to the per-variant fallback lookup.
+"""
+
+
+class SweepLookup(object):
+    def __init__(
+        self,
+        table,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        pad=0,
+        columns="*",
+        fallback=None,
+    ):
+        self.table = table
+        self.columns = columns
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.pad = int(pad)
+        self.fallbackFactory = fallback
+        self.fallback = None
+
+        self.conn = None
+        self.stream = None
+        self.chrom = None
+        self.pos = None
+        self.seenChroms = set()
+        self.active = []
+        self.pending = None
+        self.startIndex = None
+        self.endIndex = None
+
+    def overlapping(self, chrom, pos):
+        pos = int(pos)
+        if self.fallback is None:
+            try:
+                return self.advance(chrom, pos)
+            except UnsortedInputError as e:
+                print(f"{self.table}: {e}, falling back to per-variant lookups")
+                self.startFallback()
+
+        return self.fallback.overlapping(chrom, pos)
+
+    def first(self, chrom, pos):
+        rows = self.overlapping(chrom, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def advance(self, chrom, pos):
+        if chrom != self.chrom:
+            if chrom in self.seenChroms:
+                raise UnsortedInputError(f"chromosome {chrom} is not contiguous")
+            self.startChrom(chrom, pos)
+        elif pos < self.pos:
+            raise UnsortedInputError(f"position {pos} on {chrom} is out of order")
+        self.pos = pos
+
+        # Admit rows starting at or before the position
+        while (
+            self.pending is not None
+            and self.pending[self.startIndex] - self.pad <= pos
+        ):
+            self.active.append(self.pending)
+            self.pending = self.stream.fetchone()
+
+        # Retire rows the sweep has moved past; they can never match again
+        self.active = [r for r in self.active if r[self.endIndex] + self.pad >= pos]
+        return list(self.active)
+
+    def startChrom(self, chrom, pos):
+        self.closeStream()
+        self.chrom = chrom
+        self.seenChroms.add(chrom)
+        self.active = []
+
+        if self.conn is None:
+            self.conn = u.get_connection()
+        self.stream = self.conn.cursor(pymysql.cursors.SSCursor)
+        sql = (
+            "select "
+            + self.columns
+            + " from "
+            + self.table
+            + " where "
+            + self.chromCol
+            + "=%s AND "
+            + self.endCol
+            + " >= %s order by "
+            + self.startCol
+            + ";"
+        )
+        self.stream.execute(sql, [chrom, pos - self.pad])
+        columns = [str(d[0]).lower() for d in self.stream.description]
+        self.startIndex = columns.index(self.startCol.lower())
+        self.endIndex = columns.index(self.endCol.lower())
+        self.pending = self.stream.fetchone()
+
+    def startFallback(self):
+        self.closeStream()
+        if self.conn is None:
+            self.conn = u.get_connection()
+        self.fallback = self.fallbackFactory(self.conn.cursor())
+
+    def closeStream(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+        self.pending = None
+
+    def close(self):
+        self.closeStream()
+        if self.conn is not None:
+            u.release_connection(self.conn)
+        self.conn = None
+
+
+### EOF
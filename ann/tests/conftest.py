@@ -0,0 +1,17 @@
+# conftest.py
+#
+# The annotator modules are scripts imported by bare name from ann/, the
+# directory run.py and the annotator run in
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+### EOF
@@ -0,0 +1,181 @@
+# test_checkpoint.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import os
+import zlib
+
+import checkpoint as ck
+
+LINES = [b"##header\n"] + [f"1\t{i}\t.\tA\tG\n".encode("utf-8") for i in range(10)]
+
+
+class Stage(object):
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+
+
+def writeFile(path, data):
+    with open(path, "wb") as fh:
+        fh.write(data)
+    return str(path)
+
+
+def readFile(path):
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+"""Streams the first n lines of the input into the output, upper-cased,
+   and saves a checkpoint
+"""
+
+
+def annotatePart(checkpoint, n, counts):
+    fh_out = checkpoint.openOutput()
+    lines = checkpoint.readLines()
+    for i in range(0, n):
+        fh_out.write(next(lines).upper())
+    lines.close()
+    checkpoint.save([Stage(counts)])
+    fh_out.close()
+
+
+def testChecksumOfARange(tmp_path):
+    data = b"".join(LINES)
+    path = writeFile(tmp_path / "in.vcf", data)
+    assert ck.getChecksum(path) == zlib.crc32(data)
+    assert ck.getChecksum(path, 3, 20) == zlib.crc32(data[3:20])
+    assert ck.getChecksum(path, 5, 5) == 0
+
+
+def testSaveManifestReplacesAtomically(tmp_path):
+    path = str(tmp_path / "job.checkpoint.json")
+    assert ck.loadManifest(path) is None
+    ck.saveManifest(path, {"a": 1})
+    ck.saveManifest(path, {"a": 2})
+    assert ck.loadManifest(path) == {"a": 2}
+    assert not os.path.exists(path + ".tmp")
+    writeFile(path, b"{not json")
+    assert ck.loadManifest(path) is None
+
+
+def testStreamResumesWhereItStopped(tmp_path):
+    infile = writeFile(tmp_path / "in.vcf", b"".join(LINES))
+    outfile = str(tmp_path / "in.annot.vcf")
+    path = str(tmp_path / "job.checkpoint.json")
+    settings = {"stageArgs": {"format": "vcf"}, "shards": (1, 2)}
+
+    first = ck.StreamCheckpoint(path, infile, outfile, settings)
+    assert not first.isResumed()
+    annotatePart(first, 4, {"variants": 3})
+    # Lines written after the last checkpoint are dropped on resume
+    with open(outfile, "ab") as fh:
+        fh.write(b"PARTIAL")
+
+    second = ck.StreamCheckpoint(path, infile, outfile, settings)
+    assert second.isResumed()
+    assert second.inputOffset == len(b"".join(LINES[:4]))
+    stage = Stage()
+    second.restoreCounts([stage])
+    assert stage.counts == {"variants": 3}
+
+    fh_out = second.openOutput()
+    for line in second.readLines():
+        fh_out.write(line.upper())
+    second.finish([Stage({"variants": 10})])
+    fh_out.close()
+    assert readFile(outfile) == b"".join(LINES).upper()
+
+    third = ck.StreamCheckpoint(path, infile, outfile, settings)
+    assert third.complete
+    assert third.counts == [{"variants": 10}]
+
+
+def testStreamStartsOverWhenFilesChange(tmp_path):
+    infile = writeFile(tmp_path / "in.vcf", b"".join(LINES))
+    outfile = str(tmp_path / "in.annot.vcf")
+    path = str(tmp_path / "job.checkpoint.json")
+
+    annotatePart(ck.StreamCheckpoint(path, infile, outfile, {}), 4, {})
+    assert not ck.StreamCheckpoint(path, infile, outfile, {"other": 1}).isResumed()
+
+    annotatePart(ck.StreamCheckpoint(path, infile, outfile, {}), 4, {})
+    writeFile(outfile, b"##HEADER\n1\t9")
+    assert not ck.StreamCheckpoint(path, infile, outfile, {}).isResumed()
+    assert not os.path.exists(path)
+
+    annotatePart(ck.StreamCheckpoint(path, infile, outfile, {}), 4, {})
+    writeFile(infile, b"".join(LINES).replace(b"1\t1", b"2\t1"))
+    assert not ck.StreamCheckpoint(path, infile, outfile, {}).isResumed()
+
+
+def testStreamByteRange(tmp_path):
+    infile = writeFile(tmp_path / "in.vcf", b"".join(LINES))
+    outfile = str(tmp_path / "shard.vcf")
+    path = str(tmp_path / "shard.checkpoint.json")
+    start = len(LINES[0])
+    end = start + len(LINES[1]) + len(LINES[2])
+
+    checkpoint = ck.StreamCheckpoint(path, infile, outfile, {}, start=start, end=end)
+    assert list(checkpoint.readLines()) == LINES[1:3]
+    assert checkpoint.inputOffset == end
+
+
+def testStagesAfterAChangedOutputRunAgain(tmp_path):
+    infile = writeFile(tmp_path / "in.vcf", b"".join(LINES))
+    logfile = str(tmp_path / "in.vcf.count.log")
+    path = str(tmp_path / "job.checkpoint.json")
+    outputs = [str(tmp_path / f"in.vcf.{i}") for i in range(3)]
+
+    checkpoint = ck.StageCheckpoint(path, infile, logfile, {"a": 1})
+    for i, name in enumerate(["dbSNP", "Genes", "CNV"]):
+        writeFile(outputs[i], name.encode("utf-8"))
+        with open(logfile, "ab") as fh:
+            fh.write(f"{name}: done\n".encode("utf-8"))
+        checkpoint.stageDone(name, outputs[i])
+
+    writeFile(outputs[1], b"changed")
+    with open(logfile, "ab") as fh:
+        fh.write(b"rerun\n")
+
+    resumed = ck.StageCheckpoint(path, infile, logfile, {"a": 1})
+    assert resumed.isDone("dbSNP", outputs[0])
+    assert not resumed.isDone("dbSNP", outputs[1])
+    assert not resumed.isDone("Genes", outputs[1])
+    assert not resumed.isDone("CNV", outputs[2])
+    assert not resumed.complete
+    resumed.rewindLog()
+    assert readFile(logfile) == b"dbSNP: done\n"
+
+    assert not ck.StageCheckpoint(path, infile, logfile, {"a": 2}).isDone(
+        "dbSNP", outputs[0]
+    )
+
+
+def testFinishedStageRunIsComplete(tmp_path):
+    infile = writeFile(tmp_path / "in.vcf", b"".join(LINES))
+    logfile = str(tmp_path / "in.vcf.count.log")
+    path = str(tmp_path / "job.checkpoint.json")
+    last = writeFile(tmp_path / "in.vcf.1", b"annotated")
+    writeFile(logfile, b"dbSNP: done\n")
+    final = str(tmp_path / "in.annot.vcf")
+
+    checkpoint = ck.StageCheckpoint(path, infile, logfile, {})
+    checkpoint.stageDone("dbSNP", last)
+    checkpoint.finish(final)
+    os.rename(last, final)
+
+    resumed = ck.StageCheckpoint(path, infile, logfile, {})
+    assert resumed.complete
+    assert resumed.final["output"] == final
+    assert not resumed.isDone("dbSNP", last)
+
+    writeFile(final, b"truncated")
+    assert not ck.StageCheckpoint(path, infile, logfile, {}).complete
+
+
+### EOF
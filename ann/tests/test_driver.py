@@ -0,0 +1,82 @@
+# test_driver.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+from configparser import ConfigParser
+
+import pytest
+
+import driver
+
+
+def testDefaultPipelineRunsEveryStage():
+    pipeline = driver.parsePipeline()
+    assert [stage["stage"] for stage in pipeline] == driver.STAGE_NAMES
+    assert pipeline[2] == {"stage": "Genes", "table": "refGene", "promoter_offset": 500}
+    assert pipeline[8] == {"stage": "CNV", "tables": driver.CNV_TABLES}
+
+
+def testParametersAreConverted():
+    pipeline = driver.parsePipeline(
+        [
+            "HUGO",
+            {"stage": "Genes", "promoter_offset": "1000", "table": " knownGene "},
+            {"stage": "CNV", "tables": "dgv_Cnv, conrad_Cnv"},
+        ]
+    )
+    assert pipeline == [
+        {"stage": "HUGO", "table": "hugo"},
+        {"stage": "Genes", "table": "knownGene", "promoter_offset": 1000},
+        {"stage": "CNV", "tables": ["dgv_Cnv", "conrad_Cnv"]},
+    ]
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        [],
+        "dbSNP",
+        ["dbSNP", "dbSNP"],
+        ["Unknown"],
+        [{"table": "hugo"}],
+        [{"stage": "HUGO", "pad": 1}],
+        [{"stage": "HUGO", "table": ""}],
+        [{"stage": "Genes", "promoter_offset": "far"}],
+        [{"stage": "CNV", "tables": []}],
+        [3],
+    ],
+)
+def testInvalidPipelines(spec):
+    with pytest.raises(ValueError):
+        driver.parsePipeline(spec)
+
+
+def testPipelineFromConfig():
+    config = ConfigParser()
+    config.read_string(
+        "[ann]\nStages = dbSNP, Genes\n[ann.Genes]\npromoter_offset = 250\n"
+    )
+    spec = driver.pipelineFromConfig(config)
+    assert driver.parsePipeline(spec) == [
+        {"stage": "dbSNP"},
+        {"stage": "Genes", "table": "refGene", "promoter_offset": 250},
+    ]
+
+
+def testEnginesFromConfig():
+    config = ConfigParser()
+    config.read_string("[ann]\n")
+    engines = driver.enginesFromConfig(config)
+    assert engines == dict(driver.lookupEngineArgs("index"), dbsnp_index=False)
+    config.read_string("[ann]\nLookupEngine = columnar\nDbSnpIndex = true\n")
+    engines = driver.enginesFromConfig(config)
+    assert engines["columnar"] and engines["dbsnp_index"]
+    config.read_string("[ann]\nLookupEngine = fast\n")
+    with pytest.raises(ValueError):
+        driver.enginesFromConfig(config)
+
+
+### EOF
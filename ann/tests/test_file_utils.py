@@ -0,0 +1,66 @@
+# test_file_utils.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import file_utils as fu
+
+
+def writeLines(path, lines):
+    with open(path, "wb") as fh:
+        fh.write(b"".join(lines))
+    return str(path)
+
+
+def testRangesCoverTheFileOnLineBoundaries(tmp_path):
+    lines = [f"1\t{i}\t{'x' * (i % 7)}\n".encode("utf-8") for i in range(100)]
+    path = writeLines(tmp_path / "in.vcf", lines)
+    size = fu.fileSize(path)
+    starts = set()
+    offset = 0
+    for line in lines:
+        starts.add(offset)
+        offset = offset + len(line)
+
+    for n in [1, 2, 3, 7, 100, 500]:
+        ranges = fu.splitByteRange(path, n)
+        assert 1 <= len(ranges) <= n
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == size
+        for (start, end), (nextStart, nextEnd) in zip(ranges, ranges[1:]):
+            assert end == nextStart
+        for start, end in ranges:
+            assert start < end
+            assert start in starts
+
+        read = []
+        for start, end in ranges:
+            read.extend(fu.readLines(path, start, end, decode=False))
+        assert read == lines
+
+
+def testRangesStartAfterTheHeader(tmp_path):
+    lines = [b"##fileformat=VCFv4.1\n", b"#CHROM\tPOS\n"]
+    lines = lines + [f"1\t{i}\n".encode("utf-8") for i in range(20)]
+    path = writeLines(tmp_path / "in.vcf", lines)
+    headerEnd = len(lines[0]) + len(lines[1])
+
+    ranges = fu.splitByteRange(path, 4, start=headerEnd)
+    assert ranges[0][0] == headerEnd
+    read = []
+    for start, end in ranges:
+        read.extend(fu.readLines(path, start, end, decode=False))
+    assert read == lines[2:]
+
+
+def testLongLineIsNotSplit(tmp_path):
+    lines = [b"1\t1\n", b"1\t2\t" + b"x" * 1000 + b"\n", b"1\t3\n"]
+    path = writeLines(tmp_path / "in.vcf", lines)
+    # Every target falls in the long line, so it ends the first range
+    ranges = fu.splitByteRange(path, 4)
+    assert ranges == [(0, 1009), (1009, fu.fileSize(path))]
+
+
+### EOF
@@ -0,0 +1,143 @@
+# test_interval_index.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import random
+import sqlite3
+
+import pytest
+
+import interval_index as ii
+
+# chrom, start, end, name
+ROWS = [
+    ("chr1", 100, 200, "a"),
+    ("chr1", 150, 160, "b"),
+    ("chr1", 50, 400, "c"),
+    ("chr1", 150, 150, "d"),
+    ("chr2", 100, 200, "e"),
+]
+
+BANDS = [
+    ("chr1", 200, 300, "p2"),
+    ("chr1", 0, 100, "p1"),
+    ("chr1", 100, 200, "q1"),
+    ("chr2", 0, 50, "q2"),
+]
+
+
+"""Rows overlapping pos, in table order, as the SQL lookups return them
+"""
+
+
+def scan(rows, chrom, pos, pad=0):
+    return [
+        row for row in rows if row[0] == chrom and row[1] - pad <= pos <= row[2] + pad
+    ]
+
+
+def randomRows(n, disjoint=False):
+    rows = []
+    start = 0
+    for i in range(0, n):
+        chrom = random.choice(["chr1", "chr2"])
+        if disjoint:
+            end = start + random.randint(1, 20)
+            rows.append((chrom, start, end, i))
+            start = end + random.randint(0, 2)
+        else:
+            start = random.randint(0, 1000)
+            rows.append((chrom, start, start + random.randint(0, 100), i))
+    random.shuffle(rows)
+    return rows
+
+
+def testOverlappingInTableOrder():
+    index = ii.IntervalIndex(ROWS, 0, 1, 2)
+    assert index.overlapping("chr1", 150) == [ROWS[0], ROWS[1], ROWS[2], ROWS[3]]
+    assert index.overlapping("chr1", "200") == [ROWS[0], ROWS[2]]
+    assert index.overlapping("chr1", 401) == []
+    assert index.overlapping("chr3", 150) == []
+    assert index.first("chr1", 300) == ROWS[2]
+    assert index.first("chr1", 10) is None
+
+
+def testPadWidensIntervals():
+    index = ii.IntervalIndex(ROWS, 0, 1, 2, pad=10)
+    assert index.overlapping("chr2", 90) == [ROWS[4]]
+    assert index.overlapping("chr2", 210) == [ROWS[4]]
+    assert index.overlapping("chr2", 211) == []
+
+
+def testMatchesScan():
+    random.seed(3)
+    rows = randomRows(300)
+    index = ii.IntervalIndex(rows, 0, 1, 2, pad=5)
+    for pos in range(-10, 1120, 7):
+        for chrom in ["chr1", "chr2"]:
+            assert index.overlapping(chrom, pos) == scan(rows, chrom, pos, pad=5)
+
+
+@pytest.fixture(params=["numpy", "bisect"])
+def numpyOrNot(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ii, "importNumpy", lambda: None)
+    return request.param
+
+
+def testDisjointSharedBoundaries(numpyOrNot):
+    index = ii.DisjointIntervalIndex(BANDS, 0, 1, 2)
+    assert index.disjoint
+    assert index.overlappingMany("chr1", [0, 50, 100, 200, 300, 301]) == [
+        [BANDS[1]],
+        [BANDS[1]],
+        [BANDS[1], BANDS[2]],
+        [BANDS[0], BANDS[2]],
+        [BANDS[0]],
+        [],
+    ]
+    assert index.overlappingMany("chr3", [1, 2]) == [[], []]
+    assert index.first("chr2", 50) == BANDS[3]
+    assert index.first("chr2", 51) is None
+
+
+def testDisjointMatchesScan(numpyOrNot):
+    random.seed(5)
+    rows = randomRows(300, disjoint=True)
+    index = ii.DisjointIntervalIndex(rows, 0, 1, 2)
+    assert index.disjoint
+    positions = list(range(-5, 4000, 3))
+    for chrom in ["chr1", "chr2"]:
+        found = index.overlappingMany(chrom, positions)
+        assert found == [scan(rows, chrom, pos) for pos in positions]
+
+
+def testOverlapsAreNotDisjoint(numpyOrNot):
+    assert not ii.DisjointIntervalIndex(ROWS, 0, 1, 2).disjoint
+
+
+def testGetIntervalIndexFallsBackOnOverlaps(monkeypatch):
+    monkeypatch.setattr(ii, "loadedIndexes", {})
+    conn = sqlite3.connect(":memory:")
+    conn.execute("create table bands (chrom, chromStart int, chromEnd int, name)")
+    conn.executemany("insert into bands values (?,?,?,?)", BANDS)
+    conn.execute("create table regions (chrom, chromStart int, chromEnd int, name)")
+    conn.executemany("insert into regions values (?,?,?,?)", ROWS)
+
+    bands = ii.getIntervalIndex(conn, "bands", disjoint=True)
+    assert isinstance(bands, ii.DisjointIntervalIndex)
+    assert bands.overlapping("chr1", 100) == [BANDS[1], BANDS[2]]
+    assert ii.getIntervalIndex(conn, "bands", disjoint=True) is bands
+
+    regions = ii.getIntervalIndex(conn, "regions", disjoint=True)
+    assert isinstance(regions, ii.IntervalIndex)
+    assert regions.overlapping("chr1", 150) == scan(ROWS, "chr1", 150)
+    conn.close()
+
+
+### EOF
@@ -0,0 +1,64 @@
+# test_vcf_info.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import vcf_info as vi
+
+
+def testTextIsKeptAsAdded():
+    info = vi.Info("DP=10")
+    info.add(";DB;VC=SNV")
+    info.add(";GMAF=0.01")
+    assert str(info) == "DP=10;DB;VC=SNV;GMAF=0.01"
+    assert len(info) == len(str(info))
+
+
+def testGetReturnsTheFirstValueOfAKey():
+    info = vi.Info("DP=10;AF=0.5")
+    info.add(";DP=20")
+    assert info.get("DP") == "10"
+    assert info.get("AF") == "0.5"
+    assert info.get("MISSING") == vi.MISSING
+
+
+def testAppendAddsASeparatorOnlyWhereNeeded():
+    info = vi.Info("DP=10")
+    info.append("DB")
+    assert str(info) == "DP=10;DB"
+    info = vi.Info("DP=10;")
+    info.append("DB")
+    assert str(info) == "DP=10;DB"
+
+
+def testReplaceResetsTheKeys():
+    info = vi.Info(".")
+    assert info.isMissing()
+    info.replace("DB;GMAF=0.1")
+    assert not info.isMissing()
+    assert info.get("GMAF") == "0.1"
+    assert str(info) == "DB;GMAF=0.1"
+
+
+def testPrefixAndSuffixSpanPieces():
+    info = vi.Info("D")
+    info.add("P=1")
+    info.add(";DB")
+    assert info.startswith("DP=")
+    assert info.endswith("1;DB")
+    assert not info.endswith(";")
+    info.dropPrefix(2)
+    assert str(info) == "=1;DB"
+    assert info.get("DP") == vi.MISSING
+
+
+def testEmptyInfo():
+    info = vi.Info("")
+    assert str(info) == ""
+    assert len(info) == 0
+    assert not info.isMissing()
+
+
+### EOF
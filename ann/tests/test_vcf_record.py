@@ -0,0 +1,72 @@
+# test_vcf_record.py
+#
+# Copyright (C) 2015-2023 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import io
+
+import vcf_info as vi
+import vcf_record as vr
+
+
+def writeToBytes(record):
+    fh = io.BytesIO()
+    vr.writeRecord(fh, record)
+    return fh.getvalue()
+
+
+def testParseSplitsUpToInfo():
+    line = b"1\t100\trs1\tA\tG\t50\tPASS\tDP=3\tGT:DP\t0/1:3\t1/1:7"
+    record = vr.parseRecord(line)
+    assert len(record) == vr.SPLIT_COLUMNS
+    assert record[0] == "1"
+    assert record[4] == "G"
+    assert isinstance(record[7], vi.Info)
+    assert record[7].get("DP") == "3"
+    assert bytes(record.tail) == b"\tGT:DP\t0/1:3\t1/1:7"
+
+
+def testWriteRoundTrip():
+    line = b"1\t100\trs1\tA\tG\t50\tPASS\tDP=3\tGT\t0/1"
+    assert writeToBytes(vr.parseRecord(line)) == line + b"\n"
+
+
+def testWriteKeepsAnnotations():
+    record = vr.parseRecord(b"2\t5\t.\tC\tT\t.\t.\t.\tGT\t1/1")
+    record[2] = "rs5"
+    record[7].replace("DB")
+    record[7].add(";VC=SNV")
+    assert writeToBytes(record) == b"2\t5\trs5\tC\tT\t.\t.\tDB;VC=SNV\tGT\t1/1\n"
+
+
+def testRecordWithoutSampleColumns():
+    record = vr.parseRecord(b"1\t100\trs1\tA\tG\t50\tPASS\tDP=3")
+    assert bytes(record.tail) == b""
+    assert str(record[7]) == "DP=3"
+    assert writeToBytes(record) == b"1\t100\trs1\tA\tG\t50\tPASS\tDP=3\n"
+
+
+def testShortRecordHasNoInfo():
+    record = vr.parseRecord(b"1\t100\tA\tG")
+    assert record.fields == ["1", "100", "A", "G"]
+    assert writeToBytes(record) == b"1\t100\tA\tG\n"
+
+
+def testOtherSeparator():
+    record = vr.parseRecord(b"1,100,rs1,A,G,50,PASS,DP=3,GT", sep=b",")
+    assert record[1] == "100"
+    assert str(record[7]) == "DP=3"
+    assert bytes(record.tail) == b",GT"
+
+
+def testHeaderLines():
+    assert vr.isHeaderLine(b"")
+    assert vr.isHeaderLine(b"##fileformat=VCFv4.1")
+    assert vr.isHeaderLine(b"#CHROM\tPOS")
+    assert vr.isHeaderLine(b"CHROM\tPOS")
+    assert not vr.isHeaderLine(b"1\t100")
+
+
+### EOF
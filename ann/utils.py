@@ -12,30 +12,62 @@
 
 import os
 import json
+import threading
+import time
 import pymysql
+import pymysql.cursors
 import boto3
 from botocore.exceptions import ClientError
 
+"""Reference database credentials are fetched from AWS Secrets Manager
+   at most once every SECRET_TTL seconds per process
+"""
+
+SECRET_TTL = 900
+secretCache = {"secret": None, "fetched": 0}
+secretLock = threading.Lock()
+
+
+def get_rds_secret(refresh=False):
+    with secretLock:
+        age = time.time() - secretCache["fetched"]
+        if refresh or secretCache["secret"] is None or age > SECRET_TTL:
+            AWS_REGION_NAME = (
+                os.environ["AWS_REGION_NAME"]
+                if ("AWS_REGION_NAME" in os.environ)
+                else "us-east-1"
+            )
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
+                secretCache["secret"] = json.loads(asm_response["SecretString"])
+                secretCache["fetched"] = time.time()
+            except ClientError as e:
+                print(
+                    f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}"
+                )
+                raise e
+
+        return secretCache["secret"]
+
+
 """Get connection to reference database
 """
 
 
 def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+    rds_secret = get_rds_secret()
     try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+        return open_connection(rds_secret)
+    except pymysql.err.OperationalError:
+        # Credentials may have been rotated since they were cached
+        rds_secret = get_rds_secret(refresh=True)
+        return open_connection(rds_secret)
 
+
+def open_connection(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret["host"]
     mysql_port = rds_secret["port"]
@@ -49,6 +81,85 @@ def db_connect():
     )
 
 
+"""Process-wide pool of reference database connections
+
+Stages borrow a connection with get_connection() and hand it back with
+release_connection(). Idle connections are health checked (and reopened
+if the server dropped them) before they are handed out again.
+"""
+
+
+class ConnectionPool(object):
+    def __init__(self, maxIdle=4):
+        self.maxIdle = maxIdle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                conn = self.idle.pop()
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except pymysql.err.Error as e:
+                print(f"Dropping broken reference database connection: {e}")
+                self.discard(conn)
+
+        return db_connect()
+
+    """Keeps at least n idle connections, e.g. one per concurrent stage
+    """
+
+    def reserve(self, n):
+        with self.lock:
+            self.maxIdle = max(self.maxIdle, n)
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.maxIdle:
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def closeAll(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+
+connectionPool = ConnectionPool()
+
+
+def get_connection():
+    return connectionPool.get()
+
+
+def release_connection(conn):
+    connectionPool.put(conn)
+
+
+"""Unbuffered server-side cursor (SSCursor) on a connection
+   Rows are read from the server as they are fetched instead of the whole
+   result being buffered first; the cursor has to be closed before the
+   connection runs another query
+"""
+
+
+def open_stream(conn):
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
 """Column inices for pileup and VCF
 """
 
@@ -110,6 +221,76 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
+"""UCSC binning scheme (binRange.h in the UCSC Genome Browser source)
+Rows of binned tables carry the smallest bin holding their [start, end)
+range. Bins are 128kb at the finest level and 8 times wider at each level
+up; coordinates beyond 512Mb use the extended scheme.
+"""
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_OFFSETS_EXTENDED = [4096 + 512 + 64 + 8 + 1] + BIN_OFFSETS
+BIN_OFFSET_OLD_TO_EXTENDED = 4681
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAXEND_STANDARD = 512 * 1024 * 1024
+
+
+def binFromRange(start, end):
+    offsets = BIN_OFFSETS
+    base = 0
+    if end > BIN_MAXEND_STANDARD:
+        offsets = BIN_OFFSETS_EXTENDED
+        base = BIN_OFFSET_OLD_TO_EXTENDED
+
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        if startBin == endBin:
+            return base + offset + startBin
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    raise ValueError(f"start {start}, end {end} out of range for binning")
+
+
+"""Every bin a row overlapping [start, end) can be stored in
+   Rows ending beyond 512Mb have extended bins wherever they start, so the
+   extended bins of the range are always included
+"""
+
+
+def binsOverlappingRange(start, end):
+    start = max(start, 0)
+    bins = []
+    if start < BIN_MAXEND_STANDARD:
+        bins.extend(
+            getLevelBins(start, min(end, BIN_MAXEND_STANDARD), BIN_OFFSETS, 0)
+        )
+    bins.extend(
+        getLevelBins(start, end, BIN_OFFSETS_EXTENDED, BIN_OFFSET_OLD_TO_EXTENDED)
+    )
+    return bins
+
+
+def getLevelBins(start, end, offsets, base):
+    bins = []
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        bins.extend(range(base + offset + startBin, base + offset + endBin + 1))
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""Promoter-window copy of a gene table (add_promoter_windows.py), holding
+the transcripts widened by the promoter offset
+"""
+
+
+def promoterTable(table, offset):
+    return table + "Promoter" + str(int(offset))
+
+
 """Helper method to deduplicate the list
 """
 
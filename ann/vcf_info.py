@@ -0,0 +1,109 @@
+# vcf_info.py
+#
+# INFO column of a variant record being annotated
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+"""Value returned for keys that are not in INFO (same as utils.parse_field)
+"""
+MISSING = "."
+
+
+"""INFO of a record, built up by the annotation stages
+
+Text added by the stages is kept as a list of pieces and joined once, when
+the record is written (str()), instead of rebuilding the whole string at
+every stage. Items are indexed by key as they are added, so reading a key
+does not rescan INFO. The serialized text is exactly the concatenation of
+the original INFO and the added pieces, separators included, as stages
+used to build it.
+"""
+
+
+class Info(object):
+    __slots__ = ["parts", "length", "values"]
+
+    def __init__(self, text):
+        self.parts = []
+        self.length = 0
+        self.values = {}
+        self.add(text)
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if len(self.parts) > 0 else ""
+
+    def __len__(self):
+        return self.length
+
+    """Adds text as is; new items are expected to start at a separator
+    """
+
+    def add(self, text):
+        text = str(text)
+        if len(text) == 0:
+            return
+        self.parts.append(text)
+        self.length = self.length + len(text)
+        for item in text.split(";"):
+            pairs = item.split("=")
+            if len(pairs) > 1 and pairs[0] not in self.values:
+                self.values[pairs[0]] = pairs[1]
+
+    """Adds text as a new item, with a separator unless INFO ends with one
+    """
+
+    def append(self, text):
+        if self.endswith(";"):
+            self.add(text)
+        else:
+            self.add(";" + str(text))
+
+    """Replaces the whole of INFO
+    """
+
+    def replace(self, text):
+        self.parts = []
+        self.length = 0
+        self.values = {}
+        self.add(text)
+
+    """First value of a key, "." if it is not there
+       Values end at the next "=", like utils.parse_field returns them
+    """
+
+    def get(self, key):
+        return self.values.get(key, MISSING)
+
+    def isMissing(self):
+        return self.length == 1 and self.parts[-1] == MISSING
+
+    def startswith(self, prefix):
+        head = ""
+        for part in self.parts:
+            if len(head) >= len(prefix):
+                break
+            head = head + part
+        return head.startswith(prefix)
+
+    def endswith(self, suffix):
+        tail = ""
+        for part in reversed(self.parts):
+            if len(tail) >= len(suffix):
+                break
+            tail = part + tail
+        return tail.endswith(suffix)
+
+    """Removes the first n characters
+    """
+
+    def dropPrefix(self, n):
+        text = str(self)
+        self.replace(text[n:])
+
+
+### EOF
@@ -0,0 +1,88 @@
+# vcf_record.py
+#
+# Variant records and the bytes-level VCF reader and writer shared by the
+# annotation pipeline
+#
+# Copyright (C) 2015-2019 Vas Vasiliadis
+# University of Chicago
+#
+##
+
+import vcf_info as vi
+
+"""Columns split into fields (CHROM to INFO), every column the stages read
+   The rest of the line, FORMAT and the sample columns, is never split
+"""
+SPLIT_COLUMNS = 8
+
+
+"""A variant record: the first SPLIT_COLUMNS fields, INFO held as a
+vcf_info.Info, and the rest of the line as read
+
+The tail is a memoryview slice of the input line (starting with its
+separator), written back as is, so wide multi-sample lines are not split,
+converted or joined. Records index like the list of their fields.
+"""
+
+
+class VcfRecord(object):
+    __slots__ = ["fields", "tail"]
+
+    def __init__(self, fields, tail=b""):
+        self.fields = fields
+        self.tail = tail
+
+    def __getitem__(self, i):
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        self.fields[i] = value
+
+    def __len__(self):
+        return len(self.fields)
+
+
+"""Header, comment and empty lines (bytes) are passed through unchanged
+"""
+
+
+def isHeaderLine(line):
+    return len(line) == 0 or line.startswith(b"#") or line.startswith(b"CHROM")
+
+
+"""Record of a stripped variant line (bytes)
+"""
+
+
+def parseRecord(line, sep=b"\t"):
+    cut = -1
+    for i in range(0, SPLIT_COLUMNS):
+        cut = line.find(sep, cut + 1)
+        if cut < 0:
+            break
+
+    if cut < 0:
+        head = line
+        tail = b""
+    else:
+        head = line[:cut]
+        tail = memoryview(line)[cut:]
+
+    fields = head.decode("utf-8").split(sep.decode("utf-8"))
+    if len(fields) > 7:
+        fields[7] = vi.Info(fields[7])
+    return VcfRecord(fields, tail)
+
+
+"""Writes a record to a file opened in binary mode
+   Fields are written tab separated, the tail as it was read
+"""
+
+
+def writeRecord(fh_out, record):
+    fh_out.write("\t".join([str(x) for x in record.fields]).encode("utf-8"))
+    fh_out.write(record.tail)
+    fh_out.write(b"\n")
+
+
+### EOF